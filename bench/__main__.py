@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Run the microbenchmarks and load workloads, and save the results as JSON.
+
+    python -m bench [--output results.json] [--compare baseline.json]
+
+Every run is seeded and talks to the in-process stub upstream only, so two
+runs on the same machine are comparable. With --compare, each number is
+printed next to the baseline's, and the exit status is 1 if any of them got
+worse by more than --threshold.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from . import load, micro
+
+# Where bigger is better; everything else (latencies, ns per call) is better smaller.
+HIGHER_IS_BETTER = ('qps',)
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ('git', 'rev-parse', '--short', 'HEAD'), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict) -> dict[str, float]:
+    flat = {f'micro/{name}_ns': value for name, value in results['micro'].items()}
+    for workload, numbers in results['load'].items():
+        for metric in ('qps', 'p50_ms', 'p99_ms'):
+            flat[f'load/{workload}/{metric}'] = numbers[metric]
+    return flat
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print every number against the baseline; return the names of the regressions."""
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for name, value in current.items():
+        if not previous.get(name):
+            print(f'{name:36} {value:12.3f}')
+            continue
+        change = value / previous[name] - 1
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:36} {value:12.3f}  was {previous[name]:12.3f}  {change:+7.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.splitlines()[0])
+    parser.add_argument('--output', '-o', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--requests', type=int, default=5000, help='queries per load workload')
+    parser.add_argument('--iterations', type=int, default=100000, help='calls per microbenchmark')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent load clients')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub upstream latency in seconds')
+    parser.add_argument('--raw', action='store_true', help='drive the raw ASGI handler instead of FastAPI')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'args': vars(args),
+        },
+        'micro': micro.run_all(args.iterations),
+        'load': asyncio.run(load.run_all(
+            args.requests, concurrency=args.concurrency, latency=args.latency, raw=args.raw)),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions over {args.threshold:.0%}', file=sys.stderr)
+            sys.exit(1)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
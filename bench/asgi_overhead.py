@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Requests per second of the FastAPI route vs the raw ASGI DoH handler.
+
+Calls both ASGI apps in-process with a canned resolve(), so the numbers
+are the per-request framework cost alone:
+
+    python -m bench.asgi_overhead [requests]
+"""
+import asyncio
+import base64
+import sys
+import time
+from unittest.mock import patch
+
+from cf_patch_doh import app as doh
+from cf_patch_doh.asgi import app as raw_app
+from dnslib import A, DNSRecord, QTYPE, RR
+
+
+def make_scopes(query: bytes) -> dict[str, tuple[dict, bytes]]:
+    encoded = base64.urlsafe_b64encode(query).rstrip(b'=')
+    base = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'server': ('test', 80), 'client': ('127.0.0.1', 1234), 'root_path': '',
+    }
+    return {
+        'GET': ({
+            **base, 'method': 'GET', 'path': '/dns-query', 'raw_path': b'/dns-query',
+            'query_string': b'dns=' + encoded, 'headers': [(b'host', b'test')],
+        }, b''),
+        'POST': ({
+            **base, 'method': 'POST', 'path': '/dns-query', 'raw_path': b'/dns-query', 'query_string': b'',
+            'headers': [(b'host', b'test'), (b'content-type', b'application/dns-message')],
+        }, query),
+    }
+
+
+async def run(asgi_app, scope: dict, body: bytes, count: int) -> float:
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(count):
+        await asgi_app(scope, receive, send)
+    return count / (time.perf_counter() - started)
+
+
+async def main(count: int):
+    query = DNSRecord.question('example.com')
+    answer = query.reply()
+    answer.add_answer(RR('example.com', QTYPE.A, rdata=A('1.2.3.4'), ttl=300))
+    packed = bytes(answer.pack())
+
+    async def resolve(query, upstream=None):
+        return packed
+
+    with patch.object(doh, 'resolve', resolve):
+        for method, (scope, body) in make_scopes(bytes(query.pack())).items():
+            await run(doh.app, scope, body, count // 10)  # warm up
+            fastapi = await run(doh.app, scope, body, count)
+            raw = await run(raw_app, scope, body, count)
+            print(f'{method:4}  fastapi {fastapi:9.0f} req/s  raw {raw:9.0f} req/s  x{raw / fastapi:.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
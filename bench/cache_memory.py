@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Bytes per CACHED_QUERY entry: packed records vs lists of dnslib RRs.
+
+Fills a TtlCache with `entries` answers parsed from wire format, as the
+upstream's are, once per layout, and reports the deep size per entry of the
+value alone and of the whole entry (key, storage tuple and expiry heap
+item), along with the time a cache hit takes to hand out fresh RRs.
+
+    python -m bench.cache_memory [entries]
+"""
+import sys
+import time
+
+from cf_patch_doh.dns_utils import _decayed, PackedRecords, TtlCache
+from cf_patch_doh.replay import deep_sizeof
+from dnslib import A, AAAA, CNAME, DNSRecord, HTTPS, QTYPE, RR
+
+
+def answers(name: str) -> dict[str, list[RR]]:
+    """Typical answers for `name`, round-tripped through wire format."""
+    def parsed(*rrs: RR) -> list[RR]:
+        record = DNSRecord.question(name).reply()
+        for rr in rrs:
+            record.add_answer(rr)
+        return DNSRecord.parse(record.pack()).rr
+
+    return {
+        'A': parsed(RR(name, QTYPE.A, rdata=A('104.16.1.2'), ttl=300)),
+        'AAAA x2': parsed(
+            RR(name, QTYPE.AAAA, rdata=AAAA('2606:4700::1'), ttl=300),
+            RR(name, QTYPE.AAAA, rdata=AAAA('2606:4700::2'), ttl=300)),
+        'CNAME + A x2': parsed(
+            RR(name, QTYPE.CNAME, rdata=CNAME(f'cdn.{name}'), ttl=300),
+            RR(f'cdn.{name}', QTYPE.A, rdata=A('1.2.3.4'), ttl=300),
+            RR(f'cdn.{name}', QTYPE.A, rdata=A('1.2.3.5'), ttl=300)),
+        'HTTPS': parsed(RR(name, QTYPE.HTTPS, rdata=HTTPS.fromZone(
+            ['1', '.', 'alpn=h3,h2', 'ipv4hint=104.16.1.2,104.16.1.3', 'ipv6hint=2606:4700::1']), ttl=300)),
+    }
+
+
+def per_entry(layout, kind: str, entries: int) -> tuple[float, float, float]:
+    cache = TtlCache(max_size=entries, max_ttl=3000)
+    values = []
+    for i in range(entries):
+        value = layout(answers(f'site{i}.example')[kind])
+        values.append(value)
+        cache.store((f'site{i}.example', 'A', 'https://1.1.1.1/dns-query'), value, ttl=300)
+    value_bytes = deep_sizeof(values) - sys.getsizeof(values)
+    entry_bytes = deep_sizeof((cache.storage, cache.expiry)) - sys.getsizeof(cache.expiry)
+    return value_bytes / entries, entry_bytes / entries, read_time(values[0])
+
+
+def read_time(value, rounds: int = 20000) -> float:
+    """Microseconds to hand out fresh RRs from a cached value, as get_cache does."""
+    read = value.unpack if isinstance(value, PackedRecords) else (lambda age: _decayed(value, age))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        read(10)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main(entries: int):
+    layouts = {'RR list': list, 'packed': PackedRecords}
+    print(f'{"answer":14} {"layout":8} {"value B":>8} {"entry B":>8} {"read us":>8}')
+    for kind in answers('example.com'):
+        for name, layout in layouts.items():
+            value_bytes, entry_bytes, read_us = per_entry(layout, kind, entries)
+            print(f'{kind:14} {name:8} {value_bytes:8.0f} {entry_bytes:8.0f} {read_us:8.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Throughput and latency of /dns-query against the stub upstream.
+
+Drives the ASGI app in-process with `concurrency` clients, each sending
+GET or POST queries back to back, and reports queries per second and
+p50/p99 latency for these workloads:
+
+- hit: Zipf-distributed names, all answered before, so every query is a cache hit;
+- miss: names never seen before with non-Cloudflare answers, so every query goes upstream;
+- patch: names never seen before with Cloudflare answers, so every query goes upstream and is patched;
+- zipf: Zipf-distributed names from a cold cache, half of them Cloudflare, with MAX_CACHE_SIZE evictions.
+
+    python -m bench.load [requests]
+"""
+import asyncio
+import base64
+import itertools
+import random
+import sys
+import time
+from typing import Callable, Iterator
+
+from cf_patch_doh import app as doh, dns_utils
+from cf_patch_doh.asgi import app as raw_app
+from cf_patch_doh.stub_upstream import clear_caches, installed, StubUpstream
+from dnslib import DNSRecord
+
+
+WORKLOADS = ('hit', 'miss', 'patch', 'zipf')
+METHODS = ('GET', 'POST')
+
+
+def zipf_names(vocabulary: int, exponent: float = 1.0, seed: int = 0) -> Iterator[str]:
+    """Endless names from `vocabulary` distinct ones, the k-th most popular drawn with weight 1/k^exponent."""
+    rng = random.Random(seed)
+    names = [f'site{k}.example' for k in range(vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (k + 1) ** exponent for k in range(vocabulary)))
+    while True:
+        yield from rng.choices(names, cum_weights=cum_weights, k=1024)
+
+
+def unique_names(prefix: str) -> Iterator[str]:
+    return (f'q{i}.{prefix}.example' for i in itertools.count())
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def make_request(method: str, query: bytes) -> tuple[dict, bytes]:
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http', 'method': method,
+        'server': ('bench', 80), 'client': ('127.0.0.1', 1234), 'root_path': '',
+        'path': '/dns-query', 'raw_path': b'/dns-query', 'query_string': b'',
+        'headers': [(b'host', b'bench')],
+    }
+    if method == 'GET':
+        scope['query_string'] = b'dns=' + base64.urlsafe_b64encode(query).rstrip(b'=')
+        return scope, b''
+    scope['headers'] = [(b'host', b'bench'), (b'content-type', b'application/dns-message')]
+    return scope, query
+
+
+async def call(asgi_app: Callable, method: str, name: str) -> int:
+    scope, body = make_request(method, bytes(DNSRecord.question(name).pack()))
+    status = 0
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await asgi_app(scope, receive, send)
+    return status
+
+
+async def drive(asgi_app: Callable, method: str, names: Iterator[str], requests: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            name = next(names)
+            started = time.perf_counter()
+            if await call(asgi_app, method, name) != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'qps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def run_workload(
+        workload: str,
+        method: str,
+        requests: int,
+        concurrency: int = 32,
+        latency: float = 0.0,
+        vocabulary: int = 10000,
+        raw: bool = False) -> dict:
+    asgi_app = raw_app if raw else doh.app
+    clear_caches()
+    if workload == 'hit':
+        stub = StubUpstream(latency=latency, cloudflare_ratio=0.5)
+        # Enough distinct names to matter, few enough to all stay cached.
+        vocabulary = min(vocabulary, dns_utils.MAX_CACHE_SIZE // 2)
+        names = zipf_names(vocabulary)
+        with installed(stub):
+            for k in range(vocabulary):
+                await call(asgi_app, method, f'site{k}.example')
+            stub.queries = 0
+            result = await drive(asgi_app, method, names, requests, concurrency)
+    else:
+        if workload == 'miss':
+            stub, names = StubUpstream(latency=latency, cloudflare_ratio=0), unique_names(f'miss-{method}')
+        elif workload == 'patch':
+            stub, names = StubUpstream(latency=latency, cloudflare_ratio=1), unique_names(f'patch-{method}')
+        elif workload == 'zipf':
+            stub, names = StubUpstream(latency=latency, cloudflare_ratio=0.5), zipf_names(vocabulary)
+        else:
+            raise ValueError(f'Unknown workload: {workload!r}')
+        with installed(stub):
+            result = await drive(asgi_app, method, names, requests, concurrency)
+    clear_caches()
+    result['upstream_queries'] = stub.queries
+    return result
+
+
+async def run_all(requests: int, concurrency: int = 32, latency: float = 0.0, raw: bool = False) -> dict:
+    results = {}
+    for workload in WORKLOADS:
+        for method in METHODS:
+            results[f'{workload}/{method}'] = await run_workload(
+                workload, method, requests, concurrency=concurrency, latency=latency, raw=raw)
+    return results
+
+
+async def main(requests: int):
+    for name, result in (await run_all(requests)).items():
+        print(
+            f'{name:11} {result["qps"]:9.0f} q/s  p50 {result["p50_ms"]:7.3f} ms  p99 {result["p99_ms"]:7.3f} ms'
+            f'  upstream {result["upstream_queries"]}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
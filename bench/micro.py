@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the hot helpers, in nanoseconds per call.
+
+    python -m bench.micro [iterations]
+"""
+import asyncio
+import sys
+import time
+from typing import Callable
+
+from cf_patch_doh import dns_utils
+from cf_patch_doh.dns_utils import is_cloudflare_sync, patch_response, should_bypass, TtlCache
+from cf_patch_doh.stub_upstream import installed, StubUpstream
+from dnslib import A, DNSRecord, QTYPE, RR
+
+
+def per_call(func: Callable, iterations: int) -> float:
+    """Best of three runs, in nanoseconds per call."""
+    best = float('inf')
+    for _ in range(3):
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            func()
+        best = min(best, (time.perf_counter_ns() - started) / iterations)
+    return round(best, 1)
+
+
+def answer(name: str, ip: str) -> DNSRecord:
+    record = DNSRecord.question(name).reply()
+    record.add_answer(RR(name, QTYPE.A, rdata=A(ip), ttl=300))
+    return record
+
+
+def bench_ttl_cache(iterations: int) -> dict:
+    cache = TtlCache(max_size=1000, max_ttl=3000)
+    keys = [(f'site{i}.example', 'A', dns_utils.DEFAULT_UPSTREAM) for i in range(1000)]
+    for key in keys:
+        cache.store(key, [], ttl=300)
+    hit = iter(keys * (iterations // len(keys) * 3 + 3))
+    miss = ('missing.example', 'A', dns_utils.DEFAULT_UPSTREAM)
+    # Over capacity, so every store evicts.
+    store = iter([(f'new{i}.example', 'A', dns_utils.DEFAULT_UPSTREAM) for i in range(iterations * 3)])
+    return {
+        'ttl_cache_get_hit': per_call(lambda: cache.get(next(hit)), iterations),
+        'ttl_cache_get_miss': per_call(lambda: cache.get(miss), iterations),
+        'ttl_cache_store_evict': per_call(lambda: cache.store(next(store), [], ttl=300), iterations),
+    }
+
+
+def bench_should_bypass(iterations: int) -> dict:
+    listed = answer('speed.cloudflare.com', '104.16.0.1')
+    unlisted = answer('www.some.unlisted.example', '104.16.0.1')
+    return {
+        'should_bypass_listed': per_call(lambda: should_bypass(listed), iterations),
+        'should_bypass_unlisted': per_call(lambda: should_bypass(unlisted), iterations),
+    }
+
+
+def bench_is_cloudflare(iterations: int) -> dict:
+    return {
+        'is_cloudflare_str': per_call(lambda: is_cloudflare_sync('104.16.0.1'), iterations),
+        'is_cloudflare_packed': per_call(lambda: is_cloudflare_sync(b'\x68\x10\x00\x01'), iterations),
+        'is_cloudflare_str_miss': per_call(lambda: is_cloudflare_sync('198.51.100.1'), iterations),
+    }
+
+
+def bench_patch_response(iterations: int) -> dict:
+    async def run(ip: str) -> float:
+        best = float('inf')
+        for _ in range(3):
+            # patch_response works in place, so each call gets a fresh record.
+            records = [answer('www.patched.example', ip) for _ in range(iterations)]
+            started = time.perf_counter_ns()
+            for record in records:
+                await patch_response(record)
+            best = min(best, (time.perf_counter_ns() - started) / iterations)
+        return round(best, 1)
+
+    with installed(StubUpstream()):
+        return {
+            'patch_response_cloudflare': asyncio.run(run('104.16.0.1')),
+            'patch_response_other': asyncio.run(run('198.51.100.1')),
+        }
+
+
+def run_all(iterations: int) -> dict:
+    return {
+        **bench_ttl_cache(iterations),
+        **bench_should_bypass(iterations),
+        **bench_is_cloudflare(iterations),
+        **bench_patch_response(iterations // 10),
+    }
+
+
+def main(iterations: int):
+    for name, ns in run_all(iterations).items():
+        print(f'{name:28} {ns:10.1f} ns')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,14 +1,76 @@
-import base64
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from functools import partial
 
-from dnslib import DNSRecord, QTYPE
+from dnslib import DNSError, DNSRecord, QTYPE, RCODE
 from fastapi import FastAPI, Request, Response
-from starlette.responses import RedirectResponse
+from starlette.responses import PlainTextResponse, RedirectResponse
+
+from . import cloudflare, dns_server, dns_utils, metrics, tracing, wire
+from .reloader import Reloader
+from .snapshot import SNAPSHOT_PATH, Snapshotter
+from .upstream import SingleFlight, UpstreamError
+
+
+RELOADER = Reloader([cloudflare.CF_RANGES, dns_utils.BYPASS])
+SNAPSHOTTER = Snapshotter(SNAPSHOT_PATH, dns_utils.CACHED_ANSWER, dns_utils.PATCH_TARGETS) if SNAPSHOT_PATH else None
+
+# (Question in wire format, upstream): refresh of a cached answer in progress
+REFRESHES: SingleFlight[wire.WireAnswer | None] = SingleFlight()
+dns_utils.SINGLE_FLIGHTS['refresh'] = REFRESHES
+# (Question in wire format, upstream): background refresh of a hot answer, referenced until it finishes
+PREFETCHES: dict[tuple[bytes, str], asyncio.Task] = dict()
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await RELOADER.reload_all(force=True)
+    RELOADER.install_signal_handler()
+    if SNAPSHOTTER is not None:
+        await SNAPSHOTTER.load()
+    # Patch targets must be known before the first Cloudflare answer comes in.
+    try:
+        await asyncio.wait_for(dns_utils.PATCH_TARGETS.refresh(), timeout=10)
+    except asyncio.TimeoutError:
+        pass
+    tasks = [
+        asyncio.create_task(dns_utils.UPSTREAM_CLIENTS.run_evictor()),
+        asyncio.create_task(dns_utils.run_cache_sweeper()),
+        asyncio.create_task(dns_utils.PATCH_TARGETS.run()),
+        asyncio.create_task(RELOADER.run()),
+    ]
+    if SNAPSHOTTER is not None:
+        tasks.append(asyncio.create_task(SNAPSHOTTER.run()))
+    servers = []
+    if dns_server.DNS_LISTEN:
+        do53 = dns_server.DnsServers(resolve)
+        await do53.start(*dns_server.parse_listen(dns_server.DNS_LISTEN))
+        servers.append(do53)
+    if dns_server.DOT_LISTEN:
+        context = dns_server.make_tls_context(dns_server.DOT_CERT_FILE, dns_server.DOT_KEY_FILE)
+        dot = dns_server.DotServer(resolve, context)
+        await dot.start(*dns_server.parse_listen(dns_server.DOT_LISTEN))
+        servers.append(dot)
+    try:
+        yield
+    finally:
+        for server in servers:
+            await server.close()
+        for task in tasks:
+            task.cancel()
+        if SNAPSHOTTER is not None:
+            await SNAPSHOTTER.save()
+        await dns_utils.UPSTREAM_CLIENTS.aclose()
 
-from . import dns_utils
 
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
+    lifespan=lifespan,
 )
 
 
@@ -22,47 +84,224 @@ async def health():
     return 'OK'
 
 
+@app.get('/status')
+async def status():
+    ranges = cloudflare.CF_RANGES
+    return {
+        'cloudflare_ranges': {
+            'networks': ranges.value.networks,
+            'ranges': len(ranges.value),
+            **ranges.status(),
+        },
+        'bypass_list': {
+            'entries': len(dns_utils.BYPASS.value),
+            **dns_utils.BYPASS.status(),
+        },
+        'upstreams': {
+            'hedged': dns_utils.UPSTREAMS.hedged,
+            'tracked': len(dns_utils.UPSTREAMS.health),
+            'rejected': dns_utils.UPSTREAMS.health.rejected,
+            'open': [
+                upstream
+                for upstream in dns_utils.UPSTREAMS.health.breakers
+                if dns_utils.UPSTREAMS.health.state(upstream) != 'closed'
+            ],
+            'latency': {
+                upstream: {'ewma': stats.ewma, 'p95': stats.p95, 'failures': stats.failures}
+                for upstream, stats in dns_utils.UPSTREAMS.stats.items()
+            },
+        },
+    }
+
+
+@app.get('/metrics')
+async def metrics_page():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/health/patch-target')
+async def patch_target_health():
+    healthy, message = dns_utils.PATCH_TARGETS.health()
+    return PlainTextResponse(message, status_code=200 if healthy else 503)
+
+
 @app.get('/dns-query')
 @app.post("/dns-query")
 @app.get('/dns-query/{upstream:path}')
 @app.post('/dns-query/{upstream:path}')
 async def dns_query(request: Request, upstream: str | None = None):
+    started = time.perf_counter()
     if request.method == 'GET':
+        query_b64 = request.query_params.get('dns')
+        if query_b64 is None:
+            return Response(status_code=400)
         try:
-            query_b64 = request.query_params.get('dns')
-            if query_b64 is None:
-                return Response(status_code=400)
-            # Deal with padding
-            padding_needed = 4 - (len(query_b64) % 4)
-            query_b64 += '=' * padding_needed
-            query = base64.b64decode(query_b64)
-        except Exception:
+            query = wire.check_query(wire.decode_base64url(query_b64))
+        except wire.WireError:
             return Response(status_code=400)
     elif request.method == 'POST':
         if request.headers.get('accept') != 'application/dns-message' and \
                 request.headers.get('content-type') != 'application/dns-message':
             return Response(status_code=406)
         query = await request.body()
+        try:
+            wire.check_query(query)
+        except wire.WireError:
+            return Response(status_code=400)
     else:
         return Response(status_code=405)
 
-    answer = await get_record(query, upstream)
-    return Response(bytes(answer.pack()), media_type='application/dns-message')
+    try:
+        answer = await resolve(query, upstream)
+    except DNSError:
+        # Well framed, but with records dnslib can't make sense of.
+        return Response(status_code=400)
+    headers = None
+    if request.method == 'GET':
+        headers = cache_headers(answer)
+    response = Response(answer, media_type='application/dns-message', headers=headers)
+    metrics.QUERY_LATENCY.observe(time.perf_counter() - started, 'doh')
+    return response
+
+
+def cache_headers(answer: bytes) -> dict[str, str] | None:
+    """Let HTTP caches keep a GET answer no longer than its smallest TTL (RFC 8484 5.1)."""
+    try:
+        ttl = wire.min_ttl(answer)
+    except wire.WireError:
+        return None
+    if ttl is None:
+        return None
+    return {'Cache-Control': f'max-age={ttl}'}
 
 
-async def get_record(query, upstream: str | None = None):
-    record = DNSRecord.parse(query)
-    domain = record.q.qname.idna().rstrip('.')
+async def resolve(query: bytes, upstream: str | None = None) -> bytes:
+    """Answer a DNS query in wire format, replaying cached packed answers when possible.
+
+    Hot answers close to expiry are refreshed in the background. Expired
+    ones are refreshed on the spot, but if the upstream fails or takes
+    longer than STALE_RESPONSE_TIMEOUT, the stale answer is served (RFC 8767).
+    """
     upstream = upstream or dns_utils.DEFAULT_UPSTREAM
-    type_ = QTYPE[record.q.qtype]
+    if (span := tracing.start('resolve', upstream=upstream)) is None:
+        return await _resolve(query, upstream)
+    try:
+        return await _resolve(query, upstream)
+    finally:
+        span.finish()
 
-    if rrs := dns_utils.get_cache(domain, type_, upstream):
-        answer = dns_utils.make_answer(record, rrs)
-        return answer
 
-    answer = await dns_utils.fetch_dns(domain, type_, upstream)
-    answer = dns_utils.make_answer(record, answer)
-    await dns_utils.patch_response(answer)
+async def _resolve(query: bytes, upstream: str) -> bytes:
+    with tracing.stage('wire_cache'):
+        cached = dns_utils.get_wire_answer(query, upstream)
+    if cached is not None:
+        answer, age = cached
+        if not dns_utils.is_stale(answer, age):
+            tracing.annotate(cache='hit')
+            if dns_utils.should_prefetch(answer, age):
+                prefetch(query, upstream)
+            with tracing.stage('render'):
+                return answer.render(query, age)
 
-    dns_utils.store_cache(domain, type_, upstream, answer.rr)
+        tracing.annotate(cache='stale')
+        try:
+            with tracing.stage('refresh'):
+                fresh = await asyncio.wait_for(refresh(query, upstream), dns_utils.STALE_RESPONSE_TIMEOUT)
+        except Exception as e:
+            logger.info('Serving stale answer, refresh failed: %s', f'{type(e).__name__}: {e}')
+            fresh = None
+        if fresh is None:
+            metrics.STALE_ANSWERS.inc()
+            return answer.render(query, age, floor=dns_utils.STALE_ANSWER_TTL)
+        return fresh.render(query)
+
+    tracing.annotate(cache='miss')
+    record = await get_record(query, upstream)
+    with tracing.stage('pack'):
+        answer = bytes(record.pack())
+    with tracing.stage('store'):
+        dns_utils.store_wire_cache(query, upstream, answer)
+    return answer
+
+
+async def refresh(query: bytes, upstream: str) -> wire.WireAnswer | None:
+    """Re-resolve a cached question past the caches; None if the new answer can't be cached."""
+    return await REFRESHES.do(dns_utils.wire_cache_key(query, upstream), partial(_refresh, query, upstream))
+
+
+async def _refresh(query: bytes, upstream: str) -> wire.WireAnswer | None:
+    record = await get_record(query, upstream, refresh=True)
+    return dns_utils.store_wire_cache(query, upstream, bytes(record.pack()))
+
+
+def prefetch(query: bytes, upstream: str):
+    key = dns_utils.wire_cache_key(query, upstream)
+    # One prefetch per answer: hits while it's in flight would only join it.
+    if key in PREFETCHES or key in REFRESHES.inflight:
+        return
+    metrics.PREFETCHES.inc()
+    task = asyncio.ensure_future(refresh(query, upstream))
+    PREFETCHES[key] = task
+    task.add_done_callback(partial(_prefetched, key))
+
+
+def _prefetched(key: tuple[bytes, str], task: asyncio.Task):
+    if PREFETCHES.get(key) is task:
+        del PREFETCHES[key]
+    if not task.cancelled() and (e := task.exception()) is not None:
+        logger.warning('Prefetch failed: %s: %s', type(e).__name__, e)
+
+
+async def get_record(query, upstream: str | None = None, refresh: bool = False):
+    """Resolve and patch `query`; `refresh` skips the record caches and always asks the upstream."""
+    with tracing.stage('parse'):
+        record = DNSRecord.parse(query)
+        domain = record.q.qname.idna().rstrip('.')
+        upstream = upstream or dns_utils.DEFAULT_UPSTREAM
+        type_ = QTYPE[record.q.qtype]
+    tracing.annotate(domain=domain, type=type_)
+
+    cached = None
+    if not refresh:
+        with tracing.stage('record_cache'):
+            if (negative := dns_utils.get_negative_cache(domain, type_, upstream)) is not None:
+                rcode, auth = negative
+                return dns_utils.make_answer(record, [], rcode=rcode, auth=auth)
+            cached = dns_utils.get_raw_cache(domain, type_, upstream)
+
+    if cached is not None:
+        raw, age = cached
+        rcode, auth = None, []
+    else:
+        try:
+            with tracing.stage('fetch'):
+                response = await dns_utils.fetch_record(domain, type_, upstream)
+        except UpstreamError as e:
+            # Dead or open-circuit upstream: answer right away instead of holding the client.
+            logger.info('SERVFAIL for %s %s: %s', domain, type_, e)
+            return dns_utils.make_answer(record, [], rcode=RCODE.SERVFAIL)
+        if not response.rr:
+            return dns_utils.make_answer(record, [], rcode=response.header.rcode, auth=response.auth)
+        raw, age = dns_utils.PackedRecords(response.rr), 0
+        rcode, auth = response.header.rcode, response.auth
+
+    # Upstream RRs already patched against the current targets are only aged, not patched again.
+    with tracing.stage('patched_cache'):
+        key = dns_utils.patched_cache_key(raw)
+        entry = dns_utils.get_patched_cache(key)
+    tracing.annotate(patched_cache='miss' if entry is None else 'hit')
+    if entry is not None:
+        return dns_utils.make_answer(record, dns_utils.patched_answer(raw, entry, age), rcode=rcode, auth=auth)
+
+    upstream_rrs = raw.unpack()
+    answer = dns_utils.make_answer(record, upstream_rrs, rcode=rcode, auth=auth)
+    was_patched = await dns_utils.patch_record(answer)
+    tracing.annotate(patched=was_patched)
+    with tracing.stage('store_records'):
+        entry = dns_utils.store_patched_cache(key, upstream_rrs, answer.rr, was_patched)
+    if age:
+        answer.rr = dns_utils.patched_answer(raw, entry, age)
+        return answer
+    with tracing.stage('ttl_policy'):
+        dns_utils.apply_ttl_policy(answer.rr, was_patched)
     return answer
@@ -0,0 +1,98 @@
+"""DoH served straight from the ASGI scope, skipping FastAPI routing.
+
+`app` answers /dns-query itself, with the same semantics as the FastAPI
+route, and passes every other request (and the lifespan) on to the FastAPI
+app. Run it with `uvicorn cf_patch_doh.asgi:app` instead of
+`cf_patch_doh.app:app`.
+"""
+import time
+from typing import Awaitable, Callable
+from urllib.parse import parse_qsl
+
+from dnslib import DNSError
+
+from . import app as doh, metrics, wire
+
+
+DOH_PATH = '/dns-query'
+DNS_MESSAGE = b'application/dns-message'
+
+ASGIApp = Callable[[dict, Callable, Callable], Awaitable[None]]
+
+
+class RawDohApp:
+
+    def __init__(self, fallback: ASGIApp, path: str = DOH_PATH):
+        self.fallback = fallback
+        self.path = path
+        self.prefix = path + '/'
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'POST'):
+            return await self.fallback(scope, receive, send)
+        path = scope['path']
+        if path == self.path:
+            upstream = None
+        elif path.startswith(self.prefix):
+            upstream = path[len(self.prefix):]
+        else:
+            return await self.fallback(scope, receive, send)
+
+        started = time.perf_counter()
+        if scope['method'] == 'GET':
+            dns = None
+            for name, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True):
+                if name == 'dns':
+                    dns = value
+            if dns is None:
+                return await self.send(send, 400)
+            try:
+                query = wire.check_query(wire.decode_base64url(dns))
+            except wire.WireError:
+                return await self.send(send, 400)
+        else:
+            accept = content_type = None
+            for name, value in scope['headers']:
+                if name == b'accept':
+                    accept = value
+                elif name == b'content-type':
+                    content_type = value
+            if accept != DNS_MESSAGE and content_type != DNS_MESSAGE:
+                return await self.send(send, 406)
+            query = await self.read_body(receive)
+            try:
+                wire.check_query(query)
+            except wire.WireError:
+                return await self.send(send, 400)
+
+        try:
+            answer = await doh.resolve(query, upstream)
+        except DNSError:
+            # Well framed, but with records dnslib can't make sense of.
+            return await self.send(send, 400)
+        headers = [(b'content-type', DNS_MESSAGE)]
+        if scope['method'] == 'GET' and (cache := doh.cache_headers(answer)):
+            headers += [(name.lower().encode(), value.encode()) for name, value in cache.items()]
+        await self.send(send, 200, answer, headers)
+        metrics.QUERY_LATENCY.observe(time.perf_counter() - started, 'doh')
+
+    @staticmethod
+    async def read_body(receive: Callable) -> bytes:
+        message = await receive()
+        body = message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+        chunks = [body]
+        while message.get('more_body'):
+            message = await receive()
+            chunks.append(message.get('body', b''))
+        return b''.join(chunks)
+
+    @staticmethod
+    async def send(send: Callable, status: int, body: bytes = b'', headers: list | None = None):
+        headers = [(b'content-length', str(len(body)).encode()), *(headers or ())]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+app = RawDohApp(doh.app)
@@ -0,0 +1,50 @@
+from typing import Iterable
+
+
+class DomainMatcher:
+    """Match domains against a bypass list in O(labels), whatever its size.
+
+    Entries starting with a dot match any name ending with them
+    ('.example.com' matches 'a.example.com' but not 'example.com'); other
+    entries match only the exact name. Matching ignores case.
+    """
+
+    __slots__ = ('exact', 'suffixes')
+
+    def __init__(self, entries: Iterable[str] = ()):
+        self.exact: set[str] = set()
+        self.suffixes: set[str] = set()
+        for entry in entries:
+            entry = entry.strip().lower().rstrip('.')
+            if not entry or entry == '.':
+                continue
+            if entry[0] == '.':
+                self.suffixes.add(entry)
+            else:
+                self.exact.add(entry)
+
+    def __len__(self) -> int:
+        return len(self.exact) + len(self.suffixes)
+
+    def __contains__(self, domain: str) -> bool:
+        domain = domain.lower().rstrip('.')
+        if domain in self.exact:
+            return True
+        if not self.suffixes:
+            return False
+        pos = domain.find('.')
+        while pos != -1:
+            if domain[pos:] in self.suffixes:
+                return True
+            pos = domain.find('.', pos + 1)
+        return False
+
+
+def parse_domains(text: str) -> list[str]:
+    """Read one entry per line; hosts-file lines ('0.0.0.0 example.com') are accepted too."""
+    entries = []
+    for line in text.splitlines():
+        fields = line.split('#', 1)[0].split()
+        if fields:
+            entries.append(fields[-1])
+    return entries
@@ -1,4 +1,13 @@
-from ipaddress import ip_network
+import os
+from bisect import bisect_right
+from ipaddress import ip_address, ip_network, IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from typing import Iterable
+
+from .reloader import Reloadable
+
+# Range lists in the format of https://www.cloudflare.com/ips-v4 and ips-v6.
+CF_IPS_V4_FILE = os.environ.get('CF_IPS_V4_FILE')
+CF_IPS_V6_FILE = os.environ.get('CF_IPS_V6_FILE')
 
 CF_NETWORKS = [
     ip_network('103.21.244.0/22'),
@@ -25,3 +34,95 @@ CF_NETWORKS = [
     ip_network('2a06:98c0::/29'),
     ip_network('2c0f:f248::/32'),
 ]
+
+
+class PrefixIndex:
+    """Network membership test over sorted, merged integer ranges.
+
+    Lookups are a bisect per address family, taking the address as a string,
+    packed bytes or an integer, so callers holding wire-format data never
+    have to build `ip_address` objects.
+    """
+
+    __slots__ = ('starts4', 'ends4', 'starts6', 'ends6', 'networks')
+
+    def __init__(self, networks: Iterable[IPv4Network | IPv6Network]):
+        networks = list(networks)
+        self.networks = len(networks)
+        self.starts4, self.ends4 = self._ranges(n for n in networks if n.version == 4)
+        self.starts6, self.ends6 = self._ranges(n for n in networks if n.version == 6)
+
+    @staticmethod
+    def _ranges(networks: Iterable[IPv4Network | IPv6Network]) -> tuple[list[int], list[int]]:
+        starts: list[int] = []
+        ends: list[int] = []
+        for network in sorted(networks):
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def __len__(self) -> int:
+        return len(self.starts4) + len(self.starts6)
+
+    def __contains__(self, ip: str | bytes | IPv4Address | IPv6Address) -> bool:
+        if isinstance(ip, bytes):
+            return self.contains_packed(ip)
+        if isinstance(ip, str):
+            ip = ip_address(ip)
+        if ip.version == 4:
+            return self.contains_v4(int(ip))
+        return self.contains_v6(int(ip))
+
+    def contains_v4(self, value: int) -> bool:
+        i = bisect_right(self.starts4, value) - 1
+        return i >= 0 and value <= self.ends4[i]
+
+    def contains_v6(self, value: int) -> bool:
+        i = bisect_right(self.starts6, value) - 1
+        return i >= 0 and value <= self.ends6[i]
+
+    def contains_packed(self, packed: bytes) -> bool:
+        if len(packed) == 4:
+            return self.contains_v4(int.from_bytes(packed, 'big'))
+        if len(packed) == 16:
+            return self.contains_v6(int.from_bytes(packed, 'big'))
+        raise ValueError(f'Not a packed IPv4 or IPv6 address: {packed!r}')
+
+
+# Index of the embedded list above.
+CF_INDEX = PrefixIndex(CF_NETWORKS)
+
+
+def parse_networks(text: str) -> list[IPv4Network | IPv6Network]:
+    networks = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            networks.append(ip_network(line))
+    return networks
+
+
+def build_index(paths: list[str]) -> PrefixIndex:
+    """Compile the networks listed in `paths`.
+
+    An address family none of the files mentions falls back to the embedded
+    list, so a missing ips-v6 file doesn't disable IPv6 detection.
+    """
+    networks = []
+    for path in paths:
+        with open(path) as f:
+            networks.extend(parse_networks(f.read()))
+    for version in (4, 6):
+        if not any(n.version == version for n in networks):
+            networks.extend(n for n in CF_NETWORKS if n.version == version)
+    return PrefixIndex(networks)
+
+
+# The index in use; replaced as a whole when the range files change.
+CF_RANGES: Reloadable[PrefixIndex] = Reloadable(
+    'Cloudflare ranges', (CF_IPS_V4_FILE, CF_IPS_V6_FILE), build_index, CF_INDEX)
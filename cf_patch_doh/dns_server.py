@@ -0,0 +1,245 @@
+"""Plain DNS (Do53) and DNS over TLS listeners answering through the same pipeline as DoH."""
+import asyncio
+import logging
+import os
+import socket
+import ssl
+import struct
+import time
+from typing import Awaitable, Callable
+
+from . import metrics, wire
+
+
+# 'host:port' to serve Do53 on, e.g. '0.0.0.0:53' or '[::]:53'; unset disables it.
+DNS_LISTEN = os.environ.get('DNS_LISTEN')
+# Largest UDP reply we send to EDNS clients, whatever they advertise (DNS Flag Day 2020).
+EDNS_UDP_PAYLOAD = int(os.environ.get('EDNS_UDP_PAYLOAD', '1232'))
+# Limit for clients without EDNS (RFC 1035).
+CLASSIC_UDP_PAYLOAD = 512
+# TCP connections with no new query for this long are closed (RFC 7766).
+TCP_IDLE_TIMEOUT = float(os.environ.get('TCP_IDLE_TIMEOUT', '10'))
+# Queries answered concurrently on one TCP connection before reading stalls.
+TCP_MAX_PIPELINE = int(os.environ.get('TCP_MAX_PIPELINE', '100'))
+# 'host:port' to serve DNS over TLS on, e.g. '0.0.0.0:853'; needs the certificate and key files below.
+DOT_LISTEN = os.environ.get('DOT_LISTEN')
+DOT_CERT_FILE = os.environ.get('DOT_CERT_FILE')
+DOT_KEY_FILE = os.environ.get('DOT_KEY_FILE')
+# DoT clients keep connections open to skip handshakes, so let them idle longer (RFC 7858 3.4).
+DOT_IDLE_TIMEOUT = float(os.environ.get('DOT_IDLE_TIMEOUT', '120'))
+
+# With WEB_CONCURRENCY workers, each binds DNS_LISTEN and DOT_LISTEN and the kernel spreads
+# queries and connections between them (SO_REUSEPORT, Linux and the BSDs).
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+Resolver = Callable[[bytes], Awaitable[bytes]]
+
+_LENGTH = struct.Struct('!H')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_listen(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    if not host:
+        raise ValueError(f'Expected host:port, got {address!r}')
+    return host.strip('[]'), int(port)
+
+
+async def answer_query(resolve: Resolver, query: bytes) -> bytes | None:
+    """Resolve a query, turning failures into FORMERR/SERVFAIL; None means drop it."""
+    try:
+        payload_size = wire.edns_payload_size(query)
+        wire.check_query(query)
+    except wire.WireError:
+        if len(query) > 2 and query[2] & 0x80:
+            # Answering a response would let two servers bounce packets at each other forever.
+            return None
+        return wire.error_reply(query, wire.RCODE_FORMERR)
+
+    try:
+        reply = await resolve(query)
+    except Exception:
+        logger.exception('Resolving a stream or datagram query failed')
+        reply = wire.error_reply(query, wire.RCODE_SERVFAIL)
+    if payload_size is not None:
+        reply = wire.with_opt(reply, EDNS_UDP_PAYLOAD)
+    return reply
+
+
+def fit_udp(query: bytes, reply: bytes) -> bytes:
+    """Truncate `reply` to what the client can take over UDP, setting TC if it doesn't fit."""
+    try:
+        payload_size = wire.edns_payload_size(query)
+    except wire.WireError:
+        payload_size = None
+    if payload_size is None:
+        limit = CLASSIC_UDP_PAYLOAD
+    else:
+        limit = min(max(payload_size, CLASSIC_UDP_PAYLOAD), EDNS_UDP_PAYLOAD)
+    if len(reply) <= limit:
+        return reply
+
+    reply = wire.truncated(reply)
+    if payload_size is not None:
+        reply = wire.with_opt(reply, EDNS_UDP_PAYLOAD)
+    return reply
+
+
+class UdpServer(asyncio.DatagramProtocol):
+
+    def __init__(self, resolve: Resolver):
+        self.resolve = resolve
+        self.transport: asyncio.DatagramTransport | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        task = asyncio.ensure_future(self.handle(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, query: bytes, addr):
+        started = time.perf_counter()
+        reply = await answer_query(self.resolve, query)
+        if reply is None or self.transport is None or self.transport.is_closing():
+            return
+        self.transport.sendto(fit_udp(query, reply), addr)
+        metrics.QUERY_LATENCY.observe(time.perf_counter() - started, 'udp')
+
+
+class TcpServer:
+    """Length-prefixed DNS over a stream, answering pipelined queries as they complete.
+
+    Each query gets its own task, so a slow upstream doesn't hold up the
+    answers behind it; replies go out in completion order and are matched by
+    the client on their ID. Also serves TLS streams (DoT).
+    """
+
+    def __init__(
+            self,
+            resolve: Resolver,
+            idle_timeout: int | float = TCP_IDLE_TIMEOUT,
+            max_pipeline: int = TCP_MAX_PIPELINE,
+            transport: str = 'tcp'):
+        self.resolve = resolve
+        self.transport = transport
+        self.idle_timeout = idle_timeout
+        self.max_pipeline = max_pipeline
+        self.connections = 0
+        self.queries = 0
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        pending: set[asyncio.Task] = set()
+        slots = asyncio.Semaphore(self.max_pipeline)
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(_LENGTH.size), self.idle_timeout)
+                    query = await asyncio.wait_for(reader.readexactly(_LENGTH.unpack(header)[0]), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                self.queries += 1
+                await slots.acquire()
+                task = asyncio.ensure_future(self.answer(query, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.connections -= 1
+
+    async def answer(self, query: bytes, writer: asyncio.StreamWriter):
+        started = time.perf_counter()
+        reply = await answer_query(self.resolve, query)
+        if reply is None or writer.is_closing():
+            return
+        # A single write() keeps the frame whole next to other tasks' replies.
+        writer.write(_LENGTH.pack(len(reply)) + reply)
+        metrics.QUERY_LATENCY.observe(time.perf_counter() - started, self.transport)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class DnsServers:
+    """The Do53 UDP and TCP listeners on one address."""
+
+    def __init__(self, resolve: Resolver):
+        self.resolve = resolve
+        self.udp: UdpServer | None = None
+        self.tcp: TcpServer | None = None
+        self.transport: asyncio.DatagramTransport | None = None
+        self.server: asyncio.Server | None = None
+
+    async def start(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        self.transport, self.udp = await loop.create_datagram_endpoint(
+            lambda: UdpServer(self.resolve), local_addr=(host, port), reuse_port=REUSE_PORT)
+        self.tcp = TcpServer(self.resolve)
+        # Share an ephemeral port between UDP and TCP when asked for port 0.
+        port = self.transport.get_extra_info('sockname')[1]
+        self.server = await asyncio.start_server(self.tcp.handle_connection, host, port, reuse_port=REUSE_PORT)
+        logger.info('Serving Do53 on %s port %d', host, port)
+
+    @property
+    def port(self) -> int | None:
+        if self.transport is None:
+            return None
+        return self.transport.get_extra_info('sockname')[1]
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.udp is not None:
+            for task in list(self.udp.tasks):
+                task.cancel()
+
+
+def make_tls_context(cert_file: str, key_file: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    context.set_alpn_protocols(['dot'])
+    return context
+
+
+class DotServer:
+    """DNS over TLS (RFC 7858): the TCP framing and pipelining over TLS streams."""
+
+    def __init__(self, resolve: Resolver, context: ssl.SSLContext, idle_timeout: int | float = DOT_IDLE_TIMEOUT):
+        self.context = context
+        self.tcp = TcpServer(resolve, idle_timeout=idle_timeout, transport='dot')
+        self.server: asyncio.Server | None = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(
+            self.tcp.handle_connection, host, port, ssl=self.context, reuse_port=REUSE_PORT)
+        logger.info('Serving DNS over TLS on %s port %d', host, self.port)
+
+    @property
+    def port(self) -> int | None:
+        if self.server is None:
+            return None
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
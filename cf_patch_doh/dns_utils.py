@@ -1,13 +1,23 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import os
 import struct
+import sys
 import time
+from collections import OrderedDict
+from functools import partial
 from ipaddress import ip_address
-from typing import Callable, Generic, TypeVar
+from typing import Callable, Generic, Iterator, TypeVar
 
-import httpx
+from dnslib import A, AAAA, DNSBuffer, DNSRecord, HTTPS, QTYPE, RCODE, RR
 
-from dnslib import DNSRecord, HTTPS, QTYPE, RR
-
-from .cloudflare import CF_NETWORKS
+from . import cloudflare, metrics, tracing, wire
+from .bypass import DomainMatcher, parse_domains
+from .patch_target import PatchTargets
+from .reloader import Reloadable
+from .upstream import HedgedUpstreams, SingleFlight, UpstreamClients
 
 
 _SVCB_KEY_IPV4HINT = 4
@@ -38,7 +48,14 @@ def _pack_ipv6s(ips: list[str]) -> bytes:
     return b''.join(ip_address(ip).packed for ip in ips)
 
 
-MAX_CACHE_SIZE = 1000
+MAX_CACHE_SIZE = int(os.environ.get('MAX_CACHE_SIZE', '1000'))
+CACHE_POLICY = os.environ.get('CACHE_POLICY', 'ttl')
+CACHE_SWEEP_INTERVAL = 10
+# Memory-mapped file holding the packed answer cache, shared by all worker processes
+# (e.g. /dev/shm/cf-patch-doh-answers). Unset keeps the cache in-process.
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH')
+SHARED_CACHE_SLOTS = int(os.environ.get('SHARED_CACHE_SLOTS', '16384'))
+SHARED_CACHE_SLOT_SIZE = int(os.environ.get('SHARED_CACHE_SLOT_SIZE', '1024'))
 
 BYPASS_LIST = {
     'prod.api.letsencrypt.org',
@@ -49,34 +66,107 @@ BYPASS_LIST = {
     '.pacloudflare.com',
 }
 
+# Extra bypass entries, one per line, added to BYPASS_LIST.
+BYPASS_LIST_FILE = os.environ.get('BYPASS_LIST_FILE')
+
+
+def build_bypass(paths: list[str]) -> DomainMatcher:
+    entries = list(BYPASS_LIST)
+    for path in paths:
+        with open(path) as f:
+            entries.extend(parse_domains(f.read()))
+    return DomainMatcher(entries)
+
+
+BYPASS: Reloadable[DomainMatcher] = Reloadable(
+    'bypass list', (BYPASS_LIST_FILE,), build_bypass, DomainMatcher(BYPASS_LIST))
+
 DEFAULT_UPSTREAM = 'https://1.1.1.1/dns-query'
+# Upstreams that answer for DEFAULT_UPSTREAM too, raced against it when it's slow.
+HEDGE_UPSTREAMS = [
+    upstream.strip()
+    for upstream in os.environ.get('HEDGE_UPSTREAMS', 'https://1.0.0.1/dns-query').split(',')
+    if upstream.strip()
+]
+
+# TTL bounds for answers we serve, separately for patched and unpatched answers.
+# None means unbounded.
+UNPATCHED_TTL_FLOOR = int(os.environ.get('UNPATCHED_TTL_FLOOR', '0'))
+UNPATCHED_TTL_CEILING = int(os.environ['UNPATCHED_TTL_CEILING']) if 'UNPATCHED_TTL_CEILING' in os.environ else None
+PATCHED_TTL_FLOOR = int(os.environ.get('PATCHED_TTL_FLOOR', '600'))
+PATCHED_TTL_CEILING = int(os.environ['PATCHED_TTL_CEILING']) if 'PATCHED_TTL_CEILING' in os.environ else None
+
+# RFC 8767 serve-stale: how long past their TTL answers are kept, to be served
+# when the upstream can't refresh them within STALE_RESPONSE_TIMEOUT seconds.
+SERVE_STALE_TTL = int(os.environ.get('SERVE_STALE_TTL', '86400'))
+STALE_RESPONSE_TIMEOUT = float(os.environ.get('STALE_RESPONSE_TIMEOUT', '1.8'))
+# TTL given to stale answers (RFC 8767 4).
+STALE_ANSWER_TTL = 30
+# Answers hit at least PREFETCH_MIN_HITS times are refreshed in the background
+# once less than this fraction of their TTL is left.
+PREFETCH_THRESHOLD = float(os.environ.get('PREFETCH_THRESHOLD', '0.1'))
+PREFETCH_MIN_HITS = int(os.environ.get('PREFETCH_MIN_HITS', '3'))
+
+UPSTREAM_CLIENTS = UpstreamClients()
+UPSTREAMS = HedgedUpstreams({DEFAULT_UPSTREAM: [DEFAULT_UPSTREAM, *HEDGE_UPSTREAMS]})
+
+# Addresses Cloudflare answers are patched to, refreshed in the background.
+PATCH_TARGETS = PatchTargets(resolve=lambda domain, type_: fetch_record(domain, type_, DEFAULT_UPSTREAM))
+
+# (Domain, Type, upstream): upstream lookup in progress
+INFLIGHT_QUERIES: SingleFlight[list[RR]] = SingleFlight()
 
 T = TypeVar('T')
 V = TypeVar('V')
 
 
 class TtlCache(Generic[T, V]):
-    def __init__(self, max_size: int, max_ttl: int | float = 600, timer: Callable = time.monotonic):
+    """Dict-like cache whose entries expire after a TTL.
+
+    Expiry times are kept in a heap with lazy deletion: replaced or deleted
+    keys leave stale heap entries behind, which are skipped when they reach
+    the top. That keeps inserts, evictions and sweeps O(log n).
+
+    With `policy='ttl'` the entry closest to expiry is evicted when the cache
+    is full; with `policy='lru'` the least recently used one is.
+    """
+
+    POLICIES = ('ttl', 'lru')
+
+    # Expired entries swept on every store, so they don't pile up untouched.
+    SWEEP_PER_STORE = 2
+
+    def __init__(
+            self,
+            max_size: int,
+            max_ttl: int | float = 600,
+            timer: Callable = time.monotonic,
+            policy: str = 'ttl'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown eviction policy: {policy!r}')
         self.max_size = max_size
         self.max_ttl = max_ttl
         self.timer = timer
-        self.storage: dict[T, tuple[float, V]] = dict()
+        self.policy = policy
+        # key: (expire, value, stored)
+        self.storage: OrderedDict[T, tuple[float, V, float]] = OrderedDict()
+        # (expire, sequence, key), sequence breaks ties without comparing keys
+        self.expiry: list[tuple[float, int, T]] = []
+        self._sequence = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        # Entries dropped to make room, and ones dropped because they expired.
+        self.evictions = 0
+        self.expirations = 0
 
     def __setitem__(self, key: T, value: V):
         return self.store(key, value)
 
     def __getitem__(self, key: T) -> V:
-        (expire, value) = self.storage.__getitem__(key)
-        if expire < self.timer():
-            del self[key]
-            raise KeyError(key)
-        return value
+        return self.get_aged(key)[0]
 
     def __delitem__(self, key: T):
-        try:
-            del self.storage[key]
-        except KeyError:
-            pass
+        self.storage.pop(key, None)
 
     def __len__(self) -> int:
         return len(self.storage)
@@ -87,93 +177,448 @@ class TtlCache(Generic[T, V]):
         except KeyError:
             return default
 
-    def store(self, key: T, value: V, ttl: int | float | None = None):
+    def get_aged(self, key: T) -> tuple[V, float]:
+        """Return the value along with the seconds since it was stored."""
+        try:
+            (expire, value, stored) = self.storage.__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        now = self.timer()
+        if expire < now:
+            self.misses += 1
+            self.expirations += 1
+            del self[key]
+            raise KeyError(key)
+        self.hits += 1
+        if self.policy == 'lru':
+            self.storage.move_to_end(key)
+        return value, now - stored
+
+    def clear(self):
+        self.storage.clear()
+        self.expiry.clear()
+
+    def items_aged(self) -> Iterator[tuple[T, V, float, float]]:
+        """(key, value, age, seconds left) of every live entry."""
+        now = self.timer()
+        for key, (expire, value, stored) in list(self.storage.items()):
+            if expire >= now:
+                yield key, value, now - stored, expire - now
+
+    def store(self, key: T, value: V, ttl: int | float | None = None, age: int | float = 0):
+        """Store `value` for `ttl` seconds; `age` backdates it for values that were cached elsewhere."""
         if ttl is None:
             ttl = self.max_ttl
         ttl = min(ttl, self.max_ttl)
 
-        expire = self.timer() + ttl
-        tup = (expire, value)
+        now = self.timer()
+        expire = now + ttl
+        tup = (expire, value, now - age)
         self.storage.__setitem__(key, tup)
+        self.storage.move_to_end(key)
+        heapq.heappush(self.expiry, (expire, next(self._sequence), key))
 
+        self.sweep(now, limit=self.SWEEP_PER_STORE)
         if len(self.storage) > self.max_size:
             self.expire()
+        if len(self.expiry) > 2 * len(self.storage) + 64:
+            self._compact()
 
     def expire(self):
         over = len(self) - self.max_size
         for _ in range(over):
-            oldest_key = min(self.storage.keys(), key=lambda k: self.storage[k][0])
-            del self[oldest_key]
+            if self.policy == 'lru':
+                self.storage.popitem(last=False)
+            else:
+                self._pop_soonest()
+            self.evictions += 1
+
+    def sweep(self, now: float | None = None, limit: int | None = None) -> int:
+        """Drop entries that have expired, up to `limit` of them."""
+        if now is None:
+            now = self.timer()
+        swept = 0
+        while self.expiry and self.expiry[0][0] < now and (limit is None or swept < limit):
+            if self._pop_soonest(before=now) is not None:
+                swept += 1
+        self.expirations += swept
+        return swept
+
+    def _pop_soonest(self, before: float | None = None) -> T | None:
+        """Drop the entry that expires first, only if that's before `before` when given.
+
+        Heap items left behind by re-stored or already deleted keys are
+        discarded on the way, so the bound is checked against live entries.
+        """
+        while self.expiry:
+            expire, _, key = self.expiry[0]
+            if before is not None and expire >= before:
+                return None
+            heapq.heappop(self.expiry)
+            entry = self.storage.get(key)
+            if entry is not None and entry[0] == expire:
+                del self.storage[key]
+                return key
+        return None
+
+    def _compact(self):
+        self.expiry = [
+            (expire, next(self._sequence), key)
+            for key, (expire, _, _) in self.storage.items()
+        ]
+        heapq.heapify(self.expiry)
+
+
+class PackedRecords:
+    """RRs kept in wire format, parsed back into new RR objects on every read.
+
+    dnslib objects are heavy: a cached CNAME and two A records take about
+    1.5 kB as RRs and 150 bytes packed, or 2 kB and 560 bytes per entry with
+    the key and the cache's bookkeeping (python -m bench.cache_memory).
+    Parsing on every read costs more than copying RRs did, but most hits are
+    served from the packed answer cache without reaching this one.
+    """
+
+    __slots__ = ('data', 'count')
+
+    def __init__(self, rrs: list[RR]):
+        buffer = DNSBuffer()
+        for rr in rrs:
+            rr.pack(buffer)
+        self.data = bytes(buffer.data)
+        self.count = len(rrs)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def digest(self) -> bytes:
+        """Identifies the records regardless of their TTLs, which count down between fetches."""
+        data = bytearray(self.data)
+        for offset in wire.packed_ttl_offsets(self.data, self.count):
+            data[offset:offset + 4] = bytes(4)
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def unpack(self, age: int | float = 0) -> list[RR]:
+        """The RRs, with their TTLs lowered by `age` seconds."""
+        age = int(age)
+        buffer = DNSBuffer(self.data)
+        rrs = []
+        for _ in range(self.count):
+            rr = RR.parse(buffer)
+            rr.ttl = max(rr.ttl - age, 0)
+            rrs.append(rr)
+        return rrs
+
+
+# (Domain, Type, upstream): RRs as the upstream sent them
+CACHED_QUERY: TtlCache[tuple[str, str, str], PackedRecords] = TtlCache(
+    max_size=MAX_CACHE_SIZE, max_ttl=3000, policy=CACHE_POLICY)
+
+
+# (Upstream RRs digest, patch target version, bypass list and Cloudflare ranges load times):
+# (patched RRs or None if patching left them alone, index of the upstream RR each one came from, patched)
+CACHED_PATCHED: TtlCache[
+    tuple[bytes, int, float | None, float | None],
+    tuple[PackedRecords | None, tuple[int | None, ...], bool],
+] = TtlCache(
+    max_size=MAX_CACHE_SIZE, max_ttl=3000, policy=CACHE_POLICY)
+
+
+# (Domain, Type, upstream): (RCODE, authority RRs) of NXDOMAIN/NODATA answers
+CACHED_NEGATIVE: TtlCache[tuple[str, str, str], tuple[int, PackedRecords]] = TtlCache(
+    max_size=MAX_CACHE_SIZE, max_ttl=3000, policy=CACHE_POLICY)
+
+
+def _cache_key(domain: str, type_: str, upstream: str) -> tuple[str, str, str]:
+    # Interned, so the A, AAAA and HTTPS entries of a name share its strings.
+    return (sys.intern(domain), type_, sys.intern(upstream))
+
+
+def make_answer_cache():
+    # Answers outlive their TTL, capped like the record caches', by the serve-stale window.
+    max_ttl = CACHED_QUERY.max_ttl + SERVE_STALE_TTL
+    if not SHARED_CACHE_PATH:
+        return TtlCache(max_size=MAX_CACHE_SIZE, max_ttl=max_ttl, policy=CACHE_POLICY)
+
+    from .shm_cache import SharedTtlCache
+    return SharedTtlCache(
+        SHARED_CACHE_PATH,
+        slots=SHARED_CACHE_SLOTS,
+        slot_size=SHARED_CACHE_SLOT_SIZE,
+        max_ttl=max_ttl,
+        encode=lambda answer: answer.packet,
+        decode=wire.WireAnswer,
+    )
 
 
-# (Domain, Type, upstream): RRs
-CACHED_QUERY: TtlCache[tuple[str, str, str], list] = TtlCache(max_size=MAX_CACHE_SIZE, max_ttl=3000)
+# (Question in wire format, upstream): packed answer
+CACHED_ANSWER: TtlCache[tuple[bytes, str], wire.WireAnswer] = make_answer_cache()
+
+CACHES = {
+    'query': CACHED_QUERY, 'patched': CACHED_PATCHED, 'negative': CACHED_NEGATIVE, 'answer': CACHED_ANSWER,
+}
+
+
+def _cache_counter(attribute: str) -> Callable[[], dict[tuple, float]]:
+    return lambda: {(name,): getattr(cache, attribute) for name, cache in CACHES.items()}
+
+
+for _attribute, _help in (
+        ('hits', 'Cache lookups that found a live entry.'),
+        ('misses', 'Cache lookups that found nothing, or an expired entry.'),
+        ('evictions', 'Entries dropped to make room.'),
+        ('expirations', 'Entries dropped because they expired.')):
+    metrics.register(metrics.Callback(
+        f'cfdoh_cache_{_attribute}_total', _help, 'counter', ('cache',), _cache_counter(_attribute)))
+metrics.register(metrics.Callback(
+    'cfdoh_cache_entries', 'Entries in the cache.', 'gauge', ('cache',),
+    lambda: {(name,): len(cache) for name, cache in CACHES.items()}))
+
+# Lookups that coalesce concurrent callers, by name; app adds its answer refreshes.
+SINGLE_FLIGHTS: dict[str, SingleFlight] = {'upstream': INFLIGHT_QUERIES}
+
+metrics.register(metrics.Callback(
+    'cfdoh_singleflight_originated_total', 'Lookups that started a task of their own.', 'counter', ('flight',),
+    lambda: {(name,): flight.originated for name, flight in SINGLE_FLIGHTS.items()}))
+metrics.register(metrics.Callback(
+    'cfdoh_singleflight_coalesced_total', 'Lookups that joined a task already in flight.', 'counter', ('flight',),
+    lambda: {(name,): flight.coalesced for name, flight in SINGLE_FLIGHTS.items()}))
+metrics.register(metrics.Callback(
+    'cfdoh_singleflight_inflight', 'Tasks in flight.', 'gauge', ('flight',),
+    lambda: {(name,): len(flight) for name, flight in SINGLE_FLIGHTS.items()}))
+
+
+async def run_cache_sweeper(interval: int | float = CACHE_SWEEP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        CACHED_QUERY.sweep()
+        CACHED_PATCHED.sweep()
+        CACHED_NEGATIVE.sweep()
+        CACHED_ANSWER.sweep()
 
 
 def store_cache(domain: str, type_: str, upstream: str, answer: list[RR]):
+    key = _cache_key(domain, type_, upstream)
+    # Expire with the shortest-lived record so no record is served past its TTL.
+    ttl = min((a.ttl for a in answer), default=300)
+
+    CACHED_QUERY.store(key, PackedRecords(answer), ttl=ttl)
+
+
+def get_raw_cache(domain: str, type_: str, upstream: str | None) -> tuple[PackedRecords, float] | None:
+    """The upstream's cached RRs, unpatched, and the seconds they've been cached."""
+    if upstream is None:
+        upstream = DEFAULT_UPSTREAM
+
     key = (domain, type_, upstream)
     try:
-        ttl = next(
-            a.ttl
-            for a in answer
-            if a.rtype in (QTYPE.A, QTYPE.AAAA))
+        return CACHED_QUERY.get_aged(key)
+    except KeyError:
+        return None
+
+
+def get_cache(domain: str, type_: str, upstream: str | None) -> list[RR] | None:
+    """Return copies of the cached RRs with their TTLs decayed by the time spent in cache."""
+    if (cached := get_raw_cache(domain, type_, upstream)) is None:
+        return None
+    answer, age = cached
+    return answer.unpack(age)
+
+
+def patched_cache_key(raw: PackedRecords) -> tuple[bytes, int, float | None, float | None]:
+    """Patching the same upstream RRs gives the same result while the targets and rules stay the same."""
+    return (raw.digest(), PATCH_TARGETS.snapshot.version, BYPASS.loaded_at, cloudflare.CF_RANGES.loaded_at)
+
+
+def get_patched_cache(key: tuple) -> tuple[PackedRecords | None, tuple[int | None, ...], bool] | None:
+    return CACHED_PATCHED.get(key)
+
+
+def store_patched_cache(
+        key: tuple,
+        raw: list[RR],
+        patched: list[RR],
+        was_patched: bool) -> tuple[PackedRecords | None, tuple[int | None, ...], bool]:
+    """Remember what patching made of the upstream RRs `raw`.
+
+    Each patched RR keeps the index of the upstream RR it is (patch_record
+    keeps those objects), so later hits serve that RR's current TTL instead
+    of the one it had when patched. Answers patching left alone are stored
+    as None and served straight from the upstream tier.
+    """
+    if was_patched:
+        positions = {id(rr): i for i, rr in enumerate(raw)}
+        entry = (PackedRecords(patched), tuple(positions.get(id(rr)) for rr in patched), True)
+    else:
+        entry = (None, (), False)
+    # Kept until evicted: a key only stops matching when the targets or rules change.
+    CACHED_PATCHED.store(key, entry)
+    return entry
+
+
+def patched_answer(
+        raw: PackedRecords,
+        entry: tuple[PackedRecords | None, tuple[int | None, ...], bool],
+        age: int | float) -> list[RR]:
+    """The patched RRs for `raw` cached `age` seconds ago, with the TTL policy applied."""
+    patched, sources, was_patched = entry
+    upstream = raw.unpack(age)
+    if patched is None:
+        answer = upstream
+    else:
+        answer = patched.unpack(age)
+        for rr, source in zip(answer, sources):
+            if source is not None:
+                rr.ttl = upstream[source].ttl
+    apply_ttl_policy(answer, was_patched)
+    return answer
+
+
+def store_negative_cache(domain: str, type_: str, upstream: str, rcode: int, auth: list[RR]):
+    """Cache an NXDOMAIN/NODATA answer for as long as its SOA allows (RFC 2308).
+
+    The SOA's TTL is lowered to the negative TTL in place, so whoever serves
+    the answer hands out the same lifetime. Without an SOA nothing is cached.
+    """
+    try:
+        soa = next(rr for rr in auth if rr.rtype == QTYPE.SOA)
     except StopIteration:
-        ttl = 300
+        return
+    soa.ttl = min(soa.ttl, soa.rdata.times[-1])
 
-    CACHED_QUERY.store(key, answer, ttl=ttl)
+    key = _cache_key(domain, type_, upstream)
+    CACHED_NEGATIVE.store(key, (rcode, PackedRecords(auth)), ttl=soa.ttl)
 
 
-def get_cache(domain: str, type_: str, upstream: str | None) -> list[RR] | None:
+def get_negative_cache(domain: str, type_: str, upstream: str | None) -> tuple[int, list[RR]] | None:
     if upstream is None:
         upstream = DEFAULT_UPSTREAM
 
     key = (domain, type_, upstream)
-    return CACHED_QUERY.get(key)
+    try:
+        (rcode, auth), age = CACHED_NEGATIVE.get_aged(key)
+    except KeyError:
+        return None
+    return rcode, auth.unpack(age)
 
 
-def make_answer(record: DNSRecord, answer: list[RR]):
+def _decayed(answer: list[RR], age: int | float) -> list[RR]:
+    age = int(age)
+    return [
+        RR(rname=rr.rname, rtype=rr.rtype, rclass=rr.rclass, ttl=max(rr.ttl - age, 0), rdata=rr.rdata)
+        for rr in answer
+    ]
+
+
+def clamp_ttl(ttl: int, patched: bool = False) -> int:
+    if patched:
+        floor, ceiling = PATCHED_TTL_FLOOR, PATCHED_TTL_CEILING
+    else:
+        floor, ceiling = UNPATCHED_TTL_FLOOR, UNPATCHED_TTL_CEILING
+    if ceiling is not None:
+        ttl = min(ttl, ceiling)
+    return max(ttl, floor)
+
+
+def apply_ttl_policy(answer: list[RR], patched: bool = False):
+    for rr in answer:
+        rr.ttl = clamp_ttl(rr.ttl, patched)
+
+
+def wire_cache_key(query: bytes, upstream: str) -> tuple[bytes, str]:
+    # Fold the name only: label length bytes are < 64, so lower() leaves them alone, but the
+    # type and class that follow are arbitrary (HTTPS is 0x0041, TYPE97 0x0061).
+    question = wire.question(query)
+    return (question[:-4].lower() + question[-4:], upstream)
+
+
+def store_wire_cache(query: bytes, upstream: str, packet: bytes) -> wire.WireAnswer | None:
+    answer = wire.WireAnswer(packet)
+    if answer.min_ttl is None:
+        return None
+    CACHED_ANSWER.store(wire_cache_key(query, upstream), answer, ttl=fresh_ttl(answer) + SERVE_STALE_TTL)
+    return answer
+
+
+def get_wire_answer(query: bytes, upstream: str) -> tuple[wire.WireAnswer, float] | None:
+    """The cached answer for `query` and its age, which may be past its TTL (stale)."""
+    try:
+        answer, age = CACHED_ANSWER.get_aged(wire_cache_key(query, upstream))
+    except KeyError:
+        return None
+    answer.hits += 1
+    return answer, age
+
+
+def get_wire_cache(query: bytes, upstream: str) -> bytes | None:
+    """Replay a fresh cached packed answer for `query`, with its TTLs decayed."""
+    cached = get_wire_answer(query, upstream)
+    if cached is None or is_stale(*cached):
+        return None
+    answer, age = cached
+    return answer.render(query, age)
+
+
+def fresh_ttl(answer: wire.WireAnswer) -> int | float:
+    """How long a packed answer is replayed before it's refreshed.
+
+    Capped like the record caches, so new patch targets and reloaded bypass
+    lists or Cloudflare ranges reach long-TTL answers too.
+    """
+    return min(answer.min_ttl, CACHED_QUERY.max_ttl)
+
+
+def is_stale(answer: wire.WireAnswer, age: float) -> bool:
+    return age >= fresh_ttl(answer)
+
+
+def should_prefetch(answer: wire.WireAnswer, age: float) -> bool:
+    """Whether a hot answer is close enough to expiry to refresh it ahead of time."""
+    ttl = fresh_ttl(answer)
+    return answer.hits >= PREFETCH_MIN_HITS and ttl - age <= ttl * PREFETCH_THRESHOLD
+
+
+def make_answer(record: DNSRecord, answer: list[RR], rcode: int | None = None, auth: list[RR] = ()):
     response = record.reply()
+    if rcode is not None:
+        response.header.rcode = rcode
     for rr in answer:
         response.add_answer(rr)
+    for rr in auth:
+        response.add_auth(rr)
 
     return response
 
 
 def should_bypass(record: DNSRecord):
+    matcher = BYPASS.value
     query_domain = record.q.qname.idna().rstrip('.')
-    if any(
-            query_domain.endswith(bypass) if bypass[0] == '.' else query_domain == bypass
-            for bypass in BYPASS_LIST):
+    if query_domain in matcher:
         return True
 
     for rr in record.rr:
         if rr.rtype in (QTYPE.CNAME, QTYPE.NS):
             domain = str(rr.rdata).rstrip('.')
-            if any(
-                    domain.endswith(bypass) if bypass[0] == '.' else domain == bypass
-                    for bypass in BYPASS_LIST):
+            if domain in matcher:
                 return True
 
     return False
 
 
-async def _get_icn_ips() -> tuple[list[str], list[str]]:
-    a_records = await fetch_dns('namu.wiki', 'A', DEFAULT_UPSTREAM)
-    ipv4s = [str(rr.rdata) for rr in a_records if rr.rtype == QTYPE.A]
-    aaaa_records = await fetch_dns('namu.wiki', 'AAAA', DEFAULT_UPSTREAM)
-    ipv6s = [str(rr.rdata) for rr in aaaa_records if rr.rtype == QTYPE.AAAA]
-    return ipv4s, ipv6s
-
-
 def _has_cf_in_https(record: DNSRecord) -> bool:
+    index = cloudflare.CF_RANGES.value
     for rr in record.rr:
         if rr.rtype in (QTYPE.HTTPS, QTYPE.SVCB) and isinstance(rr.rdata, HTTPS):
             for key_id, value in rr.rdata.params:
                 if key_id == _SVCB_KEY_IPV4HINT:
-                    if any(is_cloudflare_sync(ip) for ip in _unpack_ipv4s(value)):
+                    if len(value) % 4 == 0 and any(
+                            index.contains_v4(ip) for (ip,) in struct.iter_unpack('!I', value)):
                         return True
                 elif key_id == _SVCB_KEY_IPV6HINT:
-                    if any(is_cloudflare_sync(ip) for ip in _unpack_ipv6s(value)):
+                    if len(value) % 16 == 0 and any(
+                            index.contains_v6(int.from_bytes(value[i:i + 16], 'big'))
+                            for i in range(0, len(value), 16)):
                         return True
     return False
 
@@ -181,7 +626,7 @@ def _has_cf_in_https(record: DNSRecord) -> bool:
 async def _has_cf_in_a_aaaa(record: DNSRecord) -> bool:
     try:
         first_ip = next(
-            str(rr.rdata)
+            bytes(rr.rdata.data)
             for rr in record.rr
             if rr.rtype in (QTYPE.A, QTYPE.AAAA)
         )
@@ -190,40 +635,62 @@ async def _has_cf_in_a_aaaa(record: DNSRecord) -> bool:
     return await is_cloudflare(first_ip)
 
 
-def is_cloudflare_sync(ip: str) -> bool:
-    address = ip_address(ip)
-    return any(address in network for network in CF_NETWORKS)
+def is_cloudflare_sync(ip: str | bytes) -> bool:
+    return ip in cloudflare.CF_RANGES.value
 
 
 async def patch_response(record: DNSRecord):
+    await patch_record(record)
+    return record
+
+
+async def patch_record(record: DNSRecord) -> bool:
+    """Patch Cloudflare addresses in `record` in place; return whether anything was patched."""
     query_domain = record.q.qname.idna().rstrip('.')
-    type_ = QTYPE[record.q.qtype]
 
-    if should_bypass(record):
-        return record
+    with tracing.stage('should_bypass'):
+        bypass = should_bypass(record)
+    if bypass:
+        metrics.PATCH_DECISIONS.inc('bypassed')
+        return False
 
-    cf_in_a_aaaa = await _has_cf_in_a_aaaa(record)
-    cf_in_https = _has_cf_in_https(record)
+    with tracing.stage('cloudflare_check'):
+        cf_in_a_aaaa = await _has_cf_in_a_aaaa(record)
+        cf_in_https = _has_cf_in_https(record)
 
     if not cf_in_a_aaaa and not cf_in_https:
-        return record
+        metrics.PATCH_DECISIONS.inc('untouched')
+        return False
 
-    icn_ipv4s, icn_ipv6s = await _get_icn_ips()
+    # Used to be a namu.wiki lookup per patched answer; now a snapshot kept fresh in the background.
+    target = PATCH_TARGETS.snapshot
+    icn_ipv4s, icn_ipv6s = target.ipv4s, target.ipv6s
 
+    # Without a target for an address family, records and hints of that family are left alone.
+    patched = False
     if cf_in_a_aaaa:
-        that_response = await fetch_dns('namu.wiki', type_, DEFAULT_UPSTREAM)
-        non_a_aaaa = [rr for rr in record.rr if rr.rtype not in (QTYPE.A, QTYPE.AAAA)]
-        record.rr = non_a_aaaa
-        for answer in that_response:
-            rr = RR(
-                rname=query_domain,
-                rtype=answer.rtype,
-                rdata=answer.rdata,
-                ttl=max(answer.ttl, 600),
-            )
-            record.add_answer(rr)
+        replacements = {QTYPE.A: [A(ip) for ip in icn_ipv4s], QTYPE.AAAA: [AAAA(ip) for ip in icn_ipv6s]}
+        replaced = [
+            rtype
+            for rtype in (QTYPE.A, QTYPE.AAAA)
+            if replacements[rtype] and any(rr.rtype == rtype for rr in record.rr)
+        ]
+        if replaced:
+            record.rr = [rr for rr in record.rr if rr.rtype not in replaced]
+            for rtype in replaced:
+                for rdata in replacements[rtype]:
+                    rr = RR(
+                        rname=query_domain,
+                        rtype=rtype,
+                        rdata=rdata,
+                        ttl=clamp_ttl(target.ttl, patched=True),
+                    )
+                    record.add_answer(rr)
+            metrics.PATCH_DECISIONS.inc('a_aaaa')
+            patched = True
 
     if cf_in_https:
+        rewritten = False
         for rr in record.rr:
             if rr.rtype in (QTYPE.HTTPS, QTYPE.SVCB) and isinstance(rr.rdata, HTTPS):
                 new_params = []
@@ -234,35 +701,75 @@ async def patch_response(record: DNSRecord):
                         new_params.append((key_id, _pack_ipv6s(icn_ipv6s)))
                     else:
                         new_params.append((key_id, value))
-                rr.rdata.params = new_params
+                if new_params != list(rr.rdata.params):
+                    # Replace rather than mutate: the rdata may be shared with cached RRs.
+                    rr.rdata = HTTPS(rr.rdata.priority, rr.rdata.target, new_params)
+                    rewritten = True
+        if rewritten:
+            metrics.PATCH_DECISIONS.inc('https')
+            patched = True
 
-    return record
+    if not patched:
+        metrics.PATCH_DECISIONS.inc('untouched')
+    return patched
 
 
 async def fetch_dns(domain: str, type_: str, upstream: str | None = None) -> list[RR]:
     if upstream is None:
         upstream = DEFAULT_UPSTREAM
 
+    if get_negative_cache(domain, type_, upstream) is not None:
+        return []
+
     if answer := get_cache(domain, type_, upstream):
         return answer
 
-    request = DNSRecord.question(domain, type_)
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            upstream,
-            headers={
-                'Content-Type': 'application/dns-message',
-            },
-            data=bytes(request.pack()),
-            timeout=30,
-        )
-        res = res.content
+    response = await fetch_record(domain, type_, upstream)
+    return response.rr
 
-    answer = DNSRecord.parse(res)
-    store_cache(domain, type_, upstream, answer.rr)
-    return answer.rr
+
+async def fetch_record(domain: str, type_: str, upstream: str | None = None) -> DNSRecord:
+    """Query the upstream, bypassing the caches, and return its whole response.
+
+    Concurrent lookups of the same question share one upstream query.
+    """
+    if upstream is None:
+        upstream = DEFAULT_UPSTREAM
+
+    key = (domain, type_, upstream)
+    response = await INFLIGHT_QUERIES.do(key, partial(_fetch_upstream, domain, type_, upstream))
+    # Every caller gets its own copies of the shared response, to patch as it likes.
+    return DNSRecord(
+        header=response.header,
+        q=response.q,
+        rr=_decayed(response.rr, 0),
+        auth=_decayed(response.auth, 0),
+    )
+
+
+async def _fetch_upstream(domain: str, type_: str, upstream: str) -> DNSRecord:
+    request = bytes(DNSRecord.question(domain, type_).pack())
+    answer = await UPSTREAMS.query(upstream, partial(_post, request))
+    if answer.rr:
+        store_cache(domain, type_, upstream, answer.rr)
+    elif answer.header.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+        store_negative_cache(domain, type_, upstream, answer.header.rcode, answer.auth)
+    return answer
+
+
+async def _post(request: bytes, upstream: str) -> DNSRecord:
+    client = UPSTREAM_CLIENTS.get(upstream)
+    res = await client.post(
+        upstream,
+        headers={
+            'Content-Type': 'application/dns-message',
+        },
+        content=request,
+        timeout=UPSTREAMS.timeout_for(upstream),
+    )
+    # Parsing here makes a garbled answer a failure of this upstream, open to hedging.
+    return DNSRecord.parse(res.content)
 
 
-async def is_cloudflare(ip: str) -> bool:
-    address = ip_address(ip)
-    return any(address in network for network in CF_NETWORKS)
+async def is_cloudflare(ip: str | bytes) -> bool:
+    return ip in cloudflare.CF_RANGES.value
@@ -0,0 +1,134 @@
+"""Prometheus metrics in the text exposition format, without a client library.
+
+Recording is a dict lookup and an integer add: everything runs on the event
+loop thread, so there are no locks, and histogram buckets are allocated once
+per label set. Values that already live elsewhere (cache counters, sizes)
+are read through callbacks at scrape time instead of being recorded twice.
+"""
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+
+    __slots__ = ('name', 'help', 'labelnames', 'values')
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple, float] = dict()
+
+    def inc(self, *labels, amount: int | float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in self.values.items():
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+
+    __slots__ = ('name', 'help', 'labelnames', 'buckets', 'counts', 'sums')
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: observations per bucket, the last one being +Inf.
+        self.counts: dict[tuple, list[int]] = dict()
+        self.sums: dict[tuple, float] = dict()
+
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {self.sums[labels]}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {total}'
+
+
+class Callback:
+    """A metric whose values are read when scraped: `callback` returns {label values: value}."""
+
+    __slots__ = ('name', 'help', 'type', 'labelnames', 'callback')
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            type_: str,
+            labelnames: Iterable[str],
+            callback: Callable[[], dict[tuple, float]]):
+        self.name = name
+        self.help = help
+        self.type = type_
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, value in self.callback().items():
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+REGISTRY: list[Counter | Histogram | Callback] = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+QUERY_LATENCY = register(Histogram(
+    'cfdoh_query_duration_seconds', 'Time to answer a DNS query, end to end.', ('transport',)))
+UPSTREAM_LATENCY = register(Histogram(
+    'cfdoh_upstream_duration_seconds', 'Time for an upstream to answer a query.', ('upstream',)))
+UPSTREAM_ERRORS = register(Counter(
+    'cfdoh_upstream_errors_total', 'Upstream queries that failed.', ('upstream',)))
+PATCH_DECISIONS = register(Counter(
+    'cfdoh_patch_decisions_total', 'What patching did to answers with records.', ('decision',)))
+STALE_ANSWERS = register(Counter(
+    'cfdoh_stale_answers_total', 'Expired answers served because the upstream could not refresh them.'))
+PREFETCHES = register(Counter(
+    'cfdoh_prefetches_total', 'Hot answers refreshed ahead of expiry.'))
+
+
+def upstream_label(upstream: str, known: Iterable[str]) -> str:
+    """Label custom upstreams as one series, so clients can't add series at will."""
+    return upstream if upstream in known else 'custom'
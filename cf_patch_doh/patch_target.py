@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from dnslib import DNSRecord, QTYPE
+
+
+# Hostname whose addresses are known to be served from the ICN region.
+PATCH_TARGET_HOST = os.environ.get('PATCH_TARGET_HOST', 'namu.wiki')
+PATCH_TARGET_REFRESH_INTERVAL = float(os.environ.get('PATCH_TARGET_REFRESH_INTERVAL', '300'))
+# The health check fails once the last good refresh is older than this.
+PATCH_TARGET_MAX_AGE = float(os.environ.get('PATCH_TARGET_MAX_AGE', '3600'))
+
+logger = logging.getLogger(__name__)
+
+
+class PatchTarget:
+    """Immutable snapshot of the addresses Cloudflare answers are patched to."""
+
+    __slots__ = ('ipv4s', 'ipv6s', 'ttl', 'version', 'refreshed_at')
+
+    def __init__(
+            self,
+            ipv4s: tuple[str, ...] = (),
+            ipv6s: tuple[str, ...] = (),
+            ttl: int = 0,
+            version: int = 0,
+            refreshed_at: float | None = None):
+        self.ipv4s = tuple(ipv4s)
+        self.ipv6s = tuple(ipv6s)
+        self.ttl = ttl
+        self.version = version
+        self.refreshed_at = refreshed_at
+
+    def __bool__(self) -> bool:
+        return bool(self.ipv4s or self.ipv6s)
+
+
+class PatchTargets:
+    """Keeps the patch target addresses fresh in the background.
+
+    Readers only ever look at `snapshot`, which is replaced as a whole, so the
+    request path never waits on an upstream. A failed or empty refresh keeps
+    the last known good snapshot.
+    """
+
+    def __init__(
+            self,
+            resolve: Callable[[str, str], Awaitable[DNSRecord]],
+            hostname: str = PATCH_TARGET_HOST,
+            interval: int | float = PATCH_TARGET_REFRESH_INTERVAL,
+            max_age: int | float = PATCH_TARGET_MAX_AGE,
+            timer: Callable = time.monotonic):
+        self.resolve = resolve
+        self.hostname = hostname
+        self.interval = interval
+        self.max_age = max_age
+        self.timer = timer
+        self.snapshot = PatchTarget()
+        self.last_error: str | None = None
+
+    async def refresh(self) -> bool:
+        try:
+            a, aaaa = await asyncio.gather(
+                self.resolve(self.hostname, 'A'),
+                self.resolve(self.hostname, 'AAAA'),
+            )
+        except Exception as e:
+            self.last_error = f'{type(e).__name__}: {e}'
+            logger.warning('Refreshing patch target %s failed: %s', self.hostname, self.last_error)
+            return False
+
+        ipv4s = tuple(str(rr.rdata) for rr in a.rr if rr.rtype == QTYPE.A)
+        ipv6s = tuple(str(rr.rdata) for rr in aaaa.rr if rr.rtype == QTYPE.AAAA)
+        if not ipv4s and not ipv6s:
+            self.last_error = f'{self.hostname} has no addresses'
+            logger.warning('Refreshing patch target failed: %s', self.last_error)
+            return False
+
+        ttl = min(
+            (rr.ttl for rr in a.rr + aaaa.rr if rr.rtype in (QTYPE.A, QTYPE.AAAA)),
+            default=0)
+        version = self.snapshot.version
+        # Upstreams rotate the order of their answers; only a different set is a new target.
+        if (set(ipv4s), set(ipv6s)) != (set(self.snapshot.ipv4s), set(self.snapshot.ipv6s)):
+            version += 1
+        self.snapshot = PatchTarget(ipv4s, ipv6s, ttl, version, self.timer())
+        self.last_error = None
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    def health(self) -> tuple[bool, str]:
+        snapshot = self.snapshot
+        if not snapshot:
+            return False, f'No addresses for {self.hostname} yet: {self.last_error}'
+        age = self.timer() - snapshot.refreshed_at
+        if age > self.max_age:
+            return False, f'Addresses for {self.hostname} are {age:.0f}s old: {self.last_error}'
+        return True, 'OK'
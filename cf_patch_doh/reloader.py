@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Callable, Generic, Iterable, TypeVar
+
+# How often watched files are checked for a new mtime.
+RELOAD_INTERVAL = float(os.environ.get('RELOAD_INTERVAL', '30'))
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+class Reloadable(Generic[T]):
+    """A value compiled from files, rebuilt off the request path when they change.
+
+    `build` gets the watched paths that currently exist and runs in a worker
+    thread. The result replaces `value` in a single assignment, so readers
+    see either the old or the new value, never a half-built one. If `build`
+    fails, the previous value stays.
+    """
+
+    def __init__(self, name: str, paths: Iterable[str | None], build: Callable[[list[str]], T], default: T):
+        self.name = name
+        self.paths = [path for path in paths if path]
+        self.build = build
+        self.value = default
+        self.mtimes: dict[str, float | None] = dict()
+        self.loaded_at: float | None = None
+        self.reload_seconds: float | None = None
+        self.last_error: str | None = None
+
+    def _stat(self) -> dict[str, float | None]:
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def changed(self) -> bool:
+        return self._stat() != self.mtimes
+
+    async def reload(self, force: bool = False) -> bool:
+        mtimes = self._stat()
+        if not force and mtimes == self.mtimes:
+            return False
+
+        existing = [path for path, mtime in mtimes.items() if mtime is not None]
+        started = time.perf_counter()
+        try:
+            value = await asyncio.to_thread(self.build, existing)
+        except Exception as e:
+            self.last_error = f'{type(e).__name__}: {e}'
+            logger.warning('Reloading %s from %s failed: %s', self.name, existing, self.last_error)
+            return False
+
+        self.value = value
+        self.mtimes = mtimes
+        self.reload_seconds = time.perf_counter() - started
+        self.loaded_at = time.time()
+        self.last_error = None
+        logger.info('Reloaded %s from %s in %.3fs', self.name, existing or 'defaults', self.reload_seconds)
+        return True
+
+    def status(self) -> dict:
+        return {
+            'paths': self.paths,
+            'loaded_at': self.loaded_at,
+            'reload_seconds': self.reload_seconds,
+            'last_error': self.last_error,
+        }
+
+
+class Reloader:
+    """Reload a set of `Reloadable`s on file changes and on SIGHUP."""
+
+    def __init__(self, reloadables: Iterable[Reloadable], interval: int | float = RELOAD_INTERVAL):
+        self.reloadables = list(reloadables)
+        self.interval = interval
+
+    async def reload_all(self, force: bool = False):
+        for reloadable in self.reloadables:
+            await reloadable.reload(force=force)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.reload_all()
+
+    def install_signal_handler(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload_all(force=True)))
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # No SIGHUP on this platform, or not running in the main thread.
+            return False
+        return True
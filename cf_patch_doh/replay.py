@@ -0,0 +1,287 @@
+"""Replay a recorded query log through get_record against the stub upstream.
+
+For sizing from real traffic: prints, per window of log time, the record
+cache hit ratio, the queries that reached the upstream, the peak number of
+upstream queries in flight and the size of the record caches (upstream
+answers, patched answers and negative answers), so MAX_CACHE_SIZE and the
+TTL cap can be tuned from evidence.
+
+The log has one query per line, either as JSON:
+
+    {"timestamp": 1700000000.25, "name": "example.com", "type": "A", "upstream": "https://..."}
+
+or as whitespace- or comma-separated `timestamp name [type [upstream]]`;
+type defaults to A and upstream to the default one. Caches follow the log's
+clock, so expiry happens as it would have, whether the log is replayed in
+real time (`--speed 1`), faster (`--speed 10`) or as fast as possible (the
+default).
+
+    cf-patch-doh-replay queries.log --max-cache-size 50000 --max-ttl 3600
+"""
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import time
+import types
+from contextlib import ExitStack
+from typing import Callable, Iterable, Iterator, TextIO
+from unittest.mock import patch
+
+from dnslib import DNSRecord
+
+from . import dns_utils
+from .app import get_record
+from .stub_upstream import installed, StubUpstream
+
+
+class LogEntry:
+
+    __slots__ = ('timestamp', 'name', 'type', 'upstream')
+
+    def __init__(self, timestamp: float, name: str, type_: str = 'A', upstream: str | None = None):
+        self.timestamp = timestamp
+        self.name = name
+        self.type = type_
+        self.upstream = upstream or dns_utils.DEFAULT_UPSTREAM
+
+
+def read_log(lines: Iterable[str]) -> Iterator[LogEntry]:
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            entry = json.loads(line)
+            yield LogEntry(
+                float(entry['timestamp']), entry['name'], entry.get('type', 'A'), entry.get('upstream'))
+        else:
+            timestamp, name, *rest = line.replace(',', ' ').split()
+            yield LogEntry(float(timestamp), name, *rest[:2])
+
+
+def deep_sizeof(obj) -> int:
+    """Bytes held by `obj` and everything it references, shared objects counted once."""
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def record_caches() -> tuple[dns_utils.TtlCache, ...]:
+    """The caches get_record goes through: upstream answers, patched answers and negative answers."""
+    return (dns_utils.CACHED_QUERY, dns_utils.CACHED_PATCHED, dns_utils.CACHED_NEGATIVE)
+
+
+class LogClock:
+    """What the caches take as the current time: the timestamp of the query being replayed."""
+
+    __slots__ = ('now',)
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Replay:
+
+    def __init__(
+            self,
+            stub: StubUpstream,
+            speed: float | None = None,
+            concurrency: int = 100,
+            window: float = 60,
+            measure_memory: bool = True,
+            report: Callable[[dict], None] = lambda row: None):
+        self.stub = stub
+        self.speed = speed
+        self.concurrency = concurrency
+        self.window = window
+        self.measure_memory = measure_memory
+        self.report = report
+        self.clock = LogClock()
+        self.rows: list[dict] = []
+        self.queries = 0
+        self.hits = 0
+        self.failed = 0
+        self.skipped = 0
+        self.peak_in_flight = 0
+        self._window_start = 0.0
+        self._window_queries = 0
+        # Counters as of the start of the current window; _evictions as of the start of the replay.
+        self._hits = 0
+        self._upstream_queries = 0
+        self._evictions = (0, 0)
+
+    def _lookups(self) -> int:
+        return dns_utils.CACHED_QUERY.hits + dns_utils.CACHED_NEGATIVE.hits
+
+    async def _query(self, entry: LogEntry, semaphore: asyncio.Semaphore | None):
+        try:
+            try:
+                query = bytes(DNSRecord.question(entry.name, entry.type).pack())
+            except Exception:
+                self.skipped += 1
+                return
+            await get_record(query, entry.upstream)
+        except Exception:
+            self.failed += 1
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def _close_window(self, start: float):
+        hits = self._lookups() - self._hits
+        row = {
+            'offset': round(self._window_start - start, 3),
+            'queries': self._window_queries,
+            'hit_ratio': round(hits / self._window_queries, 4) if self._window_queries else 0.0,
+            'upstream_queries': self.stub.queries - self._upstream_queries,
+            'peak_in_flight': self.stub.peak_in_flight,
+            'cache_entries': len(dns_utils.CACHED_QUERY),
+            'patched_entries': len(dns_utils.CACHED_PATCHED),
+        }
+        if self.measure_memory:
+            row['cache_bytes'] = deep_sizeof([cache.storage for cache in record_caches()])
+        self.peak_in_flight = max(self.peak_in_flight, self.stub.peak_in_flight)
+        self.stub.peak_in_flight = self.stub.in_flight
+        self._hits += hits
+        self.hits += hits
+        self._upstream_queries = self.stub.queries
+        self._window_queries = 0
+        self.rows.append(row)
+        self.report(row)
+
+    async def run(self, entries: Iterable[LogEntry]) -> dict:
+        tasks: set[asyncio.Task] = set()
+        semaphore = asyncio.Semaphore(self.concurrency) if self.speed is None else None
+        start = wall_start = None
+        with ExitStack() as stack:
+            stack.enter_context(installed(self.stub))
+            for cache in record_caches():
+                stack.enter_context(patch.object(cache, 'timer', self.clock))
+            self._hits = self._lookups()
+            self._evictions = (dns_utils.CACHED_QUERY.evictions, dns_utils.CACHED_QUERY.expirations)
+
+            for entry in entries:
+                if start is None:
+                    start = self._window_start = entry.timestamp
+                    wall_start = time.monotonic()
+                while entry.timestamp >= self._window_start + self.window:
+                    self._close_window(start)
+                    self._window_start += self.window
+                if self.speed is not None:
+                    delay = wall_start + (entry.timestamp - start) / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    await semaphore.acquire()
+                # Log clocks can step back a little; the caches' clock can't.
+                self.clock.now = max(self.clock.now, entry.timestamp)
+                self.queries += 1
+                self._window_queries += 1
+                task = asyncio.create_task(self._query(entry, semaphore))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.wait(tasks)
+            if start is not None:
+                self._close_window(start)
+        return self.summary()
+
+    def summary(self) -> dict:
+        summary = {
+            'queries': self.queries,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'hit_ratio': round(self.hits / self.queries, 4) if self.queries else 0.0,
+            'upstream_queries': self.stub.queries,
+            'peak_in_flight': self.peak_in_flight,
+            'cache_entries': len(dns_utils.CACHED_QUERY),
+            'patched_entries': len(dns_utils.CACHED_PATCHED),
+            'evictions': dns_utils.CACHED_QUERY.evictions - self._evictions[0],
+            'expirations': dns_utils.CACHED_QUERY.expirations - self._evictions[1],
+        }
+        if self.rows and 'cache_bytes' in self.rows[-1]:
+            summary['cache_bytes'] = max(row['cache_bytes'] for row in self.rows)
+            peak_entries = max(row['cache_entries'] + row['patched_entries'] for row in self.rows)
+            summary['bytes_per_entry'] = round(summary['cache_bytes'] / peak_entries) if peak_entries else 0
+        return summary
+
+
+def _print_row(out: TextIO) -> Callable[[dict], None]:
+    print(
+        f'{"offset":>10} {"queries":>8} {"hit":>7} {"upstream":>8} {"inflight":>8} {"entries":>8} {"patched":>8}'
+        f' {"bytes":>12}',
+        file=out)
+
+    def report(row: dict):
+        print(
+            f'{row["offset"]:10.0f} {row["queries"]:8} {row["hit_ratio"]:7.1%} {row["upstream_queries"]:8}'
+            f' {row["peak_in_flight"]:8} {row["cache_entries"]:8} {row["patched_entries"]:8}'
+            f' {row.get("cache_bytes", ""):>12}',
+            file=out)
+    return report
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='cf-patch-doh-replay', description=__doc__.splitlines()[0],
+        epilog='Cache sizes default to MAX_CACHE_SIZE and the built-in TTL cap.')
+    parser.add_argument('log', help="query log, '-' for stdin")
+    parser.add_argument(
+        '--speed', type=float, help='replay at this multiple of real time (default: as fast as possible)')
+    parser.add_argument(
+        '--concurrency', type=int, default=100, help='queries in flight when not replaying in real time')
+    parser.add_argument('--window', type=float, default=60, help='seconds of log time per report line')
+    parser.add_argument('--max-cache-size', type=int, help='entries in the record caches')
+    parser.add_argument('--max-ttl', type=float, help='longest time a record is cached, in seconds')
+    parser.add_argument('--latency', type=float, default=0.02, help='stub upstream latency in seconds')
+    parser.add_argument('--ttl', type=int, default=300, help='TTL of the stub upstream answers')
+    parser.add_argument('--cloudflare-ratio', type=float, default=0.5, help='share of names behind Cloudflare')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure the cache size in bytes")
+    parser.add_argument('--json', action='store_true', help='print report lines and the summary as JSON')
+    args = parser.parse_args(argv)
+
+    for cache in record_caches():
+        if args.max_cache_size is not None:
+            cache.max_size = args.max_cache_size
+        if args.max_ttl is not None:
+            cache.max_ttl = args.max_ttl
+
+    if args.json:
+        def report(row):
+            print(json.dumps(row))
+    else:
+        report = _print_row(sys.stdout)
+    replay = Replay(
+        StubUpstream(latency=args.latency, cloudflare_ratio=args.cloudflare_ratio, ttl=args.ttl),
+        speed=args.speed,
+        concurrency=args.concurrency,
+        window=args.window,
+        measure_memory=not args.no_memory,
+        report=report)
+
+    with (sys.stdin if args.log == '-' else open(args.log)) as f:
+        summary = asyncio.run(replay.run(read_log(f)))
+    if args.json:
+        print(json.dumps({'summary': summary}))
+    else:
+        print()
+        for key, value in summary.items():
+            print(f'{key:>16}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""A TTL cache in a shared memory-mapped file, so every worker process shares one hit rate.
+
+The file is a fixed-size, set-associative hash table: a key's digest picks
+a group of `WAYS` slots, and a store replaces the matching slot, an expired
+one, or the one closest to expiry. Each slot is guarded by a sequence
+number (a seqlock): writers make it odd while they write and even again
+afterwards, readers retry if it was odd or changed under them. Reads take
+no lock; writers serialize on an fcntl lock over the slot group.
+
+Each slot also counts its hits across processes, outside the seqlock: a
+lost or misplaced increment only nudges the prefetch heuristic.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar('T')
+V = TypeVar('V')
+
+_MAGIC = b'CFDOHSC2'
+# magic, slot count, slot size
+_HEADER = struct.Struct('=8sII')
+# sequence, key digest, expire, stored, data length, hits
+_SLOT = struct.Struct('=I16sddII')
+_SEQUENCE = struct.Struct('=I')
+_HITS = struct.Struct('=I')
+_HITS_OFFSET = _SLOT.size - _HITS.size
+
+HEADER_SIZE = 64
+
+
+class SharedTtlCache(Generic[T, V]):
+    """Drop-in for the parts of `TtlCache` the answer cache uses, shared between processes.
+
+    Values go through `encode`/`decode` to and from bytes; those that
+    encode to more than a slot holds aren't cached. Decoded values with a
+    `hits` attribute get the hits of their entry before this one, counted
+    by every process, since a fresh object can't remember them. Keys are hashed from
+    their repr, so they must repr the same in every process (bytes, str
+    and tuples of them do).
+    """
+
+    WAYS = 4
+    READ_RETRIES = 4
+
+    def __init__(
+            self,
+            path: str,
+            slots: int = 16384,
+            slot_size: int = 1024,
+            max_ttl: int | float = 600,
+            encode: Callable[[V], bytes] = bytes,
+            decode: Callable[[bytes], V] = bytes,
+            timer: Callable = time.monotonic):
+        if slots % self.WAYS:
+            raise ValueError(f'Slot count must be a multiple of {self.WAYS}')
+        if slot_size <= _SLOT.size:
+            raise ValueError(f'Slots must be larger than {_SLOT.size} bytes')
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.capacity = slot_size - _SLOT.size
+        self.groups = slots // self.WAYS
+        self.max_ttl = max_ttl
+        self.encode = encode
+        self.decode = decode
+        # CLOCK_MONOTONIC is system-wide, so expiry times compare across processes.
+        self.timer = timer
+        # Counted by this process only.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        size = HEADER_SIZE + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, _HEADER.size, 0)
+            if len(header) < _HEADER.size or _HEADER.unpack(header) != (_MAGIC, slots, slot_size):
+                # New file, or one laid out differently: start over.
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, _HEADER.pack(_MAGIC, slots, slot_size), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, size)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def __len__(self) -> int:
+        now = self.timer()
+        count = 0
+        for index in range(self.slots):
+            slot = self._read(index)
+            if slot is not None and slot[1] >= now:
+                count += 1
+        return count
+
+    def _digest(self, key: T) -> bytes:
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * self.slot_size
+
+    def _group(self, digest: bytes) -> range:
+        first = int.from_bytes(digest[:8], 'little') % self.groups * self.WAYS
+        return range(first, first + self.WAYS)
+
+    def _read(self, index: int) -> tuple[bytes, float, float, bytes] | None:
+        """(digest, expire, stored, data) of a slot, None if it's empty or kept changing."""
+        offset = self._offset(index)
+        for _ in range(self.READ_RETRIES):
+            sequence, digest, expire, stored, length, _ = _SLOT.unpack_from(self.mm, offset)
+            if sequence & 1:
+                continue
+            if sequence == 0 or length > self.capacity:
+                return None
+            start = offset + _SLOT.size
+            data = self.mm[start:start + length]
+            if _SEQUENCE.unpack_from(self.mm, offset)[0] == sequence:
+                return digest, expire, stored, data
+        return None
+
+    def get_aged(self, key: T) -> tuple[V, float]:
+        """Return the value along with the seconds since it was stored."""
+        digest = self._digest(key)
+        now = self.timer()
+        for index in self._group(digest):
+            slot = self._read(index)
+            if slot is not None and slot[0] == digest:
+                _, expire, stored, data = slot
+                if expire < now:
+                    self.expirations += 1
+                    break
+                self.hits += 1
+                value = self.decode(data)
+                hits = self._hit(index)
+                if hasattr(value, 'hits'):
+                    value.hits = hits
+                return value, now - stored
+        self.misses += 1
+        raise KeyError(key)
+
+    def _hit(self, index: int) -> int:
+        """Count a hit on a slot; return the hits before it."""
+        offset = self._offset(index) + _HITS_OFFSET
+        hits = _HITS.unpack_from(self.mm, offset)[0]
+        _HITS.pack_into(self.mm, offset, min(hits + 1, 0xffffffff))
+        return hits
+
+    def get(self, key: T, default=None) -> V | None:
+        try:
+            return self.get_aged(key)[0]
+        except KeyError:
+            return default
+
+    def store(self, key: T, value: V, ttl: int | float | None = None):
+        data = self.encode(value)
+        if len(data) > self.capacity:
+            return
+        if ttl is None:
+            ttl = self.max_ttl
+        ttl = min(ttl, self.max_ttl)
+
+        digest = self._digest(key)
+        group = self._group(digest)
+        start = self._offset(group.start)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.WAYS * self.slot_size, start, os.SEEK_SET)
+        try:
+            now = self.timer()
+            victim, victim_expire = None, None
+            for index in group:
+                slot = self._read(index)
+                if slot is None or slot[0] == digest:
+                    victim = index
+                    break
+                if victim is None or slot[1] < victim_expire:
+                    victim, victim_expire = index, slot[1]
+            else:
+                if victim_expire >= now:
+                    self.evictions += 1
+            self._write(victim, digest, now + ttl, now, data)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.WAYS * self.slot_size, start, os.SEEK_SET)
+
+    def _write(self, index: int, digest: bytes, expire: float, stored: float, data: bytes):
+        offset = self._offset(index)
+        sequence = _SEQUENCE.unpack_from(self.mm, offset)[0]
+        # Odd while the slot is half written; readers retry or treat it as a miss.
+        _SEQUENCE.pack_into(self.mm, offset, sequence + 1)
+        self.mm[offset + _SLOT.size:offset + _SLOT.size + len(data)] = data
+        _SLOT.pack_into(self.mm, offset, sequence + 1, digest, expire, stored, len(data), 0)
+        _SEQUENCE.pack_into(self.mm, offset, sequence + 2)
+
+    def sweep(self, now: float | None = None, limit: int | None = None) -> int:
+        # Expired slots are reused in place by later stores; nothing to free.
+        return 0
+
+    def clear(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slots * self.slot_size, HEADER_SIZE, os.SEEK_SET)
+        try:
+            for index in range(self.slots):
+                offset = self._offset(index)
+                sequence = _SEQUENCE.unpack_from(self.mm, offset)[0]
+                if sequence:
+                    _SEQUENCE.pack_into(self.mm, offset, sequence + 1)
+                    _SLOT.pack_into(self.mm, offset, sequence + 1, bytes(16), 0, 0, 0, 0)
+                    # Back to even, but flagged empty by a zero length and digest.
+                    _SEQUENCE.pack_into(self.mm, offset, sequence + 2)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slots * self.slot_size, HEADER_SIZE, os.SEEK_SET)
@@ -0,0 +1,172 @@
+"""Save the packed answer cache and patch targets to disk, so a restart starts warm.
+
+The file is a header followed by records, each a type byte and a length:
+
+- a patch target: its TTL, version, refresh time and packed addresses;
+- an answer: expiry and store time, the question, the upstream and the packed answer.
+
+Times are wall-clock, since the monotonic clock restarts with the machine.
+Expired answers are dropped on load.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+from ipaddress import ip_address
+from typing import Callable, Iterator
+
+from . import wire
+from .dns_utils import TtlCache
+from .patch_target import PatchTarget, PatchTargets
+
+
+# File to keep the snapshot in; unset disables snapshots.
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', '300'))
+
+_MAGIC = b'CFDOHSN1'
+_HEADER = struct.Struct('!8sd')
+_RECORD = struct.Struct('!BI')
+# IPv4 count, IPv6 count, TTL, version, refreshed at
+_TARGET = struct.Struct('!HHIId')
+# expire, stored, question length, upstream length
+_ANSWER = struct.Struct('!ddHH')
+
+RECORD_TARGET = 1
+RECORD_ANSWER = 2
+
+logger = logging.getLogger(__name__)
+
+
+def dump(
+        cache: TtlCache[tuple[bytes, str], wire.WireAnswer] | None,
+        targets: PatchTargets,
+        clock: Callable = time.time) -> bytes:
+    """Pack the patch targets and, unless `cache` is None, the answers."""
+    now = clock()
+    chunks = [_HEADER.pack(_MAGIC, now)]
+
+    target = targets.snapshot
+    if target:
+        refreshed = now - (targets.timer() - target.refreshed_at)
+        payload = b''.join((
+            _TARGET.pack(len(target.ipv4s), len(target.ipv6s), target.ttl, target.version, refreshed),
+            *(ip_address(ip).packed for ip in target.ipv4s + target.ipv6s),
+        ))
+        chunks += [_RECORD.pack(RECORD_TARGET, len(payload)), payload]
+
+    for (question, upstream), answer, age, remaining in (cache.items_aged() if cache is not None else ()):
+        upstream_ = upstream.encode()
+        payload = b''.join((
+            _ANSWER.pack(now + remaining, now - age, len(question), len(upstream_)),
+            question, upstream_, answer.packet,
+        ))
+        chunks += [_RECORD.pack(RECORD_ANSWER, len(payload)), payload]
+    return b''.join(chunks)
+
+
+def _records(data) -> Iterator[tuple[int, memoryview]]:
+    view = memoryview(data)
+    offset = _HEADER.size
+    while offset + _RECORD.size <= len(view):
+        type_, length = _RECORD.unpack_from(view, offset)
+        offset += _RECORD.size
+        if offset + length > len(view):
+            raise ValueError('Snapshot is truncated')
+        yield type_, view[offset:offset + length]
+        offset += length
+
+
+def restore(
+        data,
+        cache: TtlCache[tuple[bytes, str], wire.WireAnswer] | None,
+        targets: PatchTargets,
+        clock: Callable = time.time) -> int:
+    """Load a snapshot made by `dump`; returns the number of answers restored, none if `cache` is None."""
+    magic, _ = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('Not a cache snapshot')
+    now = clock()
+    restored = 0
+    for type_, payload in _records(data):
+        if type_ == RECORD_TARGET and not targets.snapshot:
+            count4, count6, ttl, version, refreshed = _TARGET.unpack_from(payload)
+            offset = _TARGET.size
+            ipv4s = tuple(str(ip_address(bytes(payload[offset + i * 4:offset + i * 4 + 4]))) for i in range(count4))
+            offset += count4 * 4
+            ipv6s = tuple(
+                str(ip_address(bytes(payload[offset + i * 16:offset + i * 16 + 16]))) for i in range(count6))
+            refreshed_at = targets.timer() - (now - refreshed)
+            targets.snapshot = PatchTarget(ipv4s, ipv6s, ttl, version, refreshed_at)
+        elif type_ == RECORD_ANSWER and cache is not None:
+            expire, stored, qlen, ulen = _ANSWER.unpack_from(payload)
+            if expire <= now:
+                continue
+            offset = _ANSWER.size
+            question = bytes(payload[offset:offset + qlen])
+            upstream = bytes(payload[offset + qlen:offset + qlen + ulen]).decode()
+            answer = wire.WireAnswer(bytes(payload[offset + qlen + ulen:]))
+            cache.store((question, upstream), answer, ttl=expire - now, age=now - stored)
+            restored += 1
+    return restored
+
+
+def _write(path: str, data: bytes):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Snapshotter:
+    """Save `cache` and `targets` to `path` periodically and on shutdown, and load them on startup.
+
+    Answers are saved from an in-process `TtlCache` only: a shared memory
+    cache keeps just a digest of each key, so its answers can't be written
+    out. It outlives worker restarts on its own, though not the machine's;
+    with it, only the patch targets are saved.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            cache,
+            targets: PatchTargets,
+            interval: int | float = SNAPSHOT_INTERVAL):
+        self.path = path
+        self.cache = cache if isinstance(cache, TtlCache) else None
+        self.targets = targets
+        self.interval = interval
+
+    async def load(self) -> int:
+        if self.cache is None:
+            logger.warning('Cached answers are not saved to %s with a shared cache, only patch targets', self.path)
+        try:
+            data = await asyncio.to_thread(_read, self.path)
+            restored = restore(data, self.cache, self.targets)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning('Loading cache snapshot %s failed: %s', self.path, e)
+            return 0
+        logger.info('Restored %d cached answers from %s', restored, self.path)
+        return restored
+
+    async def save(self):
+        # Serialize on the loop, where the cache can't change under us; write off it.
+        data = dump(self.cache, self.targets)
+        try:
+            await asyncio.to_thread(_write, self.path, data)
+        except OSError as e:
+            logger.warning('Saving cache snapshot %s failed: %s', self.path, e)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
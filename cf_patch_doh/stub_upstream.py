@@ -0,0 +1,110 @@
+"""A DoH upstream that makes its answers up, so benchmarks and replays need no network.
+
+Every A/AAAA question gets one address: a Cloudflare one for the share of
+names picked by `cloudflare_ratio` (decided by a hash of the name, so a name
+always gets the same kind of answer) and a documentation-range one for the
+rest, after `latency` seconds. It's an ASGI app, so it runs in-process
+through `installed()` or as a server of its own:
+
+    uvicorn cf_patch_doh.stub_upstream:app --port 8053
+"""
+import asyncio
+import hashlib
+import os
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import httpx
+from dnslib import A, AAAA, DNSRecord, QTYPE, RR
+
+from . import dns_utils
+from .patch_target import PatchTarget
+
+
+STUB_LATENCY = float(os.environ.get('STUB_LATENCY', '0'))
+STUB_CLOUDFLARE_RATIO = float(os.environ.get('STUB_CLOUDFLARE_RATIO', '0.5'))
+
+# What Cloudflare answers are patched to while a stub is installed.
+PATCH_TARGET = PatchTarget(('203.0.113.10', '203.0.113.11'), ('2001:db8::10',), ttl=300, version=1)
+
+
+class StubUpstream:
+
+    def __init__(
+            self,
+            latency: float = STUB_LATENCY,
+            cloudflare_ratio: float = STUB_CLOUDFLARE_RATIO,
+            ttl: int = 300):
+        self.latency = latency
+        self.cloudflare_ratio = cloudflare_ratio
+        self.ttl = ttl
+        self.queries = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def is_cloudflare(self, name: str) -> bool:
+        digest = hashlib.blake2b(name.lower().encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') / 2 ** 64 < self.cloudflare_ratio
+
+    def answer(self, query: bytes) -> bytes:
+        record = DNSRecord.parse(query)
+        reply = record.reply()
+        name = str(record.q.qname)
+        n = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=2).digest(), 'big')
+        cloudflare = self.is_cloudflare(name.rstrip('.'))
+        if record.q.qtype == QTYPE.A:
+            ip = f'104.16.{n >> 8}.{n & 0xff}' if cloudflare else f'198.51.{100 + (n >> 15)}.{n & 0xff}'
+            reply.add_answer(RR(name, QTYPE.A, rdata=A(ip), ttl=self.ttl))
+        elif record.q.qtype == QTYPE.AAAA:
+            ip = f'2606:4700::{n:x}' if cloudflare else f'2001:db8::{n:x}'
+            reply.add_answer(RR(name, QTYPE.AAAA, rdata=AAAA(ip), ttl=self.ttl))
+        return bytes(reply.pack())
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope['type'] != 'http':
+            return
+        message = await receive()
+        body = message.get('body', b'')
+        while message.get('more_body'):
+            message = await receive()
+            body += message.get('body', b'')
+
+        self.queries += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            try:
+                status, content = 200, self.answer(body)
+            except Exception:
+                status, content = 400, b''
+        finally:
+            self.in_flight -= 1
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/dns-message'), (b'content-length', str(len(content)).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': content})
+
+
+@contextmanager
+def installed(stub: StubUpstream):
+    """Send every upstream query to `stub`, and patch Cloudflare answers to PATCH_TARGET."""
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub))
+    snapshot = dns_utils.PATCH_TARGETS.snapshot
+    dns_utils.PATCH_TARGETS.snapshot = PatchTarget(
+        PATCH_TARGET.ipv4s, PATCH_TARGET.ipv6s, PATCH_TARGET.ttl, PATCH_TARGET.version,
+        dns_utils.PATCH_TARGETS.timer())
+    try:
+        with patch.object(dns_utils.UPSTREAM_CLIENTS, 'get', lambda upstream: client):
+            yield stub
+    finally:
+        dns_utils.PATCH_TARGETS.snapshot = snapshot
+
+
+def clear_caches():
+    for cache in dns_utils.CACHES.values():
+        cache.clear()
+
+
+app = StubUpstream()
@@ -0,0 +1,172 @@
+"""Opt-in per-query tracing: how long each stage of answering a query took.
+
+A sampled query gets a `Span` in a context variable; code marks its stages
+with `with stage('name'):`, and the finished span is written as one line to
+TRACE_FILE. With TRACE_SAMPLE_RATE at 0 (the default) no span is ever made
+and `stage()` returns a shared no-op, so tracing costs a context variable
+lookup per stage.
+
+TRACE_FORMAT 'json' writes compact lines:
+
+    {"trace": "...", "name": "resolve", "start": 1700000000.123, "ms": 12.3,
+     "attrs": {...}, "stages": [["parse", 0.01, 0.05], ...]}
+
+with stage offsets and durations in milliseconds. 'otlp' writes the span
+and its stages as OpenTelemetry JSON spans (one resourceSpans object per
+line), which an OpenTelemetry collector's file receiver can ingest.
+"""
+import json
+import os
+import random
+import sys
+import time
+from contextvars import ContextVar
+from typing import TextIO
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+# Where finished spans go, one per line; unset means stderr.
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_FORMAT = os.environ.get('TRACE_FORMAT', 'json')
+
+_SPAN: ContextVar['Span | None'] = ContextVar('span', default=None)
+
+
+class Span:
+
+    __slots__ = ('trace_id', 'span_id', 'name', 'attrs', 'wall_start', 'start', 'end', 'stages', 'token')
+
+    def __init__(self, name: str, attrs: dict):
+        self.trace_id = random.getrandbits(128)
+        self.span_id = random.getrandbits(64)
+        self.name = name
+        self.attrs = attrs
+        self.wall_start = time.time_ns()
+        self.start = time.perf_counter_ns()
+        self.end: int | None = None
+        # (name, start, end) in perf_counter nanoseconds
+        self.stages: list[tuple[str, int, int]] = []
+        self.token = None
+
+    def finish(self):
+        self.end = time.perf_counter_ns()
+        if self.token is not None:
+            _SPAN.reset(self.token)
+            self.token = None
+        SINK.write(self)
+
+    def to_json(self) -> dict:
+        return {
+            'trace': f'{self.trace_id:032x}',
+            'name': self.name,
+            'start': self.wall_start / 1e9,
+            'ms': round((self.end - self.start) / 1e6, 3),
+            'attrs': self.attrs,
+            'stages': [
+                [name, round((start - self.start) / 1e6, 3), round((end - start) / 1e6, 3)]
+                for name, start, end in self.stages
+            ],
+        }
+
+    def to_otlp(self) -> dict:
+        trace_id = f'{self.trace_id:032x}'
+        parent = f'{self.span_id:016x}'
+
+        def otlp_span(span_id: str, name: str, start: int, end: int, parent_id: str | None, attrs: dict) -> dict:
+            span = {
+                'traceId': trace_id,
+                'spanId': span_id,
+                'name': name,
+                'kind': 1,
+                'startTimeUnixNano': str(self.wall_start + start - self.start),
+                'endTimeUnixNano': str(self.wall_start + end - self.start),
+                'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in attrs.items()],
+            }
+            if parent_id is not None:
+                span['parentSpanId'] = parent_id
+            return span
+
+        spans = [otlp_span(parent, self.name, self.start, self.end, None, self.attrs)]
+        spans += [
+            otlp_span(f'{random.getrandbits(64):016x}', name, start, end, parent, {})
+            for name, start, end in self.stages
+        ]
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'cf-patch-doh'}}]},
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+        }]}
+
+
+class _Stage:
+
+    __slots__ = ('span', 'name', 'start')
+
+    def __init__(self, span: Span, name: str):
+        self.span = span
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        # Background work started by a traced query may outlive its span.
+        if self.span.end is None:
+            self.span.stages.append((self.name, self.start, time.perf_counter_ns()))
+
+
+class _NoStage:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Sink:
+    """Writes finished spans as lines to a file (stderr by default)."""
+
+    def __init__(self, path: str | None = TRACE_FILE, format: str = TRACE_FORMAT):
+        if format not in ('json', 'otlp'):
+            raise ValueError(f'Unknown trace format: {format!r}')
+        self.path = path
+        self.format = format
+        self.file: TextIO | None = None
+
+    def write(self, span: Span):
+        if self.file is None:
+            self.file = open(self.path, 'a', buffering=1) if self.path else sys.stderr
+        data = span.to_json() if self.format == 'json' else span.to_otlp()
+        self.file.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+
+SINK = Sink()
+
+
+def start(name: str, **attrs) -> Span | None:
+    """Start a span for this query if it's sampled; the caller must `finish()` it."""
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    span = Span(name, attrs)
+    span.token = _SPAN.set(span)
+    return span
+
+
+def current() -> Span | None:
+    return _SPAN.get()
+
+
+def annotate(**attrs):
+    if (span := _SPAN.get()) is not None:
+        span.attrs.update(attrs)
+
+
+def stage(name: str):
+    span = _SPAN.get()
+    if span is None:
+        return _NO_STAGE
+    return _Stage(span, name)
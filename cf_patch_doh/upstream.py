@@ -0,0 +1,432 @@
+import asyncio
+import os
+import time
+from collections import deque, OrderedDict
+from functools import partial
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+import httpx
+
+from . import metrics
+
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', '20'))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get('UPSTREAM_MAX_KEEPALIVE', '10'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', '60'))
+# Clients for upstreams nobody asked for in this long are closed and dropped.
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_IDLE_TIMEOUT', '300'))
+# Most upstream clients kept open; the least recently used one is closed to make room.
+UPSTREAM_MAX_CLIENTS = int(os.environ.get('UPSTREAM_MAX_CLIENTS', '100'))
+
+# Deadline for an upstream answer, hedges included.
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '5'))
+# Deadlines for particular upstreams, as comma-separated 'url=seconds', e.g.
+# 'https://1.1.1.1/dns-query=2,https://dns.example/dns-query=10'; others get UPSTREAM_TIMEOUT.
+UPSTREAM_TIMEOUTS = os.environ.get('UPSTREAM_TIMEOUTS', '')
+# A hedge goes out once the primary takes longer than its p95 latency, bounded by these.
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', '0.05'))
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', '0.5'))
+# An upstream failing this many times in a row is skipped for CIRCUIT_OPEN_SECONDS,
+# doubling up to CIRCUIT_MAX_OPEN_SECONDS while probes keep failing.
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', '5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.environ.get('CIRCUIT_MAX_OPEN_SECONDS', '300'))
+# Upstreams whose health is remembered; the least recently used is forgotten beyond that.
+MAX_TRACKED_UPSTREAMS = int(os.environ.get('MAX_TRACKED_UPSTREAMS', '1000'))
+
+V = TypeVar('V')
+
+
+def parse_timeouts(value: str) -> dict[str, float]:
+    timeouts = dict()
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        upstream, _, seconds = item.rpartition('=')
+        if not upstream.strip():
+            raise ValueError(f'Expected url=seconds, got {item!r}')
+        timeouts[upstream.strip()] = float(seconds)
+    return timeouts
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class UpstreamTimeout(UpstreamError, asyncio.TimeoutError):
+    pass
+
+
+class UpstreamClients:
+    """One long-lived, pooled HTTP/2 client per upstream URL.
+
+    Clients are created on first use and closed after `idle_timeout` seconds
+    without a request, so rarely used custom upstreams don't hold sockets.
+    """
+
+    def __init__(
+            self,
+            limits: httpx.Limits | None = None,
+            idle_timeout: int | float = UPSTREAM_IDLE_TIMEOUT,
+            max_clients: int = UPSTREAM_MAX_CLIENTS,
+            http2: bool = True,
+            timer: Callable = time.monotonic):
+        if limits is None:
+            limits = httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            )
+        self.limits = limits
+        self.idle_timeout = idle_timeout
+        self.max_clients = max_clients
+        self.http2 = http2
+        self.timer = timer
+        self.clients: dict[str, httpx.AsyncClient] = dict()
+        self.last_used: dict[str, float] = dict()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def __contains__(self, upstream: str) -> bool:
+        return upstream in self.clients
+
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        client = self.clients.get(upstream)
+        if client is None or client.is_closed:
+            if client is None and len(self.clients) >= self.max_clients:
+                oldest = min(self.last_used, key=self.last_used.__getitem__)
+                self.last_used.pop(oldest)
+                asyncio.ensure_future(self.clients.pop(oldest).aclose())
+            client = httpx.AsyncClient(http2=self.http2, limits=self.limits)
+            self.clients[upstream] = client
+        self.last_used[upstream] = self.timer()
+        return client
+
+    async def evict_idle(self) -> int:
+        deadline = self.timer() - self.idle_timeout
+        idle = [
+            upstream
+            for upstream, last_used in self.last_used.items()
+            if last_used < deadline
+        ]
+        for upstream in idle:
+            await self.evict(upstream)
+        return len(idle)
+
+    async def evict(self, upstream: str):
+        self.last_used.pop(upstream, None)
+        client = self.clients.pop(upstream, None)
+        if client is not None:
+            await client.aclose()
+
+    async def run_evictor(self, interval: int | float | None = None):
+        if interval is None:
+            interval = max(self.idle_timeout / 2, 1)
+        while True:
+            await asyncio.sleep(interval)
+            await self.evict_idle()
+
+    async def aclose(self):
+        clients = list(self.clients.values())
+        self.clients.clear()
+        self.last_used.clear()
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+
+class SingleFlight(Generic[V]):
+    """Coalesce concurrent lookups for the same key into one upstream task.
+
+    The first caller for a key starts the task; everyone else arriving while
+    it runs awaits the same task. Waiters are shielded from each other, so a
+    client that goes away doesn't cancel the lookup for the rest.
+    """
+
+    def __init__(self):
+        self.inflight: dict[Hashable, asyncio.Future[V]] = dict()
+        self.originated = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.inflight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[V]]) -> V:
+        task = self.inflight.get(key)
+        if task is None:
+            self.originated += 1
+            task = asyncio.ensure_future(func())
+            self.inflight[key] = task
+            task.add_done_callback(partial(self._done, key))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away.
+            task.exception()
+
+
+class UpstreamStats:
+    """Latency of one upstream: an EWMA to rank it and recent samples for its p95."""
+
+    __slots__ = ('ewma', 'samples', 'p95', 'failures')
+
+    ALPHA = 0.2
+    SAMPLES = 64
+
+    def __init__(self):
+        self.ewma: float | None = None
+        self.samples: deque[float] = deque(maxlen=self.SAMPLES)
+        self.p95: float | None = None
+        self.failures = 0
+
+    def observe(self, latency: float):
+        self.ewma = latency if self.ewma is None else self.ewma + self.ALPHA * (latency - self.ewma)
+        self.samples.append(latency)
+        ordered = sorted(self.samples)
+        self.p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+
+    def fail(self, penalty: float):
+        # Count a failure as a very slow answer, so the upstream drops in the ranking.
+        self.failures += 1
+        self.ewma = penalty if self.ewma is None else self.ewma + self.ALPHA * (penalty - self.ewma)
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for one upstream.
+
+    Closed, it lets everything through. After `threshold` failures in a
+    row it opens and refuses queries for `open_seconds`; then it lets a
+    single probe through (half-open). A successful probe closes it, a
+    failed one opens it again for twice as long, up to `max_open_seconds`.
+    """
+
+    __slots__ = ('failures', 'opened_at', 'open_seconds', 'probing')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.open_seconds = 0.0
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+
+class UpstreamHealth:
+    """Circuit breakers for the most recently used upstreams."""
+
+    def __init__(
+            self,
+            threshold: int = CIRCUIT_FAILURES,
+            open_seconds: int | float = CIRCUIT_OPEN_SECONDS,
+            max_open_seconds: int | float = CIRCUIT_MAX_OPEN_SECONDS,
+            max_tracked: int = MAX_TRACKED_UPSTREAMS,
+            timer: Callable = time.monotonic):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.max_tracked = max_tracked
+        self.timer = timer
+        self.breakers: OrderedDict[str, CircuitBreaker] = OrderedDict()
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self.breakers)
+
+    def _breaker(self, upstream: str) -> CircuitBreaker:
+        breaker = self.breakers.get(upstream)
+        if breaker is None:
+            breaker = self.breakers[upstream] = CircuitBreaker()
+            if len(self.breakers) > self.max_tracked:
+                self.breakers.popitem(last=False)
+        else:
+            self.breakers.move_to_end(upstream)
+        return breaker
+
+    def available(self, upstream: str) -> bool:
+        """Whether `allow` would let a query through, without taking the probe."""
+        breaker = self.breakers.get(upstream)
+        if breaker is None or not breaker.is_open:
+            return True
+        return not breaker.probing and self.timer() - breaker.opened_at >= breaker.open_seconds
+
+    def allow(self, upstream: str) -> bool:
+        """Call right before querying `upstream`; with a half-open circuit the query becomes the probe."""
+        if not self.available(upstream):
+            self.rejected += 1
+            return False
+        breaker = self.breakers.get(upstream)
+        if breaker is not None and breaker.is_open:
+            breaker.probing = True
+        return True
+
+    def success(self, upstream: str):
+        breaker = self.breakers.get(upstream)
+        if breaker is not None:
+            self.breakers.move_to_end(upstream)
+            breaker.failures = 0
+            breaker.opened_at = None
+            breaker.probing = False
+
+    def failure(self, upstream: str):
+        breaker = self._breaker(upstream)
+        breaker.failures += 1
+        if breaker.probing:
+            breaker.open_seconds = min(breaker.open_seconds * 2, self.max_open_seconds)
+        elif breaker.failures >= self.threshold and not breaker.is_open:
+            breaker.open_seconds = self.open_seconds
+        else:
+            return
+        breaker.opened_at = self.timer()
+        breaker.probing = False
+
+    def release(self, upstream: str):
+        """A probe ended without an answer either way; let the next query probe again."""
+        breaker = self.breakers.get(upstream)
+        if breaker is not None:
+            breaker.probing = False
+
+    def state(self, upstream: str) -> str:
+        breaker = self.breakers.get(upstream)
+        if breaker is None or not breaker.is_open:
+            return 'closed'
+        return 'half-open' if breaker.probing else 'open'
+
+
+class HedgedUpstreams:
+    """Send queries to the fastest upstream of a pool, hedging with the next ones when it's slow.
+
+    `pools` maps an upstream to the interchangeable upstreams that may answer
+    for it; others are queried alone. The one with the lowest latency EWMA
+    goes first (untried ones before that, so every one gets measured).
+    When it hasn't answered after its p95 latency, or fails, the next one is
+    queried too, and the first answer wins. Everything is given up after
+    the queried upstream's entry in `timeouts`, or `timeout` seconds
+    without one; each attempt gets its own upstream's deadline. Upstreams whose circuit is open are skipped, and
+    with none left the query fails at once with `CircuitOpenError`.
+    """
+
+    def __init__(
+            self,
+            pools: dict[str, list[str]] | None = None,
+            timeout: int | float = UPSTREAM_TIMEOUT,
+            timeouts: dict[str, float] | None = None,
+            min_delay: int | float = HEDGE_MIN_DELAY,
+            default_delay: int | float = HEDGE_DEFAULT_DELAY,
+            health: UpstreamHealth | None = None,
+            timer: Callable = time.perf_counter):
+        self.pools = pools or dict()
+        self.health = health if health is not None else UpstreamHealth()
+        self.timeout = timeout
+        self.timeouts = timeouts if timeouts is not None else parse_timeouts(UPSTREAM_TIMEOUTS)
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.timer = timer
+        self.stats: dict[str, UpstreamStats] = {
+            member: UpstreamStats()
+            for pool in self.pools.values()
+            for member in pool
+        }
+        self.hedged = 0
+
+    def candidates(self, upstream: str) -> list[str]:
+        pool = self.pools.get(upstream)
+        if pool is None:
+            return [upstream]
+        return sorted(pool, key=lambda member: self.stats[member].ewma or 0)
+
+    def timeout_for(self, upstream: str) -> float:
+        return self.timeouts.get(upstream, self.timeout)
+
+    def hedge_delay(self, upstream: str) -> float:
+        stats = self.stats.get(upstream)
+        if stats is None or stats.p95 is None:
+            return self.default_delay
+        return min(max(stats.p95, self.min_delay), self.timeout_for(upstream))
+
+    async def query(self, upstream: str, send: Callable[[str], Awaitable[V]]) -> V:
+        candidates = [candidate for candidate in self.candidates(upstream) if self.health.available(candidate)]
+        if not candidates:
+            raise CircuitOpenError(f'{upstream} is failing, not querying it for now')
+        timeout = self.timeout_for(upstream)
+        try:
+            return await self._race(candidates, send, timeout)
+        except asyncio.TimeoutError:
+            self.health.failure(candidates[0])
+            if (stats := self.stats.get(candidates[0])) is not None:
+                stats.fail(self.timeout_for(candidates[0]))
+            raise UpstreamTimeout(f'No answer from {upstream} in {timeout}s') from None
+
+    async def _race(self, candidates: list[str], send: Callable[[str], Awaitable[V]], timeout: float) -> V:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        waiting = list(candidates)
+        pending: dict[asyncio.Future, str] = {}
+        error: BaseException | None = None
+
+        def launch() -> bool:
+            while waiting:
+                upstream = waiting.pop(0)
+                if self.health.allow(upstream):
+                    pending[asyncio.ensure_future(self._timed(upstream, send))] = upstream
+                    return True
+            return False
+
+        if not launch():
+            raise CircuitOpenError(f'{candidates[0]} is failing, not querying it for now')
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    # A probe that never answered failed; cancelling it alone would only release it.
+                    for upstream in pending.values():
+                        if self.health.state(upstream) == 'half-open':
+                            self.health.failure(upstream)
+                    raise asyncio.TimeoutError
+                delay = min(self.hedge_delay(candidates[0]), remaining) if waiting else remaining
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if loop.time() < deadline and launch():
+                        self.hedged += 1
+                    continue
+                for task in done:
+                    del pending[task]
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if waiting and not pending:
+                    launch()
+            # Whatever the send failed with (connection, TLS, garbled answer), the upstream failed.
+            raise UpstreamError(f'No answer from {candidates[0]}: {type(error).__name__}: {error}') from error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _timed(self, upstream: str, send: Callable[[str], Awaitable[V]]) -> V:
+        stats = self.stats.get(upstream)
+        started = self.timer()
+        try:
+            result = await send(upstream)
+        except asyncio.CancelledError:
+            self.health.release(upstream)
+            raise
+        except Exception:
+            self.health.failure(upstream)
+            metrics.UPSTREAM_ERRORS.inc(metrics.upstream_label(upstream, self.stats))
+            if stats is not None:
+                stats.fail(self.timeout_for(upstream))
+            raise
+        latency = self.timer() - started
+        self.health.success(upstream)
+        metrics.UPSTREAM_LATENCY.observe(latency, metrics.upstream_label(upstream, self.stats))
+        if stats is not None:
+            stats.observe(latency)
+        return result
@@ -0,0 +1,229 @@
+"""Work on DNS messages in wire format, without building dnslib objects."""
+import base64
+import binascii
+import struct
+from typing import Iterator
+
+_HEADER = struct.Struct('!HHHHHH')
+_FLAGS = struct.Struct('!H')
+_RR_FIXED = struct.Struct('!HHIH')
+_TTL = struct.Struct('!I')
+_COUNT = struct.Struct('!H')
+# Swaps the alphabets, so standard base64's '+' and '/' become invalid rather than accepted.
+_FROM_BASE64URL = bytes.maketrans(b'-_+/', b'+/-_')
+
+HEADER_SIZE = 12
+
+QR = 0x8000
+OPCODE = 0x7800
+AA = 0x0400
+TC = 0x0200
+RD = 0x0100
+RA = 0x0080
+AD = 0x0020
+CD = 0x0010
+
+# Header bits a reply takes over from the query, as dnslib's reply() does.
+QUERY_FLAGS = OPCODE | RD | AD | CD
+
+TYPE_OPT = 41
+
+# Longest base64url text a DNS message (at most 65535 bytes) can encode to.
+MAX_BASE64_LENGTH = (65535 + 2) // 3 * 4
+
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+
+
+class WireError(ValueError):
+    pass
+
+
+def skip_name(packet: bytes, offset: int) -> int:
+    """Return the offset right after the (possibly compressed) name at `offset`."""
+    while True:
+        try:
+            length = packet[offset]
+        except IndexError:
+            raise WireError('Name runs past the end of the message') from None
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise WireError(f'Unsupported label type: {length:#x}')
+        offset += 1 + length
+
+
+def question_end(packet: bytes) -> int:
+    """Validate the header of a single-question message and find where its question ends."""
+    if len(packet) < HEADER_SIZE:
+        raise WireError('Message shorter than a DNS header')
+    qdcount = (packet[4] << 8) | packet[5]
+    if qdcount != 1:
+        raise WireError(f'Expected exactly one question, got {qdcount}')
+    end = skip_name(packet, HEADER_SIZE) + 4
+    if end > len(packet):
+        raise WireError('Question runs past the end of the message')
+    return end
+
+
+def question(packet: bytes) -> bytes:
+    """The raw question section (name, type and class) of a query."""
+    return packet[HEADER_SIZE:question_end(packet)]
+
+
+def decode_base64url(value: str) -> bytes:
+    """Decode the unpadded base64url `dns` parameter of an RFC 8484 GET request."""
+    if len(value) > MAX_BASE64_LENGTH:
+        raise WireError('Encoded message is too long')
+    value = value.rstrip('=')
+    try:
+        data = (value + '=' * (-len(value) % 4)).encode('ascii').translate(_FROM_BASE64URL)
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise WireError(f'Invalid base64url: {e}') from None
+
+
+def check_query(packet: bytes) -> bytes:
+    """Reject anything that isn't a single-question query before it gets parsed."""
+    question_end(packet)
+    if packet[2] & 0x80:
+        raise WireError('Message is a response, not a query')
+    # Records the counts claim (an EDNS OPT, usually) must all be there.
+    for _ in records(packet):
+        pass
+    return packet
+
+
+def min_ttl(packet: bytes) -> int | None:
+    """The smallest TTL in the message (SOA included for negative answers), None without records."""
+    return min((ttl for _, ttl in ttl_offsets(packet)), default=None)
+
+
+def records(packet: bytes) -> Iterator[tuple[int, int, int, int, int, int]]:
+    """Walk the resource records after the question.
+
+    Yields (section, offset, type, class, ttl, rdlength) where `offset` points
+    at the fixed part following the owner name and section is 0 for answer,
+    1 for authority and 2 for additional records.
+    """
+    if len(packet) < HEADER_SIZE:
+        raise WireError('Message shorter than a DNS header')
+    _, _, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(packet)
+    offset = HEADER_SIZE
+    for _ in range(qdcount):
+        offset = skip_name(packet, offset) + 4
+
+    for section, count in enumerate((ancount, nscount, arcount)):
+        for _ in range(count):
+            offset = skip_name(packet, offset)
+            if offset + _RR_FIXED.size > len(packet):
+                raise WireError('Resource record runs past the end of the message')
+            rtype, rclass, ttl, rdlength = _RR_FIXED.unpack_from(packet, offset)
+            yield section, offset, rtype, rclass, ttl, rdlength
+            offset += _RR_FIXED.size + rdlength
+    if offset > len(packet):
+        raise WireError('Resource record runs past the end of the message')
+
+
+def ttl_offsets(packet: bytes) -> list[tuple[int, int]]:
+    """(offset, ttl) of every resource record TTL in the message, OPT excluded."""
+    return [
+        (offset + 4, ttl)
+        for _, offset, rtype, _, ttl, _ in records(packet)
+        if rtype != TYPE_OPT
+    ]
+
+
+def packed_ttl_offsets(data: bytes, count: int) -> list[int]:
+    """TTL offsets of `count` resource records packed back to back, without a message around them."""
+    offsets = []
+    offset = 0
+    for _ in range(count):
+        offset = skip_name(data, offset)
+        if offset + _RR_FIXED.size > len(data):
+            raise WireError('Resource record runs past the end of the data')
+        rdlength = _RR_FIXED.unpack_from(data, offset)[3]
+        offsets.append(offset + 4)
+        offset += _RR_FIXED.size + rdlength
+    return offsets
+
+
+def edns_payload_size(query: bytes) -> int | None:
+    """The UDP payload size advertised in the query's OPT record, None without EDNS."""
+    for section, _, rtype, rclass, _, _ in records(query):
+        if section == 2 and rtype == TYPE_OPT:
+            return rclass
+    return None
+
+
+def with_opt(reply: bytes, payload_size: int) -> bytes:
+    """Append an OPT record advertising our own UDP payload size (RFC 6891)."""
+    arcount = (reply[10] << 8) | reply[11]
+    return b''.join((
+        reply[:10],
+        _COUNT.pack(arcount + 1),
+        reply[HEADER_SIZE:],
+        b'\x00',
+        _RR_FIXED.pack(TYPE_OPT, payload_size, 0, 0),
+    ))
+
+
+def truncated(reply: bytes) -> bytes:
+    """The reply cut down to its header and question, with the TC bit set."""
+    try:
+        qend = question_end(reply)
+    except WireError:
+        qend = HEADER_SIZE
+    (id_, flags, qdcount, _, _, _) = _HEADER.unpack_from(reply)
+    return _HEADER.pack(id_, flags | TC, qdcount if qend > HEADER_SIZE else 0, 0, 0, 0) + reply[HEADER_SIZE:qend]
+
+
+def error_reply(query: bytes, rcode: int) -> bytes | None:
+    """A bare reply with `rcode` for a query we couldn't answer, None if it's not even a header."""
+    if len(query) < HEADER_SIZE:
+        return None
+    (id_, flags, _, _, _, _) = _HEADER.unpack_from(query)
+    try:
+        question_ = question(query)
+    except WireError:
+        question_ = b''
+    flags = QR | RA | (flags & QUERY_FLAGS) | rcode
+    return _HEADER.pack(id_, flags, 1 if question_ else 0, 0, 0, 0) + question_
+
+
+class WireAnswer:
+    """A packed answer that can be replayed for later queries of the same question.
+
+    Only the transaction ID, the flags copied from the query, the question
+    (whose letter case may differ) and the TTLs are rewritten on replay.
+    """
+
+    __slots__ = ('packet', 'qend', 'offsets', 'ttls', 'hits')
+
+    def __init__(self, packet: bytes):
+        self.packet = packet
+        self.qend = question_end(packet)
+        records = ttl_offsets(packet)
+        self.offsets = tuple(offset for offset, _ in records)
+        self.ttls = tuple(ttl for _, ttl in records)
+        self.hits = 0
+
+    @property
+    def min_ttl(self) -> int | None:
+        return min(self.ttls, default=None)
+
+    def render(self, query: bytes, elapsed: int | float = 0, floor: int = 0) -> bytes:
+        """Build the reply to `query` with every TTL decayed by `elapsed` seconds, down to `floor`."""
+        buf = bytearray(self.packet)
+        buf[0:2] = query[0:2]
+        flags = _FLAGS.unpack_from(self.packet, 2)[0] & ~QUERY_FLAGS
+        flags |= _FLAGS.unpack_from(query, 2)[0] & QUERY_FLAGS
+        _FLAGS.pack_into(buf, 2, flags)
+        buf[HEADER_SIZE:self.qend] = query[HEADER_SIZE:self.qend]
+
+        elapsed = int(elapsed)
+        for offset, ttl in zip(self.offsets, self.ttls):
+            _TTL.pack_into(buf, offset, max(ttl - elapsed, floor))
+        return bytes(buf)
@@ -2,9 +2,16 @@
 """Unit tests for cf-patch-doh.
 
 Tests internal logic without requiring a running HTTP server.
-Network calls (fetch_dns, _get_icn_ips) are mocked.
+Network calls (fetch_dns, the upstream client) are mocked.
 """
+import asyncio
+import base64
+import json
+import logging
+import shutil
 import struct
+import subprocess
+import time
 from unittest.mock import AsyncMock, patch
 
 import dnslib
@@ -23,6 +30,17 @@ from cf_patch_doh.dns_utils import (
     should_bypass,
 )
 from cf_patch_doh.cloudflare import CF_NETWORKS
+from cf_patch_doh.upstream import UpstreamClients
+
+
+@pytest.fixture(autouse=True)
+def clear_patched_cache():
+    """Patched answers are keyed by content, not by name, so they'd carry over between tests."""
+    from cf_patch_doh.dns_utils import CACHED_PATCHED
+
+    CACHED_PATCHED.clear()
+    yield
+    CACHED_PATCHED.clear()
 
 # =============================================================================
 # Helper function tests
@@ -107,6 +125,118 @@ class TestIsCloudflareSync:
         assert is_cloudflare_sync("198.41.128.1") is True
 
 
+class TestPrefixIndex:
+    """PrefixIndex answers network membership with a bisect over integer ranges."""
+
+    def test_packed_and_int_lookups(self):
+        from ipaddress import ip_address
+
+        from cf_patch_doh.cloudflare import CF_INDEX
+
+        assert CF_INDEX.contains_packed(ip_address("104.16.0.1").packed) is True
+        assert CF_INDEX.contains_packed(ip_address("8.8.8.8").packed) is False
+        assert CF_INDEX.contains_packed(ip_address("2606:4700::1").packed) is True
+        assert CF_INDEX.contains_v4(int(ip_address("198.41.255.255"))) is True
+        assert CF_INDEX.contains_v4(int(ip_address("198.42.0.0"))) is False
+
+    def test_matches_linear_scan(self):
+        from ipaddress import ip_address
+
+        from cf_patch_doh.cloudflare import CF_INDEX
+
+        for network in CF_NETWORKS:
+            first = int(network.network_address)
+            last = int(network.broadcast_address)
+            for value in (first - 1, first, last, last + 1):
+                address = ip_address(value)
+                expected = any(address in n for n in CF_NETWORKS)
+                assert (address in CF_INDEX) is expected, address
+
+    def test_overlapping_networks_merged(self):
+        from ipaddress import ip_network
+
+        from cf_patch_doh.cloudflare import PrefixIndex
+
+        index = PrefixIndex([
+            ip_network("10.0.0.0/16"),
+            ip_network("10.0.128.0/24"),
+            ip_network("10.1.0.0/16"),
+            ip_network("192.0.2.0/24"),
+        ])
+        assert len(index) == 2
+        assert "10.1.255.255" in index
+        assert "10.2.0.0" not in index
+
+    def test_bad_packed_length(self):
+        from cf_patch_doh.cloudflare import CF_INDEX
+
+        with pytest.raises(ValueError):
+            CF_INDEX.contains_packed(b"\x01\x02\x03")
+
+    def test_is_cloudflare_sync_accepts_packed(self):
+        assert is_cloudflare_sync(bytes([104, 16, 0, 1])) is True
+        assert is_cloudflare_sync(bytes([8, 8, 8, 8])) is False
+
+
+class TestCloudflareRangeReload:
+    """Cloudflare ranges load from ips-v4/ips-v6 files and hot reload."""
+
+    def test_build_index_from_files(self, tmp_path):
+        from cf_patch_doh.cloudflare import build_index
+
+        v4 = tmp_path / "ips-v4"
+        v4.write_text("198.51.100.0/24\n# comment\n\n203.0.113.0/24\n")
+        index = build_index([str(v4)])
+        assert "198.51.100.7" in index
+        assert "104.16.0.1" not in index  # file replaces the embedded IPv4 list
+        assert "2606:4700::1" in index  # IPv6 falls back to the embedded list
+        assert index.networks == 2 + sum(1 for n in CF_NETWORKS if n.version == 6)
+
+    def test_build_index_rejects_garbage(self, tmp_path):
+        from cf_patch_doh.cloudflare import build_index
+
+        v4 = tmp_path / "ips-v4"
+        v4.write_text("not a network\n")
+        with pytest.raises(ValueError):
+            build_index([str(v4)])
+
+    @pytest.mark.asyncio
+    async def test_reload_on_mtime_change(self, tmp_path):
+        import os
+
+        from cf_patch_doh.cloudflare import CF_INDEX, build_index
+        from cf_patch_doh.reloader import Reloadable
+
+        v4 = tmp_path / "ips-v4"
+        ranges = Reloadable("test ranges", [str(v4), None], build_index, CF_INDEX)
+        assert await ranges.reload(force=True) is True  # file missing: embedded list
+        assert "104.16.0.1" in ranges.value
+        assert await ranges.reload() is False
+
+        v4.write_text("198.51.100.0/24\n")
+        assert await ranges.reload() is True
+        assert "198.51.100.1" in ranges.value
+        assert "104.16.0.1" not in ranges.value
+        assert ranges.reload_seconds is not None
+
+        old = ranges.value
+        v4.write_text("garbage\n")
+        os.utime(v4, (0, 12345))
+        assert await ranges.reload() is False
+        assert ranges.value is old
+        assert ranges.last_error is not None
+
+    @pytest.mark.asyncio
+    async def test_detection_uses_reloaded_ranges(self):
+        from ipaddress import ip_network
+
+        from cf_patch_doh.cloudflare import PrefixIndex
+
+        with patch("cf_patch_doh.cloudflare.CF_RANGES.value", PrefixIndex([ip_network("198.51.100.0/24")])):
+            assert is_cloudflare_sync("198.51.100.1") is True
+            assert is_cloudflare_sync("104.16.0.1") is False
+
+
 # =============================================================================
 # should_bypass tests
 # =============================================================================
@@ -179,6 +309,68 @@ class TestShouldBypass:
         assert should_bypass(record) is False
 
 
+class TestDomainMatcher:
+    """DomainMatcher implements BYPASS_LIST's exact and '.suffix' semantics."""
+
+    def test_exact_and_suffix(self):
+        from cf_patch_doh.bypass import DomainMatcher
+
+        matcher = DomainMatcher(["cloudflare.com", ".cdn.cloudflare.net"])
+        assert "cloudflare.com" in matcher
+        assert "www.cloudflare.com" not in matcher
+        assert "a.b.cdn.cloudflare.net" in matcher
+        assert "cdn.cloudflare.net" not in matcher
+        assert "xcdn.cloudflare.net" not in matcher
+        assert "example.com" not in matcher
+
+    def test_case_and_trailing_dot(self):
+        from cf_patch_doh.bypass import DomainMatcher
+
+        matcher = DomainMatcher(["CloudFlare.com.", ".pacloudflare.com"])
+        assert "cloudflare.com." in matcher
+        assert "X.PACLOUDFLARE.COM" in matcher
+
+    def test_matches_endswith_semantics(self):
+        from cf_patch_doh.bypass import DomainMatcher
+        from cf_patch_doh.dns_utils import BYPASS_LIST
+
+        matcher = DomainMatcher(BYPASS_LIST)
+        for domain in [
+            "prod.api.letsencrypt.org", "api.letsencrypt.org", "speed.cloudflare.com",
+            "a.pacloudflare.com", "pacloudflare.com", "shops.myshopify.com", "x.shops.myshopify.com",
+        ]:
+            expected = any(
+                domain.endswith(bypass) if bypass[0] == "." else domain == bypass
+                for bypass in BYPASS_LIST)
+            assert (domain in matcher) is expected, domain
+
+    def test_parse_domains(self):
+        from cf_patch_doh.bypass import parse_domains
+
+        text = "example.com\n# comment\n0.0.0.0 ads.example.net  # hosts format\n\n.suffix.org\n"
+        assert parse_domains(text) == ["example.com", "ads.example.net", ".suffix.org"]
+
+    @pytest.mark.asyncio
+    async def test_bypass_file_hot_reload(self, tmp_path):
+        import os
+
+        from cf_patch_doh import dns_utils
+        from cf_patch_doh.reloader import Reloadable
+
+        bypass_file = tmp_path / "bypass.txt"
+        bypass_file.write_text(".example.org\n")
+        bypass = Reloadable("bypass", [str(bypass_file)], dns_utils.build_bypass, None)
+        await bypass.reload(force=True)
+
+        with patch.object(dns_utils, "BYPASS", bypass):
+            assert should_bypass(_make_record("www.example.org")) is True
+            assert should_bypass(_make_record("cloudflare.com")) is True  # defaults kept
+            bypass_file.write_text("")
+            os.utime(bypass_file, (0, 12345))
+            await bypass.reload()
+            assert should_bypass(_make_record("www.example.org")) is False
+
+
 # =============================================================================
 # TtlCache tests
 # =============================================================================
@@ -289,6 +481,102 @@ class TestTtlCache:
         # On store, len > max_size triggers expire which removes all
         assert cache.get("a") is None
 
+    def test_eviction_by_soonest_expiry(self):
+        """The ttl policy evicts the entry closest to expiry, not the oldest."""
+        timer = _MockTimer()
+        cache = TtlCache(max_size=2, max_ttl=600, timer=timer)
+        cache.store("long", "1", ttl=500)
+        cache.store("short", "2", ttl=10)
+        cache.store("medium", "3", ttl=100)
+        assert cache.get("short") is None
+        assert cache.get("long") == "1"
+        assert cache.get("medium") == "3"
+
+    def test_restored_key_not_evicted_by_stale_expiry(self):
+        """Re-storing a key supersedes its old expiry entry."""
+        timer = _MockTimer()
+        cache = TtlCache(max_size=2, max_ttl=600, timer=timer)
+        cache.store("a", "old", ttl=10)
+        cache.store("b", "b", ttl=100)
+        cache.store("a", "new", ttl=500)
+        cache.store("c", "c", ttl=200)
+        assert cache.get("a") == "new"
+        assert cache.get("b") is None
+        assert cache.get("c") == "c"
+
+    def test_lru_eviction(self):
+        """The lru policy evicts the least recently read entry."""
+        timer = _MockTimer()
+        cache = TtlCache(max_size=2, max_ttl=600, timer=timer, policy="lru")
+        cache.store("a", "a")
+        cache.store("b", "b")
+        assert cache.get("a") == "a"  # b is now least recently used
+        cache.store("c", "c")
+        assert cache.get("b") is None
+        assert cache.get("a") == "a"
+        assert cache.get("c") == "c"
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            TtlCache(max_size=10, policy="fifo")
+
+    def test_sweep_drops_untouched_expired(self):
+        timer = _MockTimer()
+        cache = TtlCache(max_size=10, max_ttl=600, timer=timer)
+        cache.store("a", "a", ttl=5)
+        cache.store("b", "b", ttl=50)
+        timer.advance(10)
+        assert cache.sweep() == 1
+        assert len(cache) == 1
+        assert cache.get("b") == "b"
+
+    def test_sweep_keeps_live_entries_behind_lazily_deleted_key(self):
+        timer = _MockTimer()
+        cache = TtlCache(max_size=10, max_ttl=600, timer=timer)
+        cache.store("a", "a", ttl=10)
+        cache.store("b", "b", ttl=500)
+        timer.advance(20)
+        assert cache.get("a") is None  # deleted on read, its heap item left behind
+        expirations = cache.expirations
+        cache.store("c", "c")
+        assert cache.get("b") == "b"
+        assert cache.expirations == expirations
+
+    def test_sweep_keeps_live_entries_behind_replaced_key(self):
+        timer = _MockTimer()
+        cache = TtlCache(max_size=10, max_ttl=600, timer=timer)
+        cache.store("a", "a", ttl=10)
+        cache.store("b", "b", ttl=500)
+        cache.store("a", "a2", ttl=300)
+        timer.advance(20)
+        assert cache.sweep() == 0
+        assert (cache.get("a"), cache.get("b")) == ("a2", "b")
+        assert cache.expirations == 0
+
+    def test_store_sweeps_expired(self):
+        """Inserts proactively drop expired entries nobody reads any more."""
+        timer = _MockTimer()
+        cache = TtlCache(max_size=10, max_ttl=600, timer=timer)
+        cache.store("a", "a", ttl=5)
+        timer.advance(10)
+        cache.store("b", "b")
+        assert len(cache) == 1
+
+    def test_expiry_index_stays_bounded(self):
+        """Overwriting the same keys doesn't grow the expiry heap without bound."""
+        cache = TtlCache(max_size=10, max_ttl=600)
+        for i in range(10000):
+            cache.store(i % 5, i)
+        assert len(cache) == 5
+        assert len(cache.expiry) <= 2 * len(cache) + 64
+
+    def test_clear(self):
+        cache = TtlCache(max_size=10)
+        cache.store("a", "b")
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.get("a") is None
+
 
 # =============================================================================
 # make_answer tests
@@ -369,14 +657,19 @@ def https_rr(domain: str, params: list, ttl: int = 300) -> RR:
     return RR(domain, QTYPE.HTTPS, rdata=HTTPS(0, ".", params), ttl=ttl)
 
 
+def _patch_target(ipv4s: list, ipv6s: list, ttl: int = 600):
+    """Replace the ICN patch target snapshot used by patch_response."""
+    from cf_patch_doh.patch_target import PatchTarget
+
+    snapshot = PatchTarget(ipv4s, ipv6s, ttl=ttl, version=1, refreshed_at=0)
+    return patch("cf_patch_doh.dns_utils.PATCH_TARGETS.snapshot", snapshot)
+
+
 class TestPatchResponse:
     """patch_response replaces CF IPs in DNS responses with ICN IPs.
 
-    It depends on:
-      - _get_icn_ips() - fetches current ICN IPs from namu.wiki
-      - fetch_dns()    - fetches DNS records from upstream
-
-    Both are mocked in these tests.
+    It reads the ICN addresses from the PATCH_TARGETS snapshot, which is
+    replaced in these tests, and must never call fetch_dns() itself.
     """
 
     @pytest.mark.asyncio
@@ -401,15 +694,13 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::1"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=600),
-                a_rr("namu.wiki", "203.0.113.2", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         # IPs should be replaced with fetched ICN IPs
         assert len(result.rr) == 2
         assert str(result.rr[0].rdata) == "203.0.113.1"
@@ -436,14 +727,13 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::1"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                aaaa_rr("namu.wiki", "2001:db8::1", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         assert len(result.rr) == 1
         assert str(result.rr[0].rdata) == "2001:db8::1"
 
@@ -471,14 +761,13 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::1"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.10", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         https_rr_result = result.rr[0]
         params = https_rr_result.rdata.params
         # ipv4hint (4) should be replaced with ICN IPs
@@ -501,14 +790,13 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::10"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                aaaa_rr("namu.wiki", "2001:db8::10", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         https_rr_result = result.rr[0]
         ipv6hint_val = dict(https_rr_result.rdata.params)[6]
         assert _unpack_ipv6s(ipv6hint_val) == ["2001:db8::10"]
@@ -523,14 +811,13 @@ class TestPatchResponse:
         ])
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(["203.0.113.1"], ["2001:db8::1"]))),
+            _patch_target(["203.0.113.1"], ["2001:db8::1"], ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         # IPs should remain unchanged since original hints are not CF
         ipv4hint_val = dict(result.rr[0].rdata.params)[4]
         assert _unpack_ipv4s(ipv4hint_val) == ["1.2.3.4"]
@@ -549,14 +836,13 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::1"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         # A record stays unchanged
         assert str(result.rr[0].rdata) == "1.2.3.4"
         # HTTPS hint gets patched
@@ -575,12 +861,11 @@ class TestPatchResponse:
         # Even with ICN IPs available, no fetch_dns should be called
         # since the record has no CF IPs
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips") as mock_icn,
+            _patch_target(["203.0.113.1"], ["2001:db8::1"]),
             patch("cf_patch_doh.dns_utils.fetch_dns") as mock_fetch,
         ):
             result = await patch_response(record)
 
-        mock_icn.assert_not_called()
         mock_fetch.assert_not_called()
         assert result is record  # returned as-is
 
@@ -594,14 +879,13 @@ class TestPatchResponse:
         ]))
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(["203.0.113.1"], []))),
+            _patch_target(["203.0.113.1"], [], ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=600),
-            ]
             result = await patch_response(response)
 
+        mock_fetch.assert_not_called()
+
         params = dict(result.rr[0].rdata.params)
         assert _unpack_ipv4s(params[4]) == ["203.0.113.1"]
 
@@ -613,14 +897,13 @@ class TestPatchResponse:
         ])
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(["203.0.113.1"], []))),
+            _patch_target(["203.0.113.1"], [], ttl=120),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=120),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         assert result.rr[0].ttl == 600  # max(120, 600)
 
     @pytest.mark.asyncio
@@ -631,14 +914,13 @@ class TestPatchResponse:
         ])
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(["203.0.113.1"], []))),
+            _patch_target(["203.0.113.1"], [], ttl=3600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                a_rr("namu.wiki", "203.0.113.1", ttl=3600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         assert result.rr[0].ttl == 3600  # max(3600, 600)
 
     @pytest.mark.asyncio
@@ -654,18 +936,37 @@ class TestPatchResponse:
         fake_icn_v6 = ["2001:db8::1"]
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips", AsyncMock(return_value=(fake_icn_v4, fake_icn_v6))),
+            _patch_target(fake_icn_v4, fake_icn_v6, ttl=600),
             patch("cf_patch_doh.dns_utils.fetch_dns", new_callable=AsyncMock) as mock_fetch,
         ):
-            mock_fetch.return_value = [
-                aaaa_rr("namu.wiki", "2001:db8::1", ttl=600),
-            ]
             result = await patch_response(record)
 
+        mock_fetch.assert_not_called()
+
         params = dict(result.rr[0].rdata.params)
         # IPv4 hint should be unchanged since we have no ICN v4 IPs
         assert _unpack_ipv4s(params[4]) == ["104.16.0.1"]
 
+    @pytest.mark.asyncio
+    async def test_no_target_for_family_is_not_patched(self):
+        """Without a target for the answer's address family, nothing changes and no patched TTL floor applies."""
+        from cf_patch_doh import metrics
+        from cf_patch_doh.dns_utils import patch_record
+
+        decisions = dict(metrics.PATCH_DECISIONS.values)
+        a_record = _build_dns_response("example.com", "A", [a_rr("example.com", "104.16.0.1", ttl=30)])
+        https_record = _build_dns_response("example.com", "HTTPS", [
+            https_rr("example.com", [(4, _pack_ipv4s(["104.16.0.1"]))]),
+        ])
+        with _patch_target([], ["2001:db8::1"]):
+            assert await patch_record(a_record) is False
+            assert await patch_record(https_record) is False
+
+        assert [(str(rr.rdata), rr.ttl) for rr in a_record.rr] == [("104.16.0.1", 30)]
+        assert metrics.PATCH_DECISIONS.values[("untouched",)] == decisions.get(("untouched",), 0) + 2
+        for decision in ("a_aaaa", "https"):
+            assert metrics.PATCH_DECISIONS.values.get((decision,), 0) == decisions.get((decision,), 0)
+
     @pytest.mark.asyncio
     async def test_https_hints_not_cf_should_not_trigger_fetch(self):
         """If HTTPS hints are not CF IPs, no fetch or ICN lookup should happen."""
@@ -676,12 +977,11 @@ class TestPatchResponse:
         ])
 
         with (
-            patch("cf_patch_doh.dns_utils._get_icn_ips") as mock_icn,
+            _patch_target(["203.0.113.1"], ["2001:db8::1"]),
             patch("cf_patch_doh.dns_utils.fetch_dns") as mock_fetch,
         ):
             result = await patch_response(record)
 
-        mock_icn.assert_not_called()
         mock_fetch.assert_not_called()
         assert result is record
 
@@ -699,7 +999,7 @@ class TestCacheIntegration:
         """Clear the global cache before each test."""
         from cf_patch_doh.dns_utils import CACHED_QUERY
 
-        CACHED_QUERY.storage.clear()
+        CACHED_QUERY.clear()
         yield
 
     @pytest.mark.asyncio
@@ -709,9 +1009,9 @@ class TestCacheIntegration:
         fake_response.add_answer(a_rr("example.com", "1.2.3.4", ttl=300))
 
         with patch(
-            "cf_patch_doh.dns_utils.httpx.AsyncClient",
+            "cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get",
         ) as mock_client:
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(
+            mock_client.return_value.post = AsyncMock(
                 return_value=MockResponse(bytes(fake_response.pack())),
             )
 
@@ -722,10 +1022,10 @@ class TestCacheIntegration:
             assert str(result1[0].rdata) == "1.2.3.4"
 
             # Second call should use cache, not hit the network
-            mock_client.return_value.__aenter__.return_value.post.reset_mock()
+            mock_client.return_value.post.reset_mock()
             result2 = await fetch_dns("example.com", "A", "https://upstream.test/dns-query")
             assert len(result2) == 1
-            mock_client.return_value.__aenter__.return_value.post.assert_not_called()
+            mock_client.return_value.post.assert_not_called()
 
     @pytest.mark.asyncio
     async def test_fetch_dns_different_upstream_different_cache(self):
@@ -738,24 +1038,1950 @@ class TestCacheIntegration:
         from cf_patch_doh.dns_utils import fetch_dns
 
         with patch(
-            "cf_patch_doh.dns_utils.httpx.AsyncClient",
+            "cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get",
         ) as mock_client:
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(
+            mock_client.return_value.post = AsyncMock(
                 return_value=MockResponse(bytes(fake_response1.pack())),
             )
             r1 = await fetch_dns("example.com", "A", "https://upstream1.test/dns-query")
             assert str(r1[0].rdata) == "1.2.3.4"
 
         with patch(
-            "cf_patch_doh.dns_utils.httpx.AsyncClient",
+            "cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get",
         ) as mock_client:
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(
+            mock_client.return_value.post = AsyncMock(
                 return_value=MockResponse(bytes(fake_response2.pack())),
             )
             r2 = await fetch_dns("example.com", "A", "https://upstream2.test/dns-query")
             assert str(r2[0].rdata) == "5.6.7.8"
 
 
+# =============================================================================
+# Upstream client pool tests
+# =============================================================================
+
+
+class TestUpstreamClients:
+    """UpstreamClients keeps one pooled client per upstream URL."""
+
+    @pytest.mark.asyncio
+    async def test_client_reused_per_upstream(self):
+        clients = UpstreamClients()
+        a = clients.get("https://a.test/dns-query")
+        assert clients.get("https://a.test/dns-query") is a
+        assert clients.get("https://b.test/dns-query") is not a
+        assert len(clients) == 2
+        await clients.aclose()
+        assert a.is_closed
+
+    @pytest.mark.asyncio
+    async def test_idle_upstream_evicted(self):
+        timer = _MockTimer()
+        clients = UpstreamClients(idle_timeout=60, timer=timer)
+        idle = clients.get("https://idle.test/dns-query")
+        timer.advance(50)
+        clients.get("https://busy.test/dns-query")
+        timer.advance(20)
+
+        assert await clients.evict_idle() == 1
+        assert "https://idle.test/dns-query" not in clients
+        assert "https://busy.test/dns-query" in clients
+        assert idle.is_closed
+        await clients.aclose()
+
+    @pytest.mark.asyncio
+    async def test_max_clients_evicts_least_recently_used(self):
+        timer = _MockTimer()
+        clients = UpstreamClients(max_clients=2, timer=timer)
+        first = clients.get("https://a.test/dns-query")
+        timer.advance(1)
+        clients.get("https://b.test/dns-query")
+        timer.advance(1)
+        clients.get("https://a.test/dns-query")
+        timer.advance(1)
+        clients.get("https://c.test/dns-query")
+
+        assert "https://b.test/dns-query" not in clients
+        assert clients.get("https://a.test/dns-query") is first
+        assert len(clients) == 2
+        await asyncio.sleep(0)
+        await clients.aclose()
+
+    @pytest.mark.asyncio
+    async def test_closed_client_recreated(self):
+        clients = UpstreamClients()
+        a = clients.get("https://a.test/dns-query")
+        await a.aclose()
+        assert clients.get("https://a.test/dns-query") is not a
+        await clients.aclose()
+
+
+class TestSingleFlight:
+    """Concurrent fetch_dns misses for one key share a single upstream query."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        from cf_patch_doh.dns_utils import CACHED_QUERY
+
+        CACHED_QUERY.clear()
+        yield
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_coalesced(self):
+        import asyncio
+
+        from cf_patch_doh.dns_utils import INFLIGHT_QUERIES, fetch_dns
+
+        fake_response = DNSRecord.question("example.com").reply()
+        fake_response.add_answer(a_rr("example.com", "1.2.3.4", ttl=300))
+        release = asyncio.Event()
+
+        async def slow_post(*args, **kwargs):
+            await release.wait()
+            return MockResponse(bytes(fake_response.pack()))
+
+        originated = INFLIGHT_QUERIES.originated
+        coalesced = INFLIGHT_QUERIES.coalesced
+        with patch("cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get") as mock_client:
+            mock_client.return_value.post = AsyncMock(side_effect=slow_post)
+            lookups = [
+                asyncio.ensure_future(fetch_dns("example.com", "A", "https://upstream.test/dns-query"))
+                for _ in range(5)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*lookups)
+
+        assert mock_client.return_value.post.await_count == 1
+        assert all(str(r[0].rdata) == "1.2.3.4" for r in results)
+        assert INFLIGHT_QUERIES.originated - originated == 1
+        assert INFLIGHT_QUERIES.coalesced - coalesced == 4
+        assert len(INFLIGHT_QUERIES) == 0
+
+    @pytest.mark.asyncio
+    async def test_error_propagates_to_all_waiters(self):
+        import asyncio
+
+        from cf_patch_doh.upstream import SingleFlight
+
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise RuntimeError("upstream down")
+
+        waiters = [asyncio.ensure_future(flight.do("key", failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert len(flight) == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_does_not_cancel_others(self):
+        import asyncio
+
+        from cf_patch_doh.upstream import SingleFlight
+
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def lookup():
+            await release.wait()
+            return "answer"
+
+        first = asyncio.ensure_future(flight.do("key", lookup))
+        second = asyncio.ensure_future(flight.do("key", lookup))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == "answer"
+        assert first.cancelled()
+
+
+# =============================================================================
+# Wire-format answer cache tests
+# =============================================================================
+
+
+class TestWireAnswer:
+    """WireAnswer replays a packed answer with the query's ID and decayed TTLs."""
+
+    def _packed_answer(self, query: DNSRecord) -> bytes:
+        answer = make_answer(query, [
+            RR("www.example.com", QTYPE.CNAME, rdata=dnslib.CNAME("example.com"), ttl=600),
+            a_rr("example.com", "1.2.3.4", ttl=300),
+        ])
+        return bytes(answer.pack())
+
+    def test_render_rewrites_id_and_ttl(self):
+        from cf_patch_doh.wire import WireAnswer
+
+        first = DNSRecord.question("www.example.com")
+        cached = WireAnswer(self._packed_answer(first))
+        assert cached.min_ttl == 300
+
+        query = DNSRecord.question("www.example.com")
+        query.header.id = 4242
+        reply = DNSRecord.parse(cached.render(bytes(query.pack()), elapsed=100))
+        assert reply.header.id == 4242
+        assert reply.header.qr == 1
+        assert [rr.ttl for rr in reply.rr] == [500, 200]
+        assert str(reply.rr[1].rdata) == "1.2.3.4"
+
+    def test_render_ttl_never_negative(self):
+        from cf_patch_doh.wire import WireAnswer
+
+        query = DNSRecord.question("www.example.com")
+        cached = WireAnswer(self._packed_answer(query))
+        reply = DNSRecord.parse(cached.render(bytes(query.pack()), elapsed=1000))
+        assert [rr.ttl for rr in reply.rr] == [0, 0]
+
+    def test_render_copies_query_flags_and_case(self):
+        from cf_patch_doh.wire import WireAnswer
+
+        cached = WireAnswer(self._packed_answer(DNSRecord.question("www.example.com")))
+        query = DNSRecord.question("WwW.ExAmPlE.cOm")
+        query.header.rd = 0
+        query.header.cd = 1
+        reply = DNSRecord.parse(cached.render(bytes(query.pack())))
+        assert str(reply.q.qname) == "WwW.ExAmPlE.cOm."
+        assert reply.header.rd == 0
+        assert reply.header.cd == 1
+        assert reply.header.ra == 1
+
+    def test_question_requires_single_question(self):
+        from cf_patch_doh.wire import WireError, question
+
+        with pytest.raises(WireError):
+            question(b"\x00" * 5)
+        packed = bytearray(DNSRecord.question("example.com").pack())
+        packed[5] = 2  # QDCOUNT
+        with pytest.raises(WireError):
+            question(bytes(packed))
+
+
+class TestWireCache:
+    """resolve() serves repeat queries from packed answers."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        from cf_patch_doh.dns_utils import CACHED_ANSWER, CACHED_QUERY
+
+        CACHED_QUERY.clear()
+        CACHED_ANSWER.clear()
+        yield
+
+    @pytest.mark.asyncio
+    async def test_hit_skips_record_pipeline(self):
+        from cf_patch_doh import app
+
+        query = DNSRecord.question("example.com")
+        response = make_answer(query, [a_rr("example.com", "1.2.3.4", ttl=300)])
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=response)) as mock_get:
+            await app.resolve(bytes(query.pack()))
+            again = DNSRecord.question("EXAMPLE.com")
+            again.header.id = 7
+            reply = DNSRecord.parse(await app.resolve(bytes(again.pack())))
+
+        mock_get.assert_awaited_once()
+        assert reply.header.id == 7
+        assert str(reply.rr[0].rdata) == "1.2.3.4"
+
+    @pytest.mark.asyncio
+    async def test_upstreams_cached_separately(self):
+        from cf_patch_doh import app
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        response = make_answer(DNSRecord.parse(query), [a_rr("example.com", "1.2.3.4")])
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=response)) as mock_get:
+            await app.resolve(query)
+            await app.resolve(query, "https://other.test/dns-query")
+
+        assert mock_get.await_count == 2
+
+    def test_key_keeps_type_and_class_case(self):
+        from dnslib import DNSQuestion
+
+        from cf_patch_doh.dns_utils import wire_cache_key
+
+        # HTTPS is type 0x0041 ('A'), TYPE97 is 0x0061 ('a').
+        https = bytes(DNSRecord.question("Example.com", "HTTPS").pack())
+        type97 = bytes(DNSRecord(q=DNSQuestion("example.com", 97)).pack())
+        assert wire_cache_key(https, "u") != wire_cache_key(type97, "u")
+        lower = bytes(DNSRecord.question("example.com", "HTTPS").pack())
+        assert wire_cache_key(https, "u") == wire_cache_key(lower, "u")
+
+    @pytest.mark.asyncio
+    async def test_ttl_decays_on_hit(self):
+        from cf_patch_doh import app
+        from cf_patch_doh.dns_utils import CACHED_ANSWER
+
+        timer = _MockTimer()
+        query = bytes(DNSRecord.question("example.com").pack())
+        response = make_answer(DNSRecord.parse(query), [a_rr("example.com", "1.2.3.4", ttl=300)])
+        with (
+            patch.object(CACHED_ANSWER, "timer", timer),
+            patch("cf_patch_doh.app.get_record", AsyncMock(return_value=response)),
+        ):
+            await app.resolve(query)
+            timer.advance(42)
+            reply = DNSRecord.parse(await app.resolve(query))
+
+        assert reply.rr[0].ttl == 258
+
+
+# =============================================================================
+# TTL decay and policy tests
+# =============================================================================
+
+
+class TestTtlDecay:
+    """Cached answers are served with their remaining TTL."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        from cf_patch_doh.dns_utils import CACHED_QUERY
+
+        CACHED_QUERY.clear()
+        yield
+
+    def test_get_cache_decays_ttl(self):
+        from cf_patch_doh.dns_utils import CACHED_QUERY, get_cache, store_cache
+
+        timer = _MockTimer()
+        with patch.object(CACHED_QUERY, "timer", timer):
+            store_cache("example.com", "A", "https://upstream.test/dns-query", [
+                RR("example.com", QTYPE.CNAME, rdata=dnslib.CNAME("cdn.example.com"), ttl=900),
+                a_rr("cdn.example.com", "1.2.3.4", ttl=300),
+            ])
+            timer.advance(100)
+            rrs = get_cache("example.com", "A", "https://upstream.test/dns-query")
+
+        assert [rr.ttl for rr in rrs] == [800, 200]
+
+    def test_get_cache_returns_copies(self):
+        from cf_patch_doh.dns_utils import get_cache, store_cache
+
+        original = a_rr("example.com", "1.2.3.4", ttl=300)
+        store_cache("example.com", "A", "https://upstream.test/dns-query", [original])
+        rrs = get_cache("example.com", "A", "https://upstream.test/dns-query")
+        rrs[0].ttl = 1
+        assert original.ttl == 300
+
+    def test_entry_expires_with_shortest_ttl(self):
+        from cf_patch_doh.dns_utils import CACHED_QUERY, get_cache, store_cache
+
+        timer = _MockTimer()
+        with patch.object(CACHED_QUERY, "timer", timer):
+            store_cache("example.com", "A", "https://upstream.test/dns-query", [
+                RR("example.com", QTYPE.CNAME, rdata=dnslib.CNAME("cdn.example.com"), ttl=60),
+                a_rr("cdn.example.com", "1.2.3.4", ttl=300),
+            ])
+            timer.advance(61)
+            assert get_cache("example.com", "A", "https://upstream.test/dns-query") is None
+
+    def test_clamp_ttl_policies(self):
+        from cf_patch_doh import dns_utils
+
+        with (
+            patch.object(dns_utils, "UNPATCHED_TTL_FLOOR", 30),
+            patch.object(dns_utils, "UNPATCHED_TTL_CEILING", 3600),
+            patch.object(dns_utils, "PATCHED_TTL_FLOOR", 600),
+            patch.object(dns_utils, "PATCHED_TTL_CEILING", 1800),
+        ):
+            assert dns_utils.clamp_ttl(5) == 30
+            assert dns_utils.clamp_ttl(7200) == 3600
+            assert dns_utils.clamp_ttl(300) == 300
+            assert dns_utils.clamp_ttl(5, patched=True) == 600
+            assert dns_utils.clamp_ttl(7200, patched=True) == 1800
+
+    @pytest.mark.asyncio
+    async def test_patch_does_not_mutate_shared_https_rdata(self):
+        https = https_rr("example.com", [(4, _pack_ipv4s(["104.16.0.1"]))])
+        shared_rdata = https.rdata
+        record = _build_dns_response("example.com", "HTTPS", [https])
+
+        with _patch_target(["203.0.113.1"], []):
+            await patch_response(record)
+
+        assert _unpack_ipv4s(dict(shared_rdata.params)[4]) == ["104.16.0.1"]
+        assert _unpack_ipv4s(dict(record.rr[0].rdata.params)[4]) == ["203.0.113.1"]
+
+
+# =============================================================================
+# Negative caching tests
+# =============================================================================
+
+
+def soa_rr(zone: str, ttl: int = 3600, minimum: int = 300) -> RR:
+    return RR(zone, QTYPE.SOA, rdata=dnslib.SOA(
+        "ns." + zone, "admin." + zone, (1, 7200, 900, 1209600, minimum),
+    ), ttl=ttl)
+
+
+class TestNegativeCache:
+    """NXDOMAIN/NODATA answers are cached with the SOA minimum as TTL."""
+
+    UPSTREAM = "https://upstream.test/dns-query"
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        from cf_patch_doh.dns_utils import CACHED_NEGATIVE, CACHED_QUERY
+
+        CACHED_QUERY.clear()
+        CACHED_NEGATIVE.clear()
+        yield
+
+    def _upstream_reply(self, domain: str, qtype: str, rcode: int, auth: list) -> bytes:
+        response = DNSRecord.question(domain, qtype).reply()
+        response.header.rcode = rcode
+        for rr in auth:
+            response.add_auth(rr)
+        return bytes(response.pack())
+
+    @pytest.mark.asyncio
+    async def test_nxdomain_cached_with_rcode_and_soa(self):
+        from cf_patch_doh.app import get_record
+
+        query = bytes(DNSRecord.question("missing.example.com", "A").pack())
+        reply = self._upstream_reply("missing.example.com", "A", dnslib.RCODE.NXDOMAIN, [
+            soa_rr("example.com", ttl=3600, minimum=300),
+        ])
+        with patch("cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get") as mock_client:
+            mock_client.return_value.post = AsyncMock(return_value=MockResponse(reply))
+            first = await get_record(query, self.UPSTREAM)
+            second = await get_record(query, self.UPSTREAM)
+
+        assert mock_client.return_value.post.await_count == 1
+        for answer in (first, second):
+            assert answer.header.rcode == dnslib.RCODE.NXDOMAIN
+            assert answer.rr == []
+            assert answer.auth[0].rtype == QTYPE.SOA
+        assert first.auth[0].ttl == 300  # min(SOA TTL, SOA minimum)
+
+    @pytest.mark.asyncio
+    async def test_nodata_served_from_cache(self):
+        from cf_patch_doh.dns_utils import fetch_dns
+
+        reply = self._upstream_reply("v4only.example.com", "AAAA", dnslib.RCODE.NOERROR, [
+            soa_rr("example.com", ttl=60, minimum=300),
+        ])
+        with patch("cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get") as mock_client:
+            mock_client.return_value.post = AsyncMock(return_value=MockResponse(reply))
+            assert await fetch_dns("v4only.example.com", "AAAA", self.UPSTREAM) == []
+            assert await fetch_dns("v4only.example.com", "AAAA", self.UPSTREAM) == []
+
+        assert mock_client.return_value.post.await_count == 1
+
+    def test_negative_ttl_expires(self):
+        from cf_patch_doh.dns_utils import CACHED_NEGATIVE, get_negative_cache, store_negative_cache
+
+        timer = _MockTimer()
+        with patch.object(CACHED_NEGATIVE, "timer", timer):
+            store_negative_cache("a.example.com", "A", self.UPSTREAM, dnslib.RCODE.NXDOMAIN, [
+                soa_rr("example.com", ttl=3600, minimum=120),
+            ])
+            timer.advance(100)
+            rcode, auth = get_negative_cache("a.example.com", "A", self.UPSTREAM)
+            assert rcode == dnslib.RCODE.NXDOMAIN
+            assert auth[0].ttl == 20
+            timer.advance(21)
+            assert get_negative_cache("a.example.com", "A", self.UPSTREAM) is None
+
+    def test_no_soa_not_cached(self):
+        from cf_patch_doh.dns_utils import get_negative_cache, store_negative_cache
+
+        store_negative_cache("a.example.com", "A", self.UPSTREAM, dnslib.RCODE.NXDOMAIN, [])
+        assert get_negative_cache("a.example.com", "A", self.UPSTREAM) is None
+
+    @pytest.mark.asyncio
+    async def test_servfail_not_cached(self):
+        from cf_patch_doh.app import get_record
+
+        query = bytes(DNSRecord.question("broken.example.com", "A").pack())
+        reply = self._upstream_reply("broken.example.com", "A", dnslib.RCODE.SERVFAIL, [])
+        with patch("cf_patch_doh.dns_utils.UPSTREAM_CLIENTS.get") as mock_client:
+            mock_client.return_value.post = AsyncMock(return_value=MockResponse(reply))
+            answer = await get_record(query, self.UPSTREAM)
+            await get_record(query, self.UPSTREAM)
+
+        assert answer.header.rcode == dnslib.RCODE.SERVFAIL
+        assert mock_client.return_value.post.await_count == 2
+
+    def test_make_answer_preserves_rcode(self):
+        record = DNSRecord.question("missing.example.com")
+        answer = make_answer(record, [], rcode=dnslib.RCODE.NXDOMAIN, auth=[soa_rr("example.com")])
+        assert answer.header.rcode == dnslib.RCODE.NXDOMAIN
+        assert len(answer.auth) == 1
+
+
+# =============================================================================
+# Patch target tests
+# =============================================================================
+
+
+class TestPatchTargets:
+    """PatchTargets keeps a last-known-good snapshot of the ICN addresses."""
+
+    def _resolver(self, answers: dict):
+        async def resolve(domain, type_):
+            result = answers[type_]
+            if isinstance(result, Exception):
+                raise result
+            return _build_dns_response(domain, type_, result)
+        return resolve
+
+    @pytest.mark.asyncio
+    async def test_refresh(self):
+        from cf_patch_doh.patch_target import PatchTargets
+
+        targets = PatchTargets(self._resolver({
+            "A": [a_rr("namu.wiki", "203.0.113.1", ttl=300), a_rr("namu.wiki", "203.0.113.2", ttl=200)],
+            "AAAA": [aaaa_rr("namu.wiki", "2001:db8::1", ttl=400)],
+        }), hostname="namu.wiki", timer=_MockTimer())
+        assert not targets.snapshot
+        assert await targets.refresh() is True
+        assert targets.snapshot.ipv4s == ("203.0.113.1", "203.0.113.2")
+        assert targets.snapshot.ipv6s == ("2001:db8::1",)
+        assert targets.snapshot.ttl == 200
+        assert targets.snapshot.version == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_refresh_keeps_last_known_good(self):
+        from cf_patch_doh.patch_target import PatchTargets
+
+        answers = {"A": [a_rr("namu.wiki", "203.0.113.1")], "AAAA": []}
+        targets = PatchTargets(self._resolver(answers), timer=_MockTimer())
+        await targets.refresh()
+        good = targets.snapshot
+
+        answers["A"] = RuntimeError("upstream down")
+        assert await targets.refresh() is False
+        assert targets.snapshot is good
+
+        answers["A"] = []
+        assert await targets.refresh() is False
+        assert targets.snapshot is good
+
+    @pytest.mark.asyncio
+    async def test_version_changes_only_with_addresses(self):
+        from cf_patch_doh.patch_target import PatchTargets
+
+        answers = {"A": [a_rr("namu.wiki", "203.0.113.1")], "AAAA": []}
+        targets = PatchTargets(self._resolver(answers), timer=_MockTimer())
+        await targets.refresh()
+        await targets.refresh()
+        assert targets.snapshot.version == 1
+        answers["A"] = [a_rr("namu.wiki", "203.0.113.9")]
+        await targets.refresh()
+        assert targets.snapshot.version == 2
+
+    @pytest.mark.asyncio
+    async def test_version_ignores_address_order(self):
+        from cf_patch_doh.patch_target import PatchTargets
+
+        answers = {"A": [a_rr("namu.wiki", "203.0.113.1"), a_rr("namu.wiki", "203.0.113.2")], "AAAA": []}
+        targets = PatchTargets(self._resolver(answers), timer=_MockTimer())
+        await targets.refresh()
+        answers["A"].reverse()
+        await targets.refresh()
+        assert targets.snapshot.ipv4s == ("203.0.113.2", "203.0.113.1")
+        assert targets.snapshot.version == 1
+
+    @pytest.mark.asyncio
+    async def test_health(self):
+        from cf_patch_doh.patch_target import PatchTargets
+
+        timer = _MockTimer()
+        answers = {"A": RuntimeError("upstream down"), "AAAA": []}
+        targets = PatchTargets(self._resolver(answers), max_age=60, timer=timer)
+        await targets.refresh()
+        assert targets.health()[0] is False
+
+        answers["A"] = [a_rr("namu.wiki", "203.0.113.1")]
+        await targets.refresh()
+        assert targets.health() == (True, "OK")
+
+        timer.advance(61)
+        assert targets.health()[0] is False
+
+    @pytest.mark.asyncio
+    async def test_missing_family_left_unpatched(self):
+        """Without IPv6 targets, CF AAAA records are kept rather than dropped."""
+        record = _build_dns_response("example.com", "AAAA", [
+            aaaa_rr("example.com", "2606:4700::1"),
+        ])
+        with _patch_target(["203.0.113.1"], []):
+            result = await patch_response(record)
+        assert [str(rr.rdata) for rr in result.rr] == ["2606:4700::1"]
+
+
+class TestDnsServer:
+    """The Do53 listeners share resolve() and handle truncation and EDNS."""
+
+    @staticmethod
+    def _query(domain: str, id_: int = 1, edns: int | None = None) -> bytes:
+        query = DNSRecord.question(domain)
+        query.header.id = id_
+        if edns is not None:
+            query.add_ar(dnslib.EDNS0(udp_len=edns))
+        return bytes(query.pack())
+
+    @staticmethod
+    async def _resolve(query: bytes) -> bytes:
+        record = DNSRecord.parse(query)
+        domain = str(record.q.qname).rstrip(".")
+        if domain == "fail.example":
+            raise RuntimeError("upstream down")
+        if domain == "slow.example":
+            await asyncio.sleep(0.2)
+        count = 60 if domain == "big.example" else 1
+        rrs = [a_rr(domain, f"10.0.{i // 256}.{i % 256}") for i in range(count)]
+        return bytes(make_answer(record, rrs).pack())
+
+    def test_edns_payload_size(self):
+        from cf_patch_doh.wire import edns_payload_size
+
+        assert edns_payload_size(self._query("example.com")) is None
+        assert edns_payload_size(self._query("example.com", edns=4096)) == 4096
+
+    def test_fit_udp_truncates_without_edns(self):
+        from cf_patch_doh.dns_server import fit_udp
+
+        query = self._query("big.example", id_=7)
+        reply = asyncio.run(self._resolve(query))
+        assert len(reply) > 512
+        truncated = DNSRecord.parse(fit_udp(query, reply))
+        assert truncated.header.tc == 1
+        assert truncated.header.id == 7
+        assert str(truncated.q.qname) == "big.example."
+        assert truncated.rr == []
+
+    def test_fit_udp_honours_edns_size(self):
+        from cf_patch_doh.dns_server import fit_udp
+
+        query = self._query("big.example", edns=4096)
+        reply = asyncio.run(self._resolve(query))
+        assert 512 < len(reply) <= 1232
+        assert fit_udp(query, reply) == reply
+
+    @pytest.mark.asyncio
+    async def test_answer_query_errors(self):
+        from cf_patch_doh.dns_server import answer_query
+
+        reply = DNSRecord.parse(await answer_query(self._resolve, self._query("fail.example", id_=9)))
+        assert reply.header.id == 9
+        assert reply.header.rcode == dnslib.RCODE.SERVFAIL
+
+        garbage = b"\x00\x05" + b"\x00" * 10 + b"\x3f"
+        reply = DNSRecord.parse(await answer_query(self._resolve, garbage))
+        assert reply.header.id == 5
+        assert reply.header.rcode == dnslib.RCODE.FORMERR
+        assert await answer_query(self._resolve, b"\x00") is None
+
+    @pytest.mark.asyncio
+    async def test_answer_query_drops_responses(self):
+        from cf_patch_doh.dns_server import answer_query
+
+        resolve = AsyncMock(side_effect=self._resolve)
+        response = DNSRecord.question("example.com").reply().pack()
+        assert await answer_query(resolve, bytes(response)) is None
+        assert await answer_query(resolve, bytes(response[:12])) is None
+        resolve.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_answer_query_echoes_opt(self):
+        from cf_patch_doh.dns_server import answer_query
+
+        reply = DNSRecord.parse(await answer_query(self._resolve, self._query("example.com", edns=4096)))
+        opt = [rr for rr in reply.ar if rr.rtype == QTYPE.OPT]
+        assert len(opt) == 1
+        assert opt[0].rclass == 1232
+
+    @pytest.mark.asyncio
+    async def test_workers_share_the_port(self):
+        from cf_patch_doh.dns_server import DnsServers, REUSE_PORT
+
+        if not REUSE_PORT:
+            pytest.skip("SO_REUSEPORT is not available")
+        first, second = DnsServers(self._resolve), DnsServers(self._resolve)
+        await first.start("127.0.0.1", 0)
+        try:
+            await second.start("127.0.0.1", first.port)
+            assert second.port == first.port
+        finally:
+            await second.close()
+            await first.close()
+
+    @pytest.mark.asyncio
+    async def test_udp_round_trip(self):
+        from cf_patch_doh.dns_server import DnsServers
+
+        servers = DnsServers(self._resolve)
+        await servers.start("127.0.0.1", 0)
+        try:
+            loop = asyncio.get_running_loop()
+            replies = loop.create_future()
+
+            class Client(asyncio.DatagramProtocol):
+                def datagram_received(self, data, addr):
+                    replies.set_result(data)
+
+            transport, _ = await loop.create_datagram_endpoint(
+                Client, remote_addr=("127.0.0.1", servers.port))
+            transport.sendto(self._query("example.com", id_=11))
+            reply = DNSRecord.parse(await asyncio.wait_for(replies, 5))
+            transport.close()
+        finally:
+            await servers.close()
+        assert reply.header.id == 11
+        assert [str(rr.rdata) for rr in reply.rr] == ["10.0.0.0"]
+
+    @pytest.mark.asyncio
+    async def test_tcp_pipelining_out_of_order(self):
+        from cf_patch_doh.dns_server import DnsServers
+
+        servers = DnsServers(self._resolve)
+        await servers.start("127.0.0.1", 0)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", servers.port)
+            for id_, domain in ((1, "slow.example"), (2, "big.example")):
+                query = self._query(domain, id_=id_)
+                writer.write(struct.pack("!H", len(query)) + query)
+            await writer.drain()
+
+            ids = []
+            for _ in range(2):
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                reply = DNSRecord.parse(await reader.readexactly(length))
+                ids.append(reply.header.id)
+                if reply.header.id == 2:
+                    assert reply.header.tc == 0
+                    assert len(reply.rr) == 60
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            await servers.close()
+        assert ids == [2, 1]
+
+
+class TestDotServer:
+    """DoT reuses one TLS connection for many pipelined queries."""
+
+    @pytest.fixture
+    def tls_files(self, tmp_path):
+        openssl = shutil.which("openssl")
+        if openssl is None:
+            pytest.skip("openssl is needed to make a self-signed certificate")
+        cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+        subprocess.run([
+            openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert),
+        ], check=True, capture_output=True)
+        return str(cert), str(key)
+
+    @pytest.mark.asyncio
+    async def test_many_queries_one_connection(self, tls_files):
+        import ssl
+
+        from cf_patch_doh.dns_server import DotServer, make_tls_context
+
+        server = DotServer(TestDnsServer._resolve, make_tls_context(*tls_files))
+        await server.start("127.0.0.1", 0)
+        try:
+            client_context = ssl.create_default_context(cafile=tls_files[0])
+            client_context.set_alpn_protocols(["dot"])
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", server.port, ssl=client_context, server_hostname="localhost")
+            assert writer.get_extra_info("ssl_object").selected_alpn_protocol() == "dot"
+
+            queries = [TestDnsServer._query("slow.example", id_=1000)]
+            queries += [TestDnsServer._query(f"host{i}.example", id_=i) for i in range(200)]
+            writer.write(b"".join(struct.pack("!H", len(query)) + query for query in queries))
+            await writer.drain()
+
+            ids = []
+            for _ in queries:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                ids.append(DNSRecord.parse(await reader.readexactly(length)).header.id)
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            await server.close()
+        assert sorted(ids) == sorted([1000] + list(range(200)))
+        assert ids[-1] == 1000
+        assert server.tcp.queries == 201
+
+
+class TestDohGet:
+    """GET /dns-query decodes base64url correctly and sets Cache-Control."""
+
+    @pytest.fixture
+    def client(self):
+        from starlette.testclient import TestClient
+
+        from cf_patch_doh.app import app
+
+        return TestClient(app)
+
+    @staticmethod
+    def _encode(query: bytes) -> str:
+        return base64.urlsafe_b64encode(query).decode().rstrip("=")
+
+    def test_decode_base64url(self):
+        from cf_patch_doh.wire import WireError, decode_base64url
+
+        for size in range(12, 20):
+            data = bytes(range(250, 256)) * 4
+            data = data[:size]
+            assert decode_base64url(self._encode(data)) == data
+            assert decode_base64url(base64.urlsafe_b64encode(data).decode()) == data
+        with pytest.raises(WireError):
+            decode_base64url("ab+/")
+        with pytest.raises(WireError):
+            decode_base64url("a")
+
+    def test_check_query(self):
+        from cf_patch_doh.wire import WireError, check_query
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        assert check_query(query) == query
+        with pytest.raises(WireError):
+            check_query(query[:11])
+        with pytest.raises(WireError):
+            check_query(bytes(DNSRecord.question("example.com").reply().pack()))
+        missing = bytearray(query)
+        missing[11] = 1  # an additional record that isn't there
+        with pytest.raises(WireError):
+            check_query(bytes(missing))
+
+    def test_get_answer_with_max_age(self, client):
+        query = DNSRecord.question("example.com")
+        answer = make_answer(query, [a_rr("example.com", "1.2.3.4", ttl=120), a_rr("example.com", "1.2.3.5", ttl=60)])
+        with patch("cf_patch_doh.app.resolve", AsyncMock(return_value=bytes(answer.pack()))) as mock_resolve:
+            response = client.get("/dns-query", params={"dns": self._encode(bytes(query.pack()))})
+
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == "max-age=60"
+        assert mock_resolve.await_args.args[0] == bytes(query.pack())
+
+    def test_get_without_records_has_no_max_age(self, client):
+        query = DNSRecord.question("example.com")
+        answer = make_answer(query, [], rcode=dnslib.RCODE.SERVFAIL)
+        with patch("cf_patch_doh.app.resolve", AsyncMock(return_value=bytes(answer.pack()))):
+            response = client.get("/dns-query", params={"dns": self._encode(bytes(query.pack()))})
+        assert response.status_code == 200
+        assert "cache-control" not in response.headers
+
+    def test_invalid_queries_rejected(self, client):
+        with patch("cf_patch_doh.app.resolve", AsyncMock()) as mock_resolve:
+            assert client.get("/dns-query").status_code == 400
+            assert client.get("/dns-query", params={"dns": "not base64!"}).status_code == 400
+            assert client.get("/dns-query", params={"dns": self._encode(b"\x00" * 5)}).status_code == 400
+            response = client.post(
+                "/dns-query", content=b"\x00" * 5, headers={"content-type": "application/dns-message"})
+            assert response.status_code == 400
+        mock_resolve.assert_not_awaited()
+
+
+class TestRawAsgi:
+    """The raw ASGI DoH handler answers exactly like the FastAPI route."""
+
+    REQUESTS = [
+        ("GET", "/dns-query?dns={query}", {}, None),
+        ("GET", "/dns-query/https%3A%2F%2Fdns.test%2Fdns-query?dns={query}", {}, None),
+        ("GET", "/dns-query", {}, None),
+        ("GET", "/dns-query?dns=not+base64!", {}, None),
+        ("POST", "/dns-query", {"content-type": "application/dns-message"}, "query"),
+        ("POST", "/dns-query/https://dns.test/dns-query", {"accept": "application/dns-message"}, "query"),
+        ("POST", "/dns-query", {"content-type": "text/plain"}, "query"),
+        ("POST", "/dns-query", {"content-type": "application/dns-message"}, "garbage"),
+        ("PUT", "/dns-query", {}, None),
+        ("GET", "/health", {}, None),
+    ]
+
+    @staticmethod
+    async def _fetch(asgi_app, method, url, headers, content):
+        import httpx
+
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.request(method, url, headers=headers, content=content)
+
+    @pytest.mark.asyncio
+    async def test_same_responses_as_fastapi(self):
+        from cf_patch_doh.app import app as fastapi_app
+        from cf_patch_doh.asgi import app as raw_app
+
+        query = DNSRecord.question("example.com")
+        packed = bytes(query.pack())
+        encoded = base64.urlsafe_b64encode(packed).decode().rstrip("=")
+        answer = bytes(make_answer(query, [a_rr("example.com", "1.2.3.4", ttl=77)]).pack())
+        bodies = {None: None, "query": packed, "garbage": b"\x00" * 5}
+
+        for method, url, headers, body in self.REQUESTS:
+            url = url.format(query=encoded)
+            responses = []
+            for asgi_app in (fastapi_app, raw_app):
+                with patch("cf_patch_doh.app.resolve", AsyncMock(return_value=answer)) as mock_resolve:
+                    response = await self._fetch(asgi_app, method, url, headers, bodies[body])
+                responses.append((
+                    response.status_code,
+                    response.content,
+                    response.headers.get("content-type"),
+                    response.headers.get("cache-control"),
+                    mock_resolve.await_args.args if mock_resolve.await_args else None,
+                ))
+            assert responses[0] == responses[1], (method, url)
+
+    @pytest.mark.asyncio
+    async def test_unparseable_records_rejected(self):
+        from cf_patch_doh.app import app as fastapi_app
+        from cf_patch_doh.asgi import app as raw_app
+
+        # Well framed, but the additional A record has three bytes of address.
+        query = bytearray(DNSRecord.question("malformed.example").pack())
+        query[11] = 1
+        query += b"\x00\x00\x01\x00\x01\x00\x00\x00\x10\x00\x03abc"
+        encoded = base64.urlsafe_b64encode(bytes(query)).decode().rstrip("=")
+        for asgi_app in (fastapi_app, raw_app):
+            response = await self._fetch(asgi_app, "GET", f"/dns-query?dns={encoded}", {}, None)
+            assert response.status_code == 400
+            response = await self._fetch(
+                asgi_app, "POST", "/dns-query", {"content-type": "application/dns-message"}, bytes(query))
+            assert response.status_code == 400
+
+
+class TestSharedTtlCache:
+    """The mmap answer cache is shared between processes and expires like TtlCache."""
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        return str(tmp_path / "answers")
+
+    def test_store_and_get_aged(self, path):
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        timer = _MockTimer()
+        cache = SharedTtlCache(path, slots=64, slot_size=128, timer=timer)
+        cache.store((b"q", "up"), b"answer", ttl=10)
+        timer.advance(3)
+        assert cache.get_aged((b"q", "up")) == (b"answer", 3)
+        assert cache.get((b"q", "other")) is None
+        assert len(cache) == 1
+
+        timer.advance(8)
+        with pytest.raises(KeyError):
+            cache.get_aged((b"q", "up"))
+        assert len(cache) == 0
+
+    def test_shared_between_processes(self, path):
+        import multiprocessing
+
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        reader = SharedTtlCache(path, slots=64, slot_size=128, timer=time.time)
+        process = multiprocessing.get_context("fork").Process(target=_store_in_shared_cache, args=(path,))
+        process.start()
+        process.join(10)
+        assert process.exitcode == 0
+        assert reader.get(("example.com", "A")) == b"from another worker"
+
+    def test_oversized_and_max_ttl(self, path):
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        timer = _MockTimer()
+        cache = SharedTtlCache(path, slots=64, slot_size=128, max_ttl=60, timer=timer)
+        cache.store("big", b"x" * 200)
+        assert cache.get("big") is None
+        cache.store("key", b"value", ttl=3600)
+        timer.advance(61)
+        assert cache.get("key") is None
+
+    def test_full_group_evicts_soonest_expiry(self, path):
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        cache = SharedTtlCache(path, slots=4, slot_size=128, timer=_MockTimer())
+        for i in range(4):
+            cache.store(i, b"%d" % i, ttl=100 + i)
+        cache.store("new", b"new", ttl=50)
+        assert cache.get(0) is None
+        assert [cache.get(i) for i in (1, 2, 3)] == [b"1", b"2", b"3"]
+        assert cache.get("new") == b"new"
+
+    def test_half_written_slot_is_a_miss(self, path):
+        from cf_patch_doh.shm_cache import HEADER_SIZE, SharedTtlCache
+
+        cache = SharedTtlCache(path, slots=4, slot_size=128, timer=_MockTimer())
+        cache.store("key", b"value")
+        index = next(i for i in range(4) if cache._read(i) is not None)
+        offset = HEADER_SIZE + index * 128
+        sequence = struct.unpack_from("=I", cache.mm, offset)[0]
+        struct.pack_into("=I", cache.mm, offset, sequence + 1)
+        assert cache.get("key") is None
+        struct.pack_into("=I", cache.mm, offset, sequence + 2)
+        assert cache.get("key") == b"value"
+
+    def test_clear_and_relayout(self, path):
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        cache = SharedTtlCache(path, slots=8, slot_size=128, timer=_MockTimer())
+        cache.store("key", b"value")
+        cache.clear()
+        assert cache.get("key") is None
+        cache.store("key", b"value")
+        cache.close()
+
+        assert SharedTtlCache(path, slots=8, slot_size=128, timer=_MockTimer()).get("key") == b"value"
+        assert SharedTtlCache(path, slots=16, slot_size=128, timer=_MockTimer()).get("key") is None
+
+    @pytest.mark.asyncio
+    async def test_resolve_uses_shared_cache(self, path):
+        from cf_patch_doh import app, wire
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        shared = SharedTtlCache(path, slots=64, encode=lambda a: a.packet, decode=wire.WireAnswer)
+        query = DNSRecord.question("example.com")
+        response = make_answer(query, [a_rr("example.com", "1.2.3.4")])
+        with (
+            patch("cf_patch_doh.dns_utils.CACHED_ANSWER", shared),
+            patch("cf_patch_doh.app.get_record", AsyncMock(return_value=response)) as mock_get,
+        ):
+            await app.resolve(bytes(query.pack()))
+            reply = DNSRecord.parse(await app.resolve(bytes(query.pack())))
+        mock_get.assert_awaited_once()
+        assert str(reply.rr[0].rdata) == "1.2.3.4"
+
+    def test_hits_counted_across_reads(self, path):
+        from cf_patch_doh import wire
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        cache = SharedTtlCache(path, slots=64, encode=lambda a: a.packet, decode=wire.WireAnswer, timer=_MockTimer())
+        packet = bytes(make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "1.2.3.4")]).pack())
+        cache.store("key", wire.WireAnswer(packet))
+        assert [cache.get("key").hits for _ in range(3)] == [0, 1, 2]
+        cache.store("key", wire.WireAnswer(packet))
+        assert cache.get("key").hits == 0
+
+    @pytest.mark.asyncio
+    async def test_hot_shared_answer_prefetched_once(self, path):
+        from cf_patch_doh import app, metrics, wire
+        from cf_patch_doh.shm_cache import SharedTtlCache
+
+        timer = _MockTimer()
+        shared = SharedTtlCache(path, slots=64, encode=lambda a: a.packet, decode=wire.WireAnswer, timer=timer)
+        query = DNSRecord.question("example.com")
+        answer = make_answer(query, [a_rr("example.com", "1.2.3.4", ttl=100)])
+
+        async def slow_get_record(query, upstream=None, refresh=False):
+            await asyncio.sleep(0.05)
+            return make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "5.6.7.8", ttl=100)])
+
+        prefetches = metrics.PREFETCHES.values.get((), 0)
+        with patch("cf_patch_doh.dns_utils.CACHED_ANSWER", shared):
+            with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=answer)):
+                for _ in range(3):
+                    await app.resolve(bytes(query.pack()))
+            timer.advance(95)
+            with patch("cf_patch_doh.app.get_record", AsyncMock(side_effect=slow_get_record)) as mock_get:
+                for _ in range(3):
+                    await app.resolve(bytes(query.pack()))
+                await asyncio.gather(*app.PREFETCHES.values())
+                reply = DNSRecord.parse(await app.resolve(bytes(query.pack())))
+        mock_get.assert_awaited_once()
+        assert metrics.PREFETCHES.values[()] == prefetches + 1
+        assert str(reply.rr[0].rdata) == "5.6.7.8"
+
+
+def _store_in_shared_cache(path: str):
+    from cf_patch_doh.shm_cache import SharedTtlCache
+
+    SharedTtlCache(path, slots=64, slot_size=128, timer=time.time).store(("example.com", "A"), b"from another worker")
+
+
+class TestSnapshot:
+    """Cache snapshots carry answers and patch targets across restarts."""
+
+    @staticmethod
+    def _state(timer):
+        from cf_patch_doh import wire
+        from cf_patch_doh.patch_target import PatchTarget, PatchTargets
+
+        cache = TtlCache(max_size=100, max_ttl=3000, timer=timer)
+        targets = PatchTargets(resolve=None, timer=timer)
+        targets.snapshot = PatchTarget(("203.0.113.1",), ("2001:db8::1",), ttl=600, version=3, refreshed_at=timer())
+        for domain, ttl in (("short.example", 30), ("long.example", 300)):
+            query = DNSRecord.question(domain)
+            packet = bytes(make_answer(query, [a_rr(domain, "1.2.3.4", ttl=ttl)]).pack())
+            cache.store((wire.question(bytes(query.pack())), "https://up/dns-query"), wire.WireAnswer(packet), ttl=ttl)
+        return cache, targets
+
+    def test_round_trip_after_downtime(self):
+        from cf_patch_doh import wire
+        from cf_patch_doh.patch_target import PatchTargets
+        from cf_patch_doh.snapshot import dump, restore
+
+        timer = _MockTimer()
+        cache, targets = self._state(timer)
+        timer.advance(10)
+        data = dump(cache, targets, clock=lambda: 50000.0)
+
+        # A new process, 60 seconds later, with its own monotonic clock.
+        new_timer = _MockTimer(start=7.0)
+        new_cache = TtlCache(max_size=100, max_ttl=3000, timer=new_timer)
+        new_targets = PatchTargets(resolve=None, timer=new_timer)
+        assert restore(data, new_cache, new_targets, clock=lambda: 50060.0) == 1
+
+        assert new_targets.snapshot.ipv4s == ("203.0.113.1",)
+        assert new_targets.snapshot.ipv6s == ("2001:db8::1",)
+        assert new_targets.snapshot.version == 3
+        assert new_targets.snapshot.refreshed_at == pytest.approx(7.0 - 70)
+
+        query = bytes(DNSRecord.question("long.example").pack())
+        answer, age = new_cache.get_aged((wire.question(query), "https://up/dns-query"))
+        assert age == pytest.approx(70)
+        assert DNSRecord.parse(answer.render(query, age)).rr[0].ttl == 230
+
+    def test_restore_keeps_fresher_targets(self):
+        from cf_patch_doh.patch_target import PatchTarget
+        from cf_patch_doh.snapshot import dump, restore
+
+        timer = _MockTimer()
+        cache, targets = self._state(timer)
+        data = dump(cache, targets)
+        targets.snapshot = PatchTarget(("198.51.100.1",), (), ttl=600, version=4, refreshed_at=timer())
+        restore(data, cache, targets)
+        assert targets.snapshot.ipv4s == ("198.51.100.1",)
+
+    @pytest.mark.asyncio
+    async def test_snapshotter_files(self, tmp_path):
+        from cf_patch_doh.patch_target import PatchTargets
+        from cf_patch_doh.snapshot import Snapshotter
+
+        timer = _MockTimer()
+        cache, targets = self._state(timer)
+        path = str(tmp_path / "snapshot")
+        await Snapshotter(path, cache, targets).save()
+
+        new_cache = TtlCache(max_size=100, max_ttl=3000)
+        new_targets = PatchTargets(resolve=None)
+        assert await Snapshotter(path, new_cache, new_targets).load() == 2
+        assert len(new_cache) == 2
+        assert new_targets.snapshot
+
+        assert await Snapshotter(str(tmp_path / "missing"), new_cache, new_targets).load() == 0
+        (tmp_path / "garbage").write_bytes(b"not a snapshot at all")
+        assert await Snapshotter(str(tmp_path / "garbage"), new_cache, new_targets).load() == 0
+
+    @pytest.mark.asyncio
+    async def test_shared_cache_keeps_targets_only(self, tmp_path, caplog):
+        from cf_patch_doh import wire
+        from cf_patch_doh.patch_target import PatchTargets
+        from cf_patch_doh.shm_cache import SharedTtlCache
+        from cf_patch_doh.snapshot import Snapshotter
+
+        timer = _MockTimer()
+        cache, targets = self._state(timer)
+        path = str(tmp_path / "snapshot")
+        await Snapshotter(path, cache, targets).save()
+
+        shared = SharedTtlCache(
+            str(tmp_path / "answers"), slots=64, encode=lambda a: a.packet, decode=wire.WireAnswer, timer=timer)
+        new_targets = PatchTargets(resolve=None)
+        snapshotter = Snapshotter(path, shared, new_targets)
+        with caplog.at_level(logging.WARNING, logger="cf_patch_doh.snapshot"):
+            assert await snapshotter.load() == 0
+        assert "shared cache" in caplog.text
+        assert new_targets.snapshot.ipv4s == ("203.0.113.1",)
+        assert len(shared) == 0
+
+        await snapshotter.save()
+        new_targets = PatchTargets(resolve=None)
+        assert await Snapshotter(path, TtlCache(max_size=100, max_ttl=3000), new_targets).load() == 0
+        assert new_targets.snapshot.version == 3
+
+
+class TestServeStale:
+    """Expired answers are refreshed, or served stale when the upstream can't; hot ones are prefetched."""
+
+    @pytest.fixture(autouse=True)
+    def timer(self):
+        from cf_patch_doh.dns_utils import CACHED_ANSWER
+
+        CACHED_ANSWER.clear()
+        timer = _MockTimer()
+        with patch.object(CACHED_ANSWER, "timer", timer):
+            yield timer
+        CACHED_ANSWER.clear()
+
+    @staticmethod
+    def _answer(ip: str, ttl: int = 60):
+        query = DNSRecord.question("example.com")
+        return make_answer(query, [a_rr("example.com", ip, ttl=ttl)])
+
+    @pytest.mark.asyncio
+    async def test_stale_served_when_refresh_fails(self, timer):
+        from cf_patch_doh import app
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4"))):
+            await app.resolve(query)
+        timer.advance(100)
+        with patch("cf_patch_doh.app.get_record", AsyncMock(side_effect=RuntimeError("down"))) as mock_get:
+            reply = DNSRecord.parse(await app.resolve(query))
+
+        assert mock_get.await_args.kwargs == {"refresh": True}
+        assert str(reply.rr[0].rdata) == "1.2.3.4"
+        assert reply.rr[0].ttl == 30
+
+    @pytest.mark.asyncio
+    async def test_stale_replaced_by_refresh(self, timer):
+        from cf_patch_doh import app
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4"))):
+            await app.resolve(query)
+        timer.advance(100)
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("5.6.7.8"))):
+            reply = DNSRecord.parse(await app.resolve(query))
+        assert str(reply.rr[0].rdata) == "5.6.7.8"
+        assert reply.rr[0].ttl == 60
+
+    @pytest.mark.asyncio
+    async def test_slow_refresh_serves_stale_then_updates(self, timer):
+        from cf_patch_doh import app
+
+        async def slow_get_record(query, upstream=None, refresh=False):
+            await asyncio.sleep(0.1)
+            return self._answer("5.6.7.8")
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4"))):
+            await app.resolve(query)
+        timer.advance(100)
+        with (
+            patch("cf_patch_doh.dns_utils.STALE_RESPONSE_TIMEOUT", 0.01),
+            patch("cf_patch_doh.app.get_record", slow_get_record),
+        ):
+            stale = DNSRecord.parse(await app.resolve(query))
+            await asyncio.sleep(0.2)
+            fresh = DNSRecord.parse(await app.resolve(query))
+
+        assert str(stale.rr[0].rdata) == "1.2.3.4"
+        assert str(fresh.rr[0].rdata) == "5.6.7.8"
+
+    @pytest.mark.asyncio
+    async def test_past_stale_window_is_a_miss(self, timer):
+        from cf_patch_doh import app
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.dns_utils.SERVE_STALE_TTL", 10):
+            with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4"))):
+                await app.resolve(query)
+            timer.advance(71)
+            with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("5.6.7.8"))) as mock_get:
+                await app.resolve(query)
+        assert mock_get.await_args.kwargs == {}
+
+    @pytest.mark.asyncio
+    async def test_long_ttl_refreshed_at_record_cache_cap(self, timer):
+        from cf_patch_doh import app
+        from cf_patch_doh.dns_utils import CACHED_QUERY
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4", ttl=86400))):
+            await app.resolve(query)
+        timer.advance(CACHED_QUERY.max_ttl - 1)
+        fresh = AsyncMock(return_value=self._answer("5.6.7.8", ttl=86400))
+        with patch("cf_patch_doh.app.get_record", fresh) as mock_get:
+            cached = DNSRecord.parse(await app.resolve(query))
+            mock_get.assert_not_awaited()
+            timer.advance(2)
+            refreshed = DNSRecord.parse(await app.resolve(query))
+
+        assert mock_get.await_args.kwargs == {"refresh": True}
+        assert str(cached.rr[0].rdata) == "1.2.3.4"
+        assert str(refreshed.rr[0].rdata) == "5.6.7.8"
+
+    @pytest.mark.asyncio
+    async def test_hot_answer_prefetched(self, timer):
+        from cf_patch_doh import app
+
+        query = bytes(DNSRecord.question("example.com").pack())
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("1.2.3.4", ttl=100))):
+            await app.resolve(query)
+        with patch("cf_patch_doh.app.get_record", AsyncMock(return_value=self._answer("5.6.7.8", ttl=100))) as mock_get:
+            await app.resolve(query)
+            timer.advance(95)
+            await app.resolve(query)
+            mock_get.assert_not_awaited()  # not hot yet
+
+            reply = DNSRecord.parse(await app.resolve(query))
+            assert str(reply.rr[0].rdata) == "1.2.3.4"
+            await asyncio.gather(*app.PREFETCHES.values())
+            mock_get.assert_awaited_once()
+            reply = DNSRecord.parse(await app.resolve(query))
+
+        assert str(reply.rr[0].rdata) == "5.6.7.8"
+        assert reply.rr[0].ttl == 100
+
+    @pytest.mark.asyncio
+    async def test_get_record_refresh_skips_caches(self):
+        from cf_patch_doh import app
+        from cf_patch_doh.dns_utils import CACHED_QUERY, store_cache
+
+        CACHED_QUERY.clear()
+        query = DNSRecord.question("example.com")
+        store_cache("example.com", "A", app.dns_utils.DEFAULT_UPSTREAM, [a_rr("example.com", "1.2.3.4")])
+        with patch("cf_patch_doh.dns_utils.fetch_record", AsyncMock(
+                return_value=self._answer("5.6.7.8"))) as mock_fetch:
+            cached = await app.get_record(bytes(query.pack()))
+            refreshed = await app.get_record(bytes(query.pack()), refresh=True)
+        CACHED_QUERY.clear()
+        mock_fetch.assert_awaited_once()
+        assert str(cached.rr[0].rdata) == "1.2.3.4"
+        assert str(refreshed.rr[0].rdata) == "5.6.7.8"
+
+
+class TestHedgedUpstreams:
+    """Queries go to the fastest upstream of a pool and are hedged when it's slow."""
+
+    @staticmethod
+    def _sender(behaviour: dict, calls: list):
+        async def send(upstream):
+            calls.append(upstream)
+            delay, result = behaviour[upstream]
+            await asyncio.sleep(delay)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return send
+
+    @staticmethod
+    def _upstreams(**kwargs):
+        from cf_patch_doh.upstream import HedgedUpstreams
+
+        return HedgedUpstreams({"a": ["a", "b"]}, **kwargs)
+
+    @pytest.mark.asyncio
+    async def test_fast_primary_not_hedged(self):
+        upstreams = self._upstreams(default_delay=0.05)
+        calls = []
+        assert await upstreams.query("a", self._sender({"a": (0, "A"), "b": (0, "B")}, calls)) == "A"
+        assert calls == ["a"]
+        assert upstreams.hedged == 0
+        assert upstreams.stats["a"].ewma is not None
+
+    @pytest.mark.asyncio
+    async def test_slow_primary_hedged(self):
+        upstreams = self._upstreams(default_delay=0.02)
+        calls = []
+        result = await upstreams.query("a", self._sender({"a": (1, "A"), "b": (0, "B")}, calls))
+        assert result == "B"
+        assert calls == ["a", "b"]
+        assert upstreams.hedged == 1
+
+    @pytest.mark.asyncio
+    async def test_failure_falls_over_immediately(self):
+        upstreams = self._upstreams(default_delay=10)
+        calls = []
+        result = await upstreams.query("a", self._sender({"a": (0, RuntimeError("down")), "b": (0, "B")}, calls))
+        assert result == "B"
+        assert upstreams.hedged == 0
+        assert upstreams.stats["a"].failures == 1
+        # The failed upstream now ranks behind the one that answered.
+        assert upstreams.candidates("a") == ["b", "a"]
+
+    @pytest.mark.asyncio
+    async def test_all_failing_raises(self):
+        upstreams = self._upstreams()
+        from cf_patch_doh.upstream import UpstreamError
+
+        sender = self._sender({"a": (0, RuntimeError("a down")), "b": (0, RuntimeError("b down"))}, [])
+        with pytest.raises(UpstreamError) as excinfo:
+            await upstreams.query("a", sender)
+        assert isinstance(excinfo.value.__cause__, RuntimeError)
+
+    @pytest.mark.asyncio
+    async def test_deadline(self):
+        upstreams = self._upstreams(timeout=0.05, default_delay=0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await upstreams.query("a", self._sender({"a": (1, "A"), "b": (1, "B")}, []))
+        assert upstreams.stats["a"].failures + upstreams.stats["b"].failures == 1
+
+    @pytest.mark.asyncio
+    async def test_per_upstream_deadline(self):
+        from cf_patch_doh.upstream import HedgedUpstreams, UpstreamTimeout
+
+        upstreams = HedgedUpstreams(timeout=5, timeouts={"https://slow.test/": 0.05})
+        send = self._sender({"https://slow.test/": (1, "A"), "https://other.test/": (0.1, "B")}, [])
+        with pytest.raises(UpstreamTimeout, match="0.05s"):
+            await upstreams.query("https://slow.test/", send)
+        assert await upstreams.query("https://other.test/", send) == "B"
+        assert upstreams.timeout_for("https://other.test/") == 5
+
+    def test_parse_timeouts(self):
+        from cf_patch_doh.upstream import parse_timeouts
+
+        assert parse_timeouts("") == {}
+        assert parse_timeouts("https://a.test/dns-query?x=1=2, https://b.test/=0.5") == {
+            "https://a.test/dns-query?x=1": 2.0, "https://b.test/": 0.5}
+        with pytest.raises(ValueError):
+            parse_timeouts("3")
+
+    @pytest.mark.asyncio
+    async def test_custom_upstream_alone(self):
+        upstreams = self._upstreams()
+        calls = []
+        assert await upstreams.query("custom", self._sender({"custom": (0, "C")}, calls)) == "C"
+        assert calls == ["custom"]
+        assert "custom" not in upstreams.stats
+
+    def test_ranking_and_hedge_delay(self):
+        upstreams = self._upstreams(min_delay=0.05, default_delay=0.5)
+        assert upstreams.hedge_delay("a") == 0.5
+        for latency in (0.2, 0.3, 0.25):
+            upstreams.stats["a"].observe(latency)
+        upstreams.stats["b"].observe(0.01)
+        assert upstreams.candidates("a") == ["b", "a"]
+        assert upstreams.hedge_delay("a") == 0.3
+        assert upstreams.hedge_delay("b") == 0.05
+
+
+class TestCircuitBreaker:
+    """Failing upstreams are skipped for a while, probed, and fail fast meanwhile."""
+
+    @staticmethod
+    def _health(timer, **kwargs):
+        from cf_patch_doh.upstream import UpstreamHealth
+
+        return UpstreamHealth(threshold=3, open_seconds=10, max_open_seconds=30, timer=timer, **kwargs)
+
+    def test_opens_after_consecutive_failures(self):
+        timer = _MockTimer()
+        health = self._health(timer)
+        for _ in range(2):
+            health.failure("up")
+        health.success("up")
+        for _ in range(2):
+            health.failure("up")
+        assert health.allow("up")
+        health.failure("up")
+        assert health.state("up") == "open"
+        assert not health.allow("up")
+        assert health.rejected == 1
+
+    def test_half_open_probe(self):
+        timer = _MockTimer()
+        health = self._health(timer)
+        for _ in range(3):
+            health.failure("up")
+
+        timer.advance(10)
+        assert health.allow("up")
+        assert health.state("up") == "half-open"
+        assert not health.allow("up")  # one probe at a time
+
+        health.failure("up")
+        timer.advance(10)
+        assert not health.allow("up")  # open twice as long now
+        timer.advance(10)
+        assert health.allow("up")
+        health.release("up")
+        assert health.allow("up")
+        health.success("up")
+        assert health.state("up") == "closed"
+        assert health.allow("up")
+
+    def test_tracked_upstreams_capped(self):
+        health = self._health(_MockTimer(), max_tracked=2)
+        for upstream in ("a", "b", "a", "c"):
+            health.failure(upstream)
+        assert list(health.breakers) == ["a", "c"]
+        health.success("never-failed")
+        assert len(health) == 2
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_fails_fast(self):
+        from cf_patch_doh.upstream import CircuitOpenError, HedgedUpstreams
+
+        timer = _MockTimer()
+        upstreams = HedgedUpstreams({"a": ["a", "b"]}, health=self._health(timer), default_delay=10)
+        for _ in range(3):
+            upstreams.health.failure("a")
+        send = AsyncMock(return_value="B")
+        assert await upstreams.query("a", send) == "B"
+        send.assert_awaited_once_with("b")
+
+        for _ in range(3):
+            upstreams.health.failure("custom")
+        send.reset_mock()
+        with pytest.raises(CircuitOpenError):
+            await upstreams.query("custom", send)
+        send.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_hanging_probe_reopens_the_circuit(self):
+        from cf_patch_doh.upstream import HedgedUpstreams, UpstreamTimeout
+
+        timer = _MockTimer()
+        upstreams = HedgedUpstreams(health=self._health(timer), timeout=0.01)
+        for _ in range(3):
+            upstreams.health.failure("up")
+        timer.advance(10)
+
+        async def hang(upstream):
+            await asyncio.sleep(10)
+
+        with pytest.raises(UpstreamTimeout):
+            await upstreams.query("up", hang)
+        assert upstreams.health.state("up") == "open"
+        assert upstreams.health.breakers["up"].open_seconds == 20
+        timer.advance(10)
+        assert not upstreams.health.available("up")  # not probed again until the doubled window passes
+
+    @pytest.mark.asyncio
+    async def test_failures_open_the_circuit(self):
+        from cf_patch_doh.upstream import CircuitOpenError, HedgedUpstreams, UpstreamError
+
+        upstreams = HedgedUpstreams(health=self._health(_MockTimer()))
+        send = AsyncMock(side_effect=RuntimeError("connection refused"))
+        for _ in range(3):
+            with pytest.raises(UpstreamError):
+                await upstreams.query("https://dead.test/dns-query", send)
+        with pytest.raises(CircuitOpenError):
+            await upstreams.query("https://dead.test/dns-query", send)
+        assert send.await_count == 3
+
+    @pytest.mark.asyncio
+    async def test_dead_upstream_servfails_before_circuit_opens(self):
+        import httpx
+
+        from cf_patch_doh import app
+
+        query = DNSRecord.question("example.com")
+        with (
+            patch("cf_patch_doh.dns_utils.UPSTREAMS.health", self._health(_MockTimer())),
+            patch("cf_patch_doh.dns_utils._post", AsyncMock(side_effect=httpx.ConnectError("refused"))),
+        ):
+            reply = await app.get_record(bytes(query.pack()), "https://dead.test/dns-query", refresh=True)
+        assert reply.header.rcode == dnslib.RCODE.SERVFAIL
+
+    @pytest.mark.asyncio
+    async def test_get_record_servfail(self):
+        from cf_patch_doh import app
+        from cf_patch_doh.upstream import CircuitOpenError
+
+        query = DNSRecord.question("example.com")
+        with patch("cf_patch_doh.dns_utils.fetch_record", AsyncMock(side_effect=CircuitOpenError("open"))):
+            reply = await app.get_record(bytes(query.pack()), "https://dead.test/dns-query", refresh=True)
+        assert reply.header.rcode == dnslib.RCODE.SERVFAIL
+        assert reply.header.id == query.header.id
+
+
+class TestMetrics:
+    """/metrics exposes counters and histograms in the Prometheus text format."""
+
+    def test_histogram_render(self):
+        from cf_patch_doh.metrics import Histogram
+
+        histogram = Histogram("latency_seconds", "Latency.", ("transport",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, "udp")
+        lines = list(histogram.render())
+        assert 'latency_seconds_bucket{transport="udp",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{transport="udp",le="1"} 3' in lines
+        assert 'latency_seconds_bucket{transport="udp",le="+Inf"} 4' in lines
+        assert 'latency_seconds_count{transport="udp"} 4' in lines
+
+    def test_counter_label_escaping(self):
+        from cf_patch_doh.metrics import Counter
+
+        counter = Counter("things_total", "Things.", ("name",))
+        counter.inc('a"b')
+        counter.inc('a"b', amount=2)
+        assert list(counter.render())[-1] == 'things_total{name="a\\"b"} 3'
+
+    def test_ttl_cache_counters(self):
+        timer = _MockTimer()
+        cache = TtlCache(max_size=2, timer=timer)
+        cache.store("a", 1, ttl=10)
+        cache.get("a")
+        cache.get("missing")
+        cache.store("b", 2, ttl=20)
+        cache.store("c", 3, ttl=30)
+        timer.advance(25)
+        cache.get("b")
+        assert (cache.hits, cache.misses, cache.evictions, cache.expirations) == (1, 2, 1, 1)
+
+    @pytest.mark.asyncio
+    async def test_patch_decisions_and_upstream_latency(self):
+        from cf_patch_doh import metrics
+        from cf_patch_doh.dns_utils import patch_record
+        from cf_patch_doh.upstream import HedgedUpstreams
+
+        decisions = dict(metrics.PATCH_DECISIONS.values)
+        await patch_record(_build_dns_response("cloudflare.com", "A", [a_rr("cloudflare.com", "104.16.0.1")]))
+        await patch_record(_build_dns_response("example.com", "A", [a_rr("example.com", "1.2.3.4")]))
+        with _patch_target(["203.0.113.1"], []):
+            await patch_record(_build_dns_response("example.com", "A", [a_rr("example.com", "104.16.0.1")]))
+        for decision in ("bypassed", "untouched", "a_aaaa"):
+            assert metrics.PATCH_DECISIONS.values[(decision,)] == decisions.get((decision,), 0) + 1
+
+        await HedgedUpstreams({"a": ["a"]}).query("https://custom.test/", AsyncMock(return_value="ok"))
+        assert ("custom",) in metrics.UPSTREAM_LATENCY.counts
+        assert ("https://custom.test/",) not in metrics.UPSTREAM_LATENCY.counts
+
+    def test_metrics_endpoint(self):
+        from starlette.testclient import TestClient
+
+        from cf_patch_doh.app import app
+
+        response = TestClient(app).get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert 'cfdoh_cache_hits_total{cache="answer"}' in response.text
+        assert "# TYPE cfdoh_query_duration_seconds histogram" in response.text
+
+    @pytest.mark.asyncio
+    async def test_singleflight_counters(self):
+        from cf_patch_doh import metrics
+        from cf_patch_doh.app import REFRESHES
+
+        def values(name):
+            (metric,) = [metric for metric in metrics.REGISTRY if metric.name == name]
+            return metric.callback()
+
+        before = values("cfdoh_singleflight_coalesced_total")
+        started = values("cfdoh_singleflight_originated_total")
+        gate = asyncio.Event()
+
+        async def lookup():
+            await gate.wait()
+            return None
+
+        waiters = [asyncio.ensure_future(REFRESHES.do("key", lookup)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert values("cfdoh_singleflight_inflight")[("refresh",)] == 1
+        gate.set()
+        await asyncio.gather(*waiters)
+        assert values("cfdoh_singleflight_originated_total")[("refresh",)] == started[("refresh",)] + 1
+        assert values("cfdoh_singleflight_coalesced_total")[("refresh",)] == before[("refresh",)] + 2
+        assert ("upstream",) in before
+
+
+class TestTracing:
+    """Sampled queries write a span with per-stage timings; unsampled ones cost a no-op."""
+
+    @pytest.fixture(autouse=True)
+    def clean_caches(self):
+        from cf_patch_doh.dns_utils import CACHED_ANSWER, CACHED_QUERY
+
+        CACHED_ANSWER.clear()
+        CACHED_QUERY.clear()
+        yield
+        CACHED_ANSWER.clear()
+        CACHED_QUERY.clear()
+
+    def test_off_by_default(self):
+        from cf_patch_doh import tracing
+
+        with patch("cf_patch_doh.tracing.TRACE_SAMPLE_RATE", 0):
+            assert tracing.start("resolve") is None
+            assert tracing.stage("parse") is tracing._NO_STAGE
+            tracing.annotate(cache="hit")
+        assert tracing.current() is None
+
+    @pytest.mark.asyncio
+    async def test_resolve_writes_json_span(self, tmp_path):
+        from cf_patch_doh import app, dns_utils, tracing
+
+        path = tmp_path / "trace.jsonl"
+        answer = make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "1.2.3.4")])
+        query = bytes(DNSRecord.question("example.com").pack())
+        with (
+            patch("cf_patch_doh.tracing.TRACE_SAMPLE_RATE", 1),
+            patch("cf_patch_doh.tracing.SINK", tracing.Sink(str(path), "json")),
+            patch("cf_patch_doh.dns_utils.fetch_record", AsyncMock(return_value=answer)),
+        ):
+            await app.resolve(query)
+            await app.resolve(query)
+            tracing.SINK.file.close()
+        assert tracing.current() is None
+
+        miss, hit = [json.loads(line) for line in path.read_text().splitlines()]
+        assert miss["name"] == "resolve"
+        assert miss["attrs"] == {
+            "upstream": dns_utils.DEFAULT_UPSTREAM, "cache": "miss", "domain": "example.com", "type": "A",
+            "patched_cache": "miss", "patched": False,
+        }
+        stages = [name for name, _, _ in miss["stages"]]
+        assert stages[:4] == ["wire_cache", "parse", "record_cache", "fetch"]
+        assert "cloudflare_check" in stages and stages[-2:] == ["pack", "store"]
+        assert all(offset >= 0 and duration >= 0 for _, offset, duration in miss["stages"])
+        assert hit["attrs"]["cache"] == "hit"
+        assert [name for name, _, _ in hit["stages"]] == ["wire_cache", "render"]
+
+    def test_otlp_format(self):
+        from cf_patch_doh import tracing
+
+        span = tracing.Span("resolve", {"upstream": "u"})
+        with tracing._Stage(span, "fetch"):
+            pass
+        with patch.object(tracing.SINK, "write"):
+            span.finish()
+        with tracing._Stage(span, "late"):
+            pass
+        assert [name for name, _, _ in span.stages] == ["fetch"]
+
+        root, fetch = span.to_otlp()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert root["traceId"] == fetch["traceId"] and len(root["traceId"]) == 32
+        assert fetch["parentSpanId"] == root["spanId"] and "parentSpanId" not in root
+        assert int(root["startTimeUnixNano"]) <= int(fetch["startTimeUnixNano"])
+        assert int(fetch["endTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+        assert root["attributes"] == [{"key": "upstream", "value": {"stringValue": "u"}}]
+
+        with pytest.raises(ValueError):
+            tracing.Sink(None, "xml")
+
+
+class TestBench:
+    """The benchmark harness runs against its stub upstream without network access."""
+
+    def test_stub_upstream_answers(self):
+        from cf_patch_doh.stub_upstream import StubUpstream
+
+        cloudflare = StubUpstream(cloudflare_ratio=1).answer(bytes(DNSRecord.question("a.example").pack()))
+        other = StubUpstream(cloudflare_ratio=0).answer(bytes(DNSRecord.question("a.example", "AAAA").pack()))
+        assert is_cloudflare_sync(str(DNSRecord.parse(cloudflare).rr[0].rdata))
+        assert not is_cloudflare_sync(str(DNSRecord.parse(other).rr[0].rdata))
+
+    @pytest.mark.asyncio
+    async def test_workloads(self):
+        from bench import load
+
+        patched = await load.run_workload("patch", "POST", 20, concurrency=4)
+        assert patched["errors"] == 0 and patched["upstream_queries"] == 20
+        hit = await load.run_workload("hit", "GET", 20, concurrency=4, vocabulary=10)
+        assert hit["errors"] == 0 and hit["upstream_queries"] == 0
+        assert hit["p50_ms"] <= hit["p99_ms"]
+
+
+class TestReplay:
+    """Query logs replay through get_record on the log's clock."""
+
+    @pytest.fixture(autouse=True)
+    def clean_caches(self):
+        from cf_patch_doh.stub_upstream import clear_caches
+
+        clear_caches()
+        yield
+        clear_caches()
+
+    def test_read_log(self):
+        from cf_patch_doh import dns_utils
+        from cf_patch_doh.replay import read_log
+
+        entries = list(read_log([
+            "# comment",
+            '{"timestamp": 10.5, "name": "a.example", "type": "AAAA", "upstream": "https://dns.test/"}',
+            "11,b.example",
+            "12 c.example HTTPS",
+        ]))
+        assert [(e.timestamp, e.name, e.type, e.upstream) for e in entries] == [
+            (10.5, "a.example", "AAAA", "https://dns.test/"),
+            (11.0, "b.example", "A", dns_utils.DEFAULT_UPSTREAM),
+            (12.0, "c.example", "HTTPS", dns_utils.DEFAULT_UPSTREAM),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_replay_follows_log_clock(self):
+        from cf_patch_doh.replay import read_log, Replay
+        from cf_patch_doh.stub_upstream import StubUpstream
+
+        rows = []
+        replay = Replay(StubUpstream(ttl=300), concurrency=1, window=100, report=rows.append)
+        summary = await replay.run(read_log([
+            "1000 a.example A",
+            "1001 a.example A",
+            "1002 b.example BOGUS",
+            # Past the 300s TTL in log time, though no time passed.
+            "1400 a.example A",
+        ]))
+        assert summary["queries"] == 4 and summary["skipped"] == 1
+        assert summary["upstream_queries"] == 2
+        assert summary["hit_ratio"] == 0.25
+        assert summary["cache_bytes"] > 0
+        assert summary["patched_entries"] > 0
+        assert [row["queries"] for row in rows] == [3, 0, 0, 0, 1]
+
+
+class TestPackedRecords:
+    """Cached records are kept packed and parsed back into new RRs on read."""
+
+    def test_round_trip_with_age(self):
+        from dnslib import CNAME
+
+        from cf_patch_doh.dns_utils import PackedRecords
+
+        rrs = [
+            RR("www.example.com", QTYPE.CNAME, rdata=CNAME("cdn.example.com"), ttl=300),
+            a_rr("cdn.example.com", "104.16.0.1", ttl=60),
+        ]
+        packed = PackedRecords(rrs)
+        assert len(packed) == 2
+        first, second = packed.unpack(), packed.unpack(age=100)
+        assert [str(rr) for rr in first] == [str(rr) for rr in rrs]
+        assert [rr.ttl for rr in second] == [200, 0]
+        assert first[1] is not second[1]
+        # Names are compressed against each other.
+        assert len(packed.data) < sum(len(PackedRecords([rr]).data) for rr in rrs)
+
+    def test_cache_keys_are_interned(self):
+        from cf_patch_doh.dns_utils import CACHED_QUERY, store_cache
+
+        CACHED_QUERY.clear()
+        upstream = "".join(["https://dns.test/", "dns-query"])
+        store_cache("".join(["example", ".com"]), "A", upstream, [a_rr("example.com", "1.2.3.4")])
+        store_cache("".join(["example", ".com"]), "AAAA", upstream, [])
+        (a_key, aaaa_key) = CACHED_QUERY.storage
+        CACHED_QUERY.clear()
+        assert a_key[0] is aaaa_key[0] and a_key[2] is aaaa_key[2]
+
+
+class TestPatchedCache:
+    """Upstream answers and patched answers are cached apart; patching reruns only for new targets."""
+    @pytest.fixture(autouse=True)
+    def timer(self):
+        from cf_patch_doh.dns_utils import CACHED_NEGATIVE, CACHED_QUERY
+
+        CACHED_QUERY.clear()
+        CACHED_NEGATIVE.clear()
+        timer = _MockTimer()
+        with patch.object(CACHED_QUERY, "timer", timer):
+            yield timer
+        CACHED_QUERY.clear()
+        CACHED_NEGATIVE.clear()
+
+    @staticmethod
+    def _upstream(ttl: int = 300) -> DNSRecord:
+        return make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "104.16.0.1", ttl=ttl)])
+
+    @staticmethod
+    async def _get(upstream: DNSRecord) -> tuple[DNSRecord, AsyncMock, AsyncMock]:
+        from cf_patch_doh import app, dns_utils
+
+        patch_record = AsyncMock(wraps=dns_utils.patch_record)
+        with (
+            patch("cf_patch_doh.dns_utils.fetch_record", AsyncMock(return_value=upstream)) as fetch,
+            patch("cf_patch_doh.dns_utils.patch_record", patch_record),
+        ):
+            reply = await app.get_record(bytes(DNSRecord.question("example.com").pack()))
+        return reply, fetch, patch_record
+
+    @pytest.mark.asyncio
+    async def test_raw_answer_not_overwritten_by_patched(self):
+        from cf_patch_doh.dns_utils import DEFAULT_UPSTREAM, get_cache, store_cache
+
+        upstream = self._upstream()
+        store_cache("example.com", "A", DEFAULT_UPSTREAM, upstream.rr)
+        with _patch_target(["203.0.113.1"], []):
+            reply, fetch, _ = await self._get(upstream)
+            again, _, patch_record = await self._get(upstream)
+
+        fetch.assert_not_awaited()
+        patch_record.assert_not_awaited()
+        assert [str(rr.rdata) for rr in reply.rr] == [str(rr.rdata) for rr in again.rr] == ["203.0.113.1"]
+        assert [str(rr.rdata) for rr in get_cache("example.com", "A", None)] == ["104.16.0.1"]
+
+    @pytest.mark.asyncio
+    async def test_new_targets_repatch_without_refetch(self):
+        from cf_patch_doh.dns_utils import DEFAULT_UPSTREAM, store_cache
+        from cf_patch_doh.patch_target import PatchTarget
+
+        store_cache("example.com", "A", DEFAULT_UPSTREAM, self._upstream().rr)
+        with _patch_target(["203.0.113.1"], []):
+            await self._get(self._upstream())
+        moved = PatchTarget(["203.0.113.2"], [], ttl=600, version=2, refreshed_at=0)
+        with patch("cf_patch_doh.dns_utils.PATCH_TARGETS.snapshot", moved):
+            reply, fetch, patch_record = await self._get(self._upstream())
+
+        fetch.assert_not_awaited()
+        patch_record.assert_awaited_once()
+        assert [str(rr.rdata) for rr in reply.rr] == ["203.0.113.2"]
+
+    @pytest.mark.asyncio
+    async def test_refetched_answer_not_patched_twice(self, timer):
+        with _patch_target(["203.0.113.1"], []):
+            _, fetch, patch_record = await self._get(self._upstream(ttl=300))
+            fetch.assert_awaited_once()
+            patch_record.assert_awaited_once()
+
+            # Only the TTL differs after the upstream answer expired and came back.
+            timer.advance(400)
+            reply, fetch, patch_record = await self._get(self._upstream(ttl=120))
+            fetch.assert_awaited_once()
+            patch_record.assert_not_awaited()
+        assert [str(rr.rdata) for rr in reply.rr] == ["203.0.113.1"]
+
+    @pytest.mark.asyncio
+    async def test_patched_hit_ages_with_upstream_answer(self, timer):
+        from cf_patch_doh.dns_utils import DEFAULT_UPSTREAM, store_cache
+
+        store_cache("example.com", "A", DEFAULT_UPSTREAM, self._upstream().rr)
+        with _patch_target(["203.0.113.1"], []), patch("cf_patch_doh.dns_utils.PATCHED_TTL_FLOOR", 0):
+            fresh, _, _ = await self._get(self._upstream())
+            timer.advance(100)
+            aged, _, patch_record = await self._get(self._upstream())
+        patch_record.assert_not_awaited()
+        assert aged.rr[0].ttl == fresh.rr[0].ttl - 100
+
+    @pytest.mark.asyncio
+    async def test_patched_hit_takes_refetched_ttls(self, timer):
+        def upstream(ttl: int) -> DNSRecord:
+            return make_answer(DNSRecord.question("example.com"), [
+                RR("example.com", QTYPE.CNAME, rdata=dnslib.CNAME("cdn.example.com"), ttl=ttl),
+                a_rr("cdn.example.com", "104.16.0.1", ttl=ttl),
+            ])
+
+        with _patch_target(["203.0.113.1"], []), patch("cf_patch_doh.dns_utils.PATCHED_TTL_FLOOR", 30):
+            first, _, _ = await self._get(upstream(300))
+            timer.advance(400)
+            reply, fetch, patch_record = await self._get(upstream(20))
+        fetch.assert_awaited_once()
+        patch_record.assert_not_awaited()
+        assert first.rr[0].ttl == 300
+        # The CNAME is the upstream's: its refetched TTL, clamped like a freshly patched answer's.
+        assert reply.rr[0].rtype == QTYPE.CNAME and reply.rr[0].ttl == 30
+        assert [str(rr.rdata) for rr in reply.rr[1:]] == ["203.0.113.1"]
+
+    @pytest.mark.asyncio
+    async def test_unpatched_answer_served_from_upstream_tier(self, timer):
+        from cf_patch_doh.dns_utils import CACHED_PATCHED, DEFAULT_UPSTREAM, store_cache
+
+        upstream = make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "198.51.100.1")])
+        store_cache("example.com", "A", DEFAULT_UPSTREAM, upstream.rr)
+        with _patch_target(["203.0.113.1"], []):
+            await self._get(upstream)
+            timer.advance(100)
+            reply, _, patch_record = await self._get(upstream)
+        patch_record.assert_not_awaited()
+        ((_, (patched, _, was_patched), _),) = CACHED_PATCHED.storage.values()
+        assert patched is None and not was_patched
+        assert reply.rr[0].ttl == 200 and str(reply.rr[0].rdata) == "198.51.100.1"
+
+    def test_digest_ignores_ttls(self):
+        from cf_patch_doh.dns_utils import PackedRecords
+
+        digest = PackedRecords(self._upstream(ttl=300).rr).digest()
+        assert PackedRecords(self._upstream(ttl=5).rr).digest() == digest
+        other = make_answer(DNSRecord.question("example.com"), [a_rr("example.com", "104.16.0.2")])
+        assert PackedRecords(other.rr).digest() != digest
+
+
 class MockResponse:
     """Minimal mock for httpx.Response used in tests."""
 